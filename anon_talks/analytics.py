@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import suppress
+from typing import Dict, Optional
+
+from anon_talks.integrations.botlytics import BotlyticsClient, BotlyticsPipeline
+
+
+WAIT_BUCKETS = (5, 15, 30, 60, 120, 300, 600)  # in seconds
+WAIT_LABELS = tuple(f'up to {bound} s' for bound in WAIT_BUCKETS) + (f'over {WAIT_BUCKETS[-1]} s',)
+
+
+class _ConversationStats:
+    __slots__ = ('started_at', 'touched_at', 'message_count')
+
+    def __init__(self, started_at: Optional[float], now: float):
+        self.started_at = started_at  # None, if the conversation is started by another process
+        self.touched_at = now
+        self.message_count = 0
+
+
+class ConversationAnalytics:
+    """
+    Aggregator of analytics events in the process, sent as summaries instead of an event per message.
+
+    Counters of a conversation are kept, while it's in progress, and sent as one event, when it's finished:
+    the count of relayed messages, the duration and the user, who disconnected.
+    Counts of searches and matches and a histogram of waiting for a match are sent as one rollup event
+    every `rollup_interval` seconds. Nothing is collected, until the aggregator is started with a pipeline.
+    Searches and conversations, left by other processes, are forgotten after `forget_after` seconds.
+    """
+
+    def __init__(self, rollup_interval: float, forget_after: float):
+        self._rollup_interval = rollup_interval
+        self._forget_after = forget_after
+        self._pipeline: Optional[BotlyticsPipeline] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self._conversations: Dict[int, _ConversationStats] = {}
+        self._search_started_at: Dict[int, float] = {}  # by user id
+        self._counts = dict.fromkeys(('searches', 'matches', 'cancelled', 'timed_out'), 0)
+        self._wait_counters = [0] * (len(WAIT_BUCKETS) + 1)  # with the bucket of longer waits in the end
+
+    @property
+    def is_started(self) -> bool:
+        return self._pipeline is not None
+
+    def start(self, pipeline: BotlyticsPipeline):
+        self._pipeline = pipeline
+        self._task = asyncio.create_task(self._roll_up_forever())
+
+    async def close(self):
+        """
+        Stop the rollups, put the last one to the pipeline.
+        """
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._pipeline:
+            self.roll_up()
+            self._pipeline = None
+
+    def search_started(self, user_id: int):
+        if self._pipeline:
+            self._counts['searches'] += 1
+            self._search_started_at[user_id] = time.monotonic()
+
+    def search_stopped(self, *user_ids: int, timed_out=False):
+        if self._pipeline:
+            self._counts['timed_out' if timed_out else 'cancelled'] += len(user_ids)
+            for user_id in user_ids:
+                self._search_started_at.pop(user_id, None)
+
+    def conversation_started(self, conversation_id: int, initiator_id: int):
+        if self._pipeline:
+            now = time.monotonic()
+            self._counts['matches'] += 1
+            search_started_at = self._search_started_at.pop(initiator_id, None)
+            if search_started_at is not None:
+                self._wait_counters[bisect_left(WAIT_BUCKETS, now - search_started_at)] += 1
+            self._conversations[conversation_id] = _ConversationStats(now, now)
+
+    def message_relayed(self, conversation_id: int):
+        if self._pipeline:
+            now = time.monotonic()
+            stats = self._conversations.get(conversation_id)
+            if stats is None:
+                stats = self._conversations[conversation_id] = _ConversationStats(None, now)
+            stats.touched_at = now
+            stats.message_count += 1
+
+    def conversation_finished(self, conversation_id: int, user_id: int):
+        """
+        Put the summary of the conversation to the pipeline, the user is the one, who disconnected.
+        """
+        if not self._pipeline:
+            return
+        stats = self._conversations.pop(conversation_id, None) or _ConversationStats(None, time.monotonic())
+        text = f'Conversation finished: {stats.message_count} messages'
+        if stats.started_at is not None:
+            text += f', {time.monotonic() - stats.started_at:.0f} s'
+        self._pipeline.put(
+            text=text,
+            kind=BotlyticsClient.KIND_OUTGOING,
+            conversation_id=conversation_id,
+            sender_id=f'user_{user_id}',
+        )
+
+    def roll_up(self):
+        """
+        Put the counts since the previous rollup to the pipeline, if there are any, and reset them.
+        """
+        now = time.monotonic()
+        forgotten_before = now - self._forget_after
+        self._search_started_at = {
+            user_id: started_at for user_id, started_at in self._search_started_at.items()
+            if started_at >= forgotten_before
+        }
+        self._conversations = {
+            conversation_id: stats for conversation_id, stats in self._conversations.items()
+            if stats.touched_at >= forgotten_before
+        }
+
+        if not any(self._counts.values()):
+            return
+        waits = ', '.join(f'{label}: {counter}' for label, counter in zip(WAIT_LABELS, self._wait_counters))
+        text = ('Rollup: {searches} searches, {matches} matches, {cancelled} cancelled, {timed_out} timed out; '
+                'waits for a match {waits}').format(waits=waits, **self._counts)
+        self._pipeline.put(text=text, kind=BotlyticsClient.KIND_OUTGOING)
+        self._counts = dict.fromkeys(self._counts, 0)
+        self._wait_counters = [0] * len(self._wait_counters)
+
+    async def _roll_up_forever(self):
+        while True:
+            await asyncio.sleep(self._rollup_interval)
+            try:
+                self.roll_up()
+            except Exception:
+                logging.exception('Rollup of analytics failed.')
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from datetime import timedelta
+
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.webhook import configure_app
+from aiohttp import web
+from tortoise import run_async, Tortoise
+
+from anon_talks import config, metrics
+from anon_talks.archive import make_archiver
+from anon_talks.integrations.botlytics import BotlyticsClient, BotlyticsPipeline
+from anon_talks.bot import bot, dispatcher, sender, MetricsMiddleware
+from anon_talks.broker import StateBroker
+from anon_talks.db import init_db, warm_up_db
+from anon_talks.instrumentation import install_query_hook
+from anon_talks.models import broker_client, matchmaker
+from anon_talks.polling import OffsetStore, UpdatePoller
+from anon_talks.reaper import WaitingReaper
+from anon_talks.services import conversation_analytics, media_groups
+from anon_talks.storage import default_storage
+from anon_talks.upstream import get_nginx_upstream, get_worker_socket_names
+
+
+def start(socket_name=None):
+    if socket_name:
+        path = str(config.ROOT_PATH / 'socks' / socket_name)
+        host = None
+        port = None
+    else:
+        path = None
+        host = config.WEBAPP_HOST
+        port = config.WEBAPP_PORT
+
+    web_app = web.Application()
+    web_app.router.add_get('/metrics', metrics.handle_metrics)
+    configure_app(dispatcher, web_app, path=get_webhook_path())
+    web_app.on_startup.append(_on_app_startup)
+    web_app.on_shutdown.append(_on_app_shutdown)
+    web.run_app(web_app, host=host, port=port, path=path)
+
+
+def start_polling():
+    """
+    Run the bot by long polling of updates instead of the webhook.
+    """
+    run_async(_poll())
+
+
+def get_webhook_path() -> str:
+    return f'/callback/{config.BOT_API_TOKEN}/'
+
+
+def start_workers(workers_count: int):
+    """
+    Run webhook workers on separate unix sockets, restarting them if they exit.
+
+    The matchmaking state is hosted by this process and shared with the workers through the broker.
+    The global rate limit of Telegram is split equally among this process and the workers.
+    """
+    run_async(_supervise_workers(workers_count))
+
+
+async def _on_app_startup(app: web.Application):
+    await _on_startup(dispatcher)
+
+
+async def _on_app_shutdown(app: web.Application):
+    await _on_shutdown(dispatcher)
+    await bot.session.close()
+
+
+async def _on_startup(dp: Dispatcher):
+    started_at = time.perf_counter()
+    dp.middleware.setup(MetricsMiddleware())
+
+    if config.BOTLYTICS_API_KEY:
+        analytics_client = BotlyticsClient(api_key=config.BOTLYTICS_API_KEY)
+        analytics_pipeline = BotlyticsPipeline(
+            client=analytics_client,
+            max_size=config.BOTLYTICS_QUEUE_SIZE,
+            batch_size=config.BOTLYTICS_BATCH_SIZE,
+            flush_interval=config.BOTLYTICS_FLUSH_INTERVAL,
+            max_concurrency=config.BOTLYTICS_MAX_CONCURRENCY,
+        )
+        analytics_pipeline.start()
+        dp['analytic_client'] = analytics_client
+        dp['analytic_pipeline'] = analytics_pipeline
+        # events are aggregated per conversation and rolled up, instead of being sent per message:
+        conversation_analytics.start(analytics_pipeline)
+
+    if config.STORAGE != 'memory':
+        await init_db()
+        install_query_hook(type(Tortoise.get_connection('anon_talks')))
+        # connections are warmed up along with the state, needed by the first updates:
+        await asyncio.gather(
+            warm_up_db(connections_count=config.DB_POOL_MIN_SIZE),
+            broker_client.connect() if broker_client else default_storage.load(),
+        )
+
+    # in multi-worker mode, the archiver and the reaper are run by the supervisor:
+    if not config.BROKER_SOCK_NAME:
+        if config.STORAGE != 'memory':
+            archiver = make_archiver()
+            archiver.start()
+            dp['archiver'] = archiver
+        reaper = _make_reaper()
+        reaper.start()
+        dp['reaper'] = reaper
+    logging.info(f'Startup took {time.perf_counter() - started_at:.3f} s.')
+
+
+async def _on_shutdown(dp: Dispatcher):
+    logging.warning('Shutting down...')
+    if 'archiver' in dp:
+        await dp['archiver'].close()
+    if 'reaper' in dp:
+        await dp['reaper'].close()
+    await media_groups.close()
+    await sender.close()
+    # transitions of the write-behind storage are flushed to the database before it's closed:
+    await default_storage.close()
+    await Tortoise.close_connections()
+    logging.info("Tortoise-ORM shutdown.")
+
+    if 'analytic_client' in dp:
+        await conversation_analytics.close()
+        pipeline = dp['analytic_pipeline']
+        await pipeline.close()
+        logging.info(f"Analytics pipeline closed: {pipeline.sent_count} sent, "
+                     f"{pipeline.failed_count} failed, {pipeline.dropped_count} dropped.")
+        await dp['analytic_client'].close_session()
+
+    if broker_client:
+        await broker_client.close()
+
+
+async def _supervise_workers(workers_count: int):
+    await init_db()
+    archiver = make_archiver()
+    archiver.start()
+
+    broker_sock_name = 'broker.sock'
+    broker = StateBroker(matchmaker=matchmaker)
+    await broker.start(path=str(config.ROOT_PATH / 'socks' / broker_sock_name))
+
+    async def notify_workers(*user_ids):
+        await broker.publish('users_changed', user_ids)
+
+    reaper = _make_reaper(on_users_changed=notify_workers)
+    reaper.start()
+    logging.info(f"Nginx upstream of the workers:\n{get_nginx_upstream(workers_count)}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    # every process sends messages by its own sender, so each one gets an equal share of the global limit:
+    global_rate = config.TELEGRAM_GLOBAL_RATE / (workers_count + 1)
+    sender.set_global_rate(global_rate)
+    worker_env = {**os.environ, 'BROKER_SOCK_NAME': broker_sock_name, 'TELEGRAM_GLOBAL_RATE': str(global_rate)}
+    workers = [
+        asyncio.create_task(_run_worker(socket_name, env=worker_env))
+        for socket_name in get_worker_socket_names(workers_count)
+    ]
+    await stop_event.wait()
+
+    logging.warning('Stopping workers...')
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await reaper.close()
+    await sender.close()
+    await bot.session.close()
+    await broker.close()
+    await archiver.close()
+
+
+async def _run_worker(socket_name: str, env: dict):
+    while True:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, str(config.ROOT_PATH / 'main.py'), 'run', '--sock_name', socket_name, env=env,
+        )
+        try:
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            await process.wait()
+            raise
+
+        logging.warning(f'Worker {socket_name} exited with code {return_code}, restarting...')
+        await asyncio.sleep(config.WORKER_RESTART_DELAY)
+
+
+def _make_reaper(**kwargs) -> WaitingReaper:
+    return WaitingReaper(
+        sender=sender,
+        search_timeout=timedelta(minutes=config.SEARCH_TIMEOUT),
+        batch_size=config.REAPER_BATCH_SIZE,
+        interval=config.REAPER_INTERVAL,
+        **kwargs,
+    )
+
+
+async def _poll():
+    Dispatcher.set_current(dispatcher)
+    await bot.delete_webhook()
+    await _on_startup(dispatcher)
+
+    poller = UpdatePoller(
+        dispatcher=dispatcher,
+        sender=sender,
+        offset_store=OffsetStore(config.POLLING_STATE_PATH),
+        batch_size=config.POLLING_BATCH_SIZE,
+        poll_timeout=config.POLLING_TIMEOUT,
+        max_workers=config.POLLING_WORKERS,
+    )
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, poller.stop)
+
+    logging.info('Polling of updates started.')
+    try:
+        await poller.run()
+    finally:
+        await _on_shutdown(dispatcher)
+        await bot.session.close()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from pypika.queries import Query, Table
+from tortoise import run_async
+from tortoise.transactions import in_transaction
+
+from anon_talks import config
+from anon_talks.db import init_db
+from anon_talks.models import ArchivedConversation, Conversation
+
+
+class ConversationArchiver:
+    """
+    Background task, moving conversations finished long ago from the hot table to the archive one.
+
+    Conversations are moved in batches of at most `batch_size`, each batch in its own short transaction.
+    To not compete with live traffic, the archiver pauses after every batch for at least `batch_delay` seconds,
+    and longer if the batch was slow, so it spends at most `duty_cycle` share of time in the DB.
+    A run over all the old conversations is repeated every `interval` seconds.
+    """
+
+    def __init__(self, archive_after: timedelta, batch_size=500, batch_delay=1.0, duty_cycle=0.1, interval=600.0):
+        self._archive_after = archive_after
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._duty_cycle = duty_cycle
+        self._interval = interval
+
+        self._task: Optional[asyncio.Task] = None
+        self.archived_count = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._archive_forever())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def archive_all(self) -> int:
+        """
+        Move all the conversations finished before the archive age, return their count.
+        """
+        finished_before = datetime.now() - self._archive_after
+        total_count = 0
+        while True:
+            started_at = time.monotonic()
+            count = await self.archive_batch(finished_before)
+            total_count += count
+            if count < self._batch_size:
+                return total_count
+
+            elapsed = time.monotonic() - started_at
+            await asyncio.sleep(max(self._batch_delay, elapsed * (1 - self._duty_cycle) / self._duty_cycle))
+
+    async def archive_batch(self, finished_before: datetime) -> int:
+        ids = await (Conversation
+                     .filter(finished_at__lt=finished_before)
+                     .order_by('id')
+                     .limit(self._batch_size)
+                     .values_list('id', flat=True))
+        if not ids:
+            return 0
+
+        async with in_transaction('anon_talks') as connection:
+            await connection.execute_query(self._get_copy_sql(ids))
+            await Conversation.filter(id__in=ids).using_db(connection).delete()
+
+        self.archived_count += len(ids)
+        return len(ids)
+
+    @staticmethod
+    def _get_copy_sql(ids: List[int]) -> str:
+        conversation_table = Table(Conversation._meta.db_table)
+        archive_table = Table(ArchivedConversation._meta.db_table)
+        columns = ('id', 'initiator_id', 'opponent_id', 'tags', 'created_at', 'modified_at', 'finished_at')
+        return (Query
+                .into(archive_table)
+                .columns(*columns)
+                .from_(conversation_table)
+                .select(*columns)
+                .where(conversation_table.id.isin(ids))
+                .get_sql())
+
+    async def _archive_forever(self):
+        while True:
+            try:
+                count = await self.archive_all()
+            except Exception:
+                logging.exception('Archiving of conversations failed.')
+            else:
+                if count:
+                    logging.info(f'{count} conversations are archived.')
+            await asyncio.sleep(self._interval)
+
+
+def make_archiver() -> ConversationArchiver:
+    return ConversationArchiver(
+        archive_after=timedelta(minutes=config.ARCHIVE_AFTER),
+        batch_size=config.ARCHIVE_BATCH_SIZE,
+        batch_delay=config.ARCHIVE_BATCH_DELAY,
+        duty_cycle=config.ARCHIVE_DUTY_CYCLE,
+        interval=config.ARCHIVE_INTERVAL,
+    )
+
+
+def archive_conversations():
+    run_async(_archive())
+
+
+async def _archive():
+    await init_db()
+    count = await make_archiver().archive_all()
+    logging.info(f"{count} conversations are archived.")
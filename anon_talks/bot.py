@@ -1,71 +1,173 @@
 import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
 
-from aiogram.types import Message
+from aiogram.types import ContentType, Message, Update
 from aiogram.bot import Bot
 from aiogram.dispatcher import Dispatcher
 from aiogram.dispatcher.middlewares import BaseMiddleware
-from aiogram.dispatcher.webhook import SendMessage
 
-from anon_talks import config
-from anon_talks.integrations.botlytics import BotlyticsClient
-from anon_talks.models import TelegramUser
+from anon_talks import config, metrics
+from anon_talks.instrumentation import start_tracking_queries, stop_tracking_queries
+from anon_talks.sender import MessageSender
 from anon_talks.services import BotService
+from anon_talks.storage import default_storage
+
+
+class MeasuredBot(Bot):
+    """
+    Bot, measuring the duration of Telegram API calls.
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        with metrics.TELEGRAM_API_DURATION.time(method=method):
+            return await super().request(method, data, files, **kwargs)
+
+
+class _QueuedUpdate:
+    __slots__ = ('turn', 'queued_at')
+
+    def __init__(self, turn: asyncio.Future, queued_at: float):
+        self.turn = turn
+        self.queued_at = queued_at
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """
+    Dispatcher, processing updates of a chat one by one, in the order they've come,
+    while updates of different chats are processed concurrently.
+
+    An update waits for its turn in the queue of its chat. The queue is dropped as soon as it's empty,
+    so only chats with updates in progress are kept.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the first update of a queue is the one being processed:
+        self.chat_queues: Dict[int, Deque[_QueuedUpdate]] = {}
+
+    async def process_update(self, update: Update):
+        chat_id = get_chat_id(update)
+        if chat_id is None:
+            return await super().process_update(update)
+
+        queued_update = _QueuedUpdate(turn=asyncio.get_running_loop().create_future(), queued_at=time.monotonic())
+        queue = self.chat_queues.get(chat_id)
+        if queue is None:
+            queue = self.chat_queues[chat_id] = deque()
+            queued_update.turn.set_result(None)
+        queue.append(queued_update)
+
+        try:
+            await queued_update.turn
+        except asyncio.CancelledError:
+            if not queued_update.turn.cancelled():
+                # the turn has come, while the update was being cancelled:
+                self._pass_turn(chat_id, queue)
+            elif queued_update in queue:
+                queue.remove(queued_update)
+            raise
+
+        metrics.UPDATE_QUEUE_WAIT.observe(time.monotonic() - queued_update.queued_at)
+        try:
+            return await super().process_update(update)
+        finally:
+            self._pass_turn(chat_id, queue)
+
+    def _pass_turn(self, chat_id: int, queue: Deque[_QueuedUpdate]):
+        queue.popleft()
+        # updates, cancelled while waiting, are skipped:
+        while queue and queue[0].turn.cancelled():
+            queue.popleft()
+        if queue:
+            queue[0].turn.set_result(None)
+        else:
+            del self.chat_queues[chat_id]
+
+    def get_queue_depth(self) -> int:
+        return sum(len(queue) - 1 for queue in self.chat_queues.values())
+
+    def get_max_queue_depth(self) -> int:
+        return max((len(queue) - 1 for queue in self.chat_queues.values()), default=0)
+
+    def get_queue_lag(self) -> float:
+        """
+        Return how many seconds the oldest waiting update has waited for its turn.
+        """
+        queued_at = min((queue[1].queued_at for queue in self.chat_queues.values() if len(queue) > 1), default=None)
+        return time.monotonic() - queued_at if queued_at is not None else 0
+
+
+def get_chat_id(update: Update) -> Optional[int]:
+    message = update.message or update.edited_message
+    return message.chat.id if message else None
+
 
+bot = MeasuredBot(token=config.BOT_API_TOKEN)  # Initialize bot and dispatcher
+dispatcher = ChatOrderedDispatcher(bot)
+sender = MessageSender(
+    bot,
+    global_rate=config.TELEGRAM_GLOBAL_RATE,
+    chat_rate=config.TELEGRAM_CHAT_RATE,
+    chat_burst=config.TELEGRAM_CHAT_BURST,
+)
 
-bot = Bot(token=config.BOT_API_TOKEN)  # Initialize bot and dispatcher
-dispatcher = Dispatcher(bot)
+metrics.CHAT_QUEUES.set_function(lambda: len(dispatcher.chat_queues))
+metrics.CHAT_QUEUE_DEPTH.set_function(dispatcher.get_queue_depth)
+metrics.CHAT_QUEUE_MAX_DEPTH.set_function(dispatcher.get_max_queue_depth)
+metrics.CHAT_QUEUE_LAG.set_function(dispatcher.get_queue_lag)
 
 
 @dispatcher.message_handler(commands=['start'])
 async def register_user(message: Message):
-    await BotService(bot).register_user(user_id=message.from_user.id, chat_id=message.chat.id)
+    return await BotService(sender).register_user(user_id=message.from_user.id, chat_id=message.chat.id)
 
 
 @dispatcher.message_handler(commands=['help'])
 async def display_help(message: Message):
-    return SendMessage(message.chat.id, BotService.HELP_TEXT)
+    return BotService.HELP_REPLY.to(message.chat.id)
 
 
-@dispatcher.message_handler()
+@dispatcher.message_handler(commands=['tags'])
+async def set_tags(message: Message):
+    return await BotService(sender).set_tags(
+        user_id=message.from_user.id, chat_id=message.chat.id, text=message.get_args() or '',
+    )
+
+
+@dispatcher.message_handler(content_types=ContentType.ANY)
 async def handle_custom_message(message: Message):
-    await BotService(bot).handle_message(message)
+    return await BotService(sender).handle_message(message)
 
 
-class AnalyticsMiddleware(BaseMiddleware):
-    ANON_USER_ID = 'anon_user'
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Measure the duration of processing of incoming messages and SQL statements, executed for them.
 
-    def __init__(self, analytic_client: BotlyticsClient):
-        super().__init__()
-        self.analytic_client = analytic_client
+    Measurements are labeled by the branch of handlers: a command or a status of the user.
+    """
+    COMMANDS = ('start', 'help', 'tags')
+    NOT_REGISTERED_BRANCH = 'not_registered'
 
-    async def on_process_message(self, message: Message, __):
-        # create a task for analytic logging to not block next message processing:
-        asyncio.create_task(self.log_to_analytic(message=message))
+    async def on_pre_process_message(self, message: Message, data: dict):
+        data['metrics_started_at'] = time.perf_counter()
+        data['metrics_query_stats'] = start_tracking_queries()
+        data['metrics_branch'] = await self.get_branch(message)
 
-    async def log_to_analytic(self, message: Message):
-        tg_user = await TelegramUser.filter(tg_id=message.from_user.id).first()
-        sender_id = f'user_{tg_user.pk}' if tg_user else self.ANON_USER_ID
-        text = self.private_text(message.text)
-        await self.analytic_client.send_message(
-            text=text, kind=BotlyticsClient.KIND_INCOMING, sender_id=sender_id,
-        )
+    async def on_post_process_message(self, message: Message, results, data: dict):
+        stop_tracking_queries()
+        branch, query_stats = data['metrics_branch'], data['metrics_query_stats']
+        metrics.UPDATE_DURATION.observe(time.perf_counter() - data['metrics_started_at'], branch=branch)
+        metrics.UPDATE_QUERIES.observe(query_stats.count, branch=branch)
+        metrics.UPDATE_QUERIES_DURATION.observe(query_stats.duration, branch=branch)
 
-    @staticmethod
-    def private_text(text: str):
-        """
-        Check if user text is bot command or button click. If it's not, returns stub text.
+    async def get_branch(self, message: Message) -> str:
+        command = message.get_command(pure=True)
+        if command in self.COMMANDS:
+            return command
+
+        # the handler looks the user up right after, so the lookup just warms the cache up for it:
+        tg_user = await default_storage.get_user(tg_id=message.from_user.id)
+        return tg_user.status.value if tg_user else self.NOT_REGISTERED_BRANCH
 
-        The method is used to prevent exposing of user sensitive data, when sending it to third-party service.
-        """
-        bot_keywords = (
-            '/start',
-            '/help',
-            BotService.START_CONVERSATION_BTN,
-            BotService.CANCEL_WAITING_OPPONENT_BTN,
-            BotService.COMPLETE_CONVERSATION_BTN,
-        )
-
-        if text.strip() in bot_keywords:
-            return text
-
-        return '<private message>'
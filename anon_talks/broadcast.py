@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import os
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+
+import ujson
+from aiogram import Bot
+from aiogram.utils.exceptions import BotBlocked, CantInitiateConversation, ChatNotFound, UserDeactivated
+from tortoise import run_async
+
+from anon_talks import config
+from anon_talks.db import init_db
+from anon_talks.models import TelegramUser
+from anon_talks.sender import MessageSender
+
+
+class BroadcastProgress:
+    __slots__ = ('digest', 'last_user_id', 'sent_count', 'blocked_count', 'failed_count')
+
+    def __init__(self, digest: str, last_user_id=0, sent_count=0, blocked_count=0, failed_count=0):
+        self.digest = digest  # of the message, so progress of another message isn't resumed
+        self.last_user_id = last_user_id
+        self.sent_count = sent_count
+        self.blocked_count = blocked_count
+        self.failed_count = failed_count
+
+    def __str__(self):
+        return f'{self.sent_count} sent, {self.blocked_count} blocked, {self.failed_count} failed'
+
+
+class BroadcastCheckpoint:
+    """
+    Persistent progress of a broadcast, saved to a JSON file by atomic replacement, like the state of polling.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def load(self, digest: str) -> BroadcastProgress:
+        try:
+            with open(self._path) as state_file:
+                state = ujson.load(state_file)
+        except FileNotFoundError:
+            return BroadcastProgress(digest)
+        if state['digest'] != digest:
+            logging.warning('Progress of another broadcast is found, it is discarded.')
+            return BroadcastProgress(digest)
+        return BroadcastProgress(**state)
+
+    def save(self, progress: BroadcastProgress):
+        temp_path = f'{self._path}.tmp'
+        with open(temp_path, 'w') as state_file:
+            ujson.dump({name: getattr(progress, name) for name in BroadcastProgress.__slots__}, state_file)
+        os.replace(temp_path, self._path)
+
+    def clear(self):
+        with suppress(FileNotFoundError):
+            self._path.unlink()
+
+
+class Broadcaster:
+    """
+    Sender of a message to all the users, except those who have blocked the bot.
+
+    Chats are read from the DB in chunks of `chunk_size`, by keyset pagination over the primary key,
+    so the memory used doesn't depend on the number of users. Messages of a chunk are sent concurrently
+    through the rate-limited sender. The progress is checkpointed after every chunk,
+    so an interrupted broadcast of the same message is resumed from the next chunk.
+    Chats, which blocked the bot or are gone, are marked and skipped by later broadcasts.
+    """
+    UNREACHABLE_ERRORS = (BotBlocked, CantInitiateConversation, ChatNotFound, UserDeactivated)
+
+    def __init__(self, sender: MessageSender, checkpoint: BroadcastCheckpoint, chunk_size=1000):
+        self._sender = sender
+        self._checkpoint = checkpoint
+        self._chunk_size = chunk_size
+
+    async def run(self, text: str, parse_mode: Optional[str] = None) -> BroadcastProgress:
+        digest = hashlib.sha256(f'{parse_mode}:{text}'.encode()).hexdigest()
+        progress = self._checkpoint.load(digest)
+        if progress.last_user_id:
+            logging.info(f'The broadcast is resumed after user {progress.last_user_id}: {progress}.')
+
+        while True:
+            chats = await (TelegramUser
+                           .filter(id__gt=progress.last_user_id, blocked_at__isnull=True)
+                           .order_by('id')
+                           .limit(self._chunk_size)
+                           .values_list('id', 'tg_chat_id'))
+            if not chats:
+                break
+
+            await self._send_chunk(chats, text, parse_mode, progress)
+            progress.last_user_id = chats[-1][0]
+            self._checkpoint.save(progress)
+            logging.info(f'Broadcast to users up to {progress.last_user_id}: {progress}.')
+            if len(chats) < self._chunk_size:
+                break
+
+        self._checkpoint.clear()
+        return progress
+
+    async def _send_chunk(self, chats, text: str, parse_mode: Optional[str], progress: BroadcastProgress):
+        results = await asyncio.gather(*(
+            self._sender.send_message(chat_id, text, parse_mode=parse_mode) for __, chat_id in chats
+        ), return_exceptions=True)
+
+        blocked_ids = []
+        for (user_id, chat_id), result in zip(chats, results):
+            if isinstance(result, self.UNREACHABLE_ERRORS):
+                blocked_ids.append(user_id)
+            elif isinstance(result, Exception):
+                progress.failed_count += 1
+                logging.warning(f'Failed to broadcast to chat {chat_id}: {result!r}')
+            else:
+                progress.sent_count += 1
+
+        if blocked_ids:
+            await TelegramUser.mark_blocked(*blocked_ids)
+            progress.blocked_count += len(blocked_ids)
+
+
+def broadcast(text: str, parse_mode: Optional[str] = None):
+    run_async(_broadcast(text, parse_mode))
+
+
+async def _broadcast(text: str, parse_mode: Optional[str]):
+    await init_db()
+    bot = Bot(token=config.BOT_API_TOKEN)
+    # the broadcast shares the global rate limit of the bot with the workers, so it takes only a part of it:
+    sender = MessageSender(
+        bot,
+        global_rate=config.BROADCAST_RATE,
+        chat_rate=config.TELEGRAM_CHAT_RATE,
+        chat_burst=config.TELEGRAM_CHAT_BURST,
+    )
+    broadcaster = Broadcaster(
+        sender,
+        checkpoint=BroadcastCheckpoint(config.BROADCAST_STATE_PATH),
+        chunk_size=config.BROADCAST_CHUNK_SIZE,
+    )
+    try:
+        progress = await broadcaster.run(text, parse_mode)
+    finally:
+        await sender.close()
+        await bot.session.close()
+    logging.info(f'The broadcast is finished: {progress}.')
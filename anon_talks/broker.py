@@ -0,0 +1,207 @@
+import asyncio
+import itertools
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Sequence, Set
+
+import ujson
+
+from anon_talks.locks import LazyLock
+from anon_talks.matchmaking import Matchmaker
+
+
+class BrokerError(Exception):
+    pass
+
+
+class StateBroker:
+    """
+    Server, sharing the matchmaking state between worker processes over a unix socket.
+
+    Workers call methods of the matchmaker, hosted by the broker, and publish events,
+    which are delivered to all the other workers. Messages are JSON lines:
+    ``{"id": 1, "method": "pop_match", "args": [42]}`` is answered by ``{"id": 1, "result": 7}``,
+    ``{"event": "users_changed", "data": [42, 43]}`` is forwarded as is.
+    Calls are handled concurrently, as a match may be a search, reserved by another call of the same worker.
+    Searches, reserved by a worker, which is disconnected before creating them, are cancelled.
+    """
+    METHODS = ('pop_match', 'enqueue', 'cancel_reservation', 'discard', 'remember_opponents')
+
+    def __init__(self, matchmaker: Matchmaker):
+        self._matchmaker = matchmaker
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._server = None
+
+    async def start(self, path: str):
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=path)
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+
+    async def publish(self, event: str, data):
+        """
+        Deliver the event to all the workers.
+        """
+        self._broadcast(ujson.dumps({'event': event, 'data': data}).encode() + b'\n', sender=None)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        reserved_user_ids: Set[int] = set()  # of searches, reserved by the worker and not created yet
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                message = ujson.loads(line)
+                if 'event' in message:
+                    self._broadcast(line, sender=writer)
+                else:
+                    asyncio.ensure_future(self._respond(writer, message, reserved_user_ids))
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+            for user_id in list(reserved_user_ids):
+                await self._matchmaker.cancel_reservation(user_id)
+
+    async def _respond(self, writer: asyncio.StreamWriter, request: dict, reserved_user_ids: Set[int]):
+        response = await self._call(request)
+        method, args = request['method'], request['args']
+        if 'result' in response:
+            if method == 'pop_match' and args[2:] == [True] and response['result'] is None:
+                reserved_user_ids.add(args[0])
+            elif method == 'enqueue':
+                reserved_user_ids.discard(args[1])
+            elif method == 'cancel_reservation':
+                reserved_user_ids.discard(args[0])
+        if not writer.is_closing():
+            writer.write(ujson.dumps(response).encode() + b'\n')
+
+    async def _call(self, request: dict) -> dict:
+        method, args = request['method'], request['args']
+        if method not in self.METHODS:
+            return {'id': request['id'], 'error': f'Unknown method "{method}"'}
+
+        if method == 'remember_opponents':
+            args[2] = datetime.fromisoformat(args[2])
+
+        try:
+            result = await getattr(self._matchmaker, method)(*args)
+        except Exception as e:
+            logging.exception('Broker call %s failed.', method)
+            return {'id': request['id'], 'error': str(e)}
+
+        return {'id': request['id'], 'result': result}
+
+    def _broadcast(self, line: bytes, sender: Optional[asyncio.StreamWriter]):
+        for writer in self._writers:
+            if writer is not sender:
+                writer.write(line)
+
+
+class BrokerClient:
+    """
+    Connection of a worker to the `StateBroker`.
+
+    It's established on first use and re-established after the broker is restarted.
+    Events of other workers are passed to `on_event` callback.
+    """
+
+    def __init__(self, path: str, on_event: Callable[[str, Any], None]):
+        self._path = path
+        self._on_event = on_event
+        self._request_ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._connect_lock = LazyLock()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        await self._ensure_connected()
+
+    async def call(self, method: str, *args):
+        await self._ensure_connected()
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._send({'id': request_id, 'method': method, 'args': args})
+        return await future
+
+    async def publish(self, event: str, data):
+        await self._ensure_connected()
+        self._send({'event': event, 'data': data})
+
+    async def close(self):
+        if self._read_task:
+            self._read_task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = self._read_task = None
+
+    def _send(self, message: dict):
+        self._writer.write(ujson.dumps(message).encode() + b'\n')
+
+    async def _ensure_connected(self):
+        if self._writer:
+            return
+
+        async with self._connect_lock:
+            if not self._writer:
+                self._reader, self._writer = await asyncio.open_unix_connection(self._path)
+                self._read_task = asyncio.create_task(self._read_messages(self._reader))
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        try:
+            async for line in reader:
+                message = ujson.loads(line)
+                if 'event' in message:
+                    self._on_event(message['event'], message['data'])
+                    continue
+
+                future = self._pending.pop(message['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(BrokerError(message['error']))
+                else:
+                    future.set_result(message['result'])
+        finally:
+            self._reader = self._writer = self._read_task = None
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(BrokerError('Connection to the broker is lost'))
+
+
+class RemoteMatchmaker:
+    """
+    Matchmaker, hosted by the `StateBroker` of the supervisor process, with the same interface as `Matchmaker`.
+    """
+    is_loaded = True
+
+    def __init__(self, client: BrokerClient):
+        self._client = client
+
+    async def pop_match(self, user_id: int, tags: Sequence[str] = (), reserve=False) -> Optional[int]:
+        return await self._client.call('pop_match', user_id, list(tags), reserve)
+
+    async def enqueue(self, conversation_id: int, user_id: int, tags: Sequence[str] = ()):
+        await self._client.call('enqueue', conversation_id, user_id, list(tags))
+
+    async def cancel_reservation(self, user_id: int):
+        await self._client.call('cancel_reservation', user_id)
+
+    async def discard(self, conversation_id: int):
+        await self._client.call('discard', conversation_id)
+
+    async def remember_opponents(self, user_id: int, opponent_id: int, finished_at: datetime):
+        await self._client.call('remember_opponents', user_id, opponent_id, finished_at.isoformat())
+
+    def reset(self):
+        pass  # the state is owned by the broker
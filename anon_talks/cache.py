@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class UserCache:
+    """
+    LRU cache of telegram users, keyed by telegram user id.
+
+    Entries expire after `ttl` seconds. Status changes are written through by `set_status`,
+    so the cached users are consistent with the database.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: 'OrderedDict[int, Tuple[Any, float]]' = OrderedDict()
+        self._tg_ids: Dict[int, int] = {}  # user pk -> telegram user id
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tg_id: int) -> Optional[Any]:
+        entry = self._entries.get(tg_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        user, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(tg_id)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(tg_id)
+        self.hits += 1
+        return user
+
+    def put(self, user):
+        self._entries[user.tg_id] = (user, time.monotonic() + self._ttl)
+        self._entries.move_to_end(user.tg_id)
+        self._tg_ids[user.pk] = user.tg_id
+        while len(self._entries) > self._max_size:
+            tg_id, (stale_user, __) = self._entries.popitem(last=False)
+            self._tg_ids.pop(stale_user.pk, None)
+
+    def set_status(self, user_id: int, status):
+        tg_id = self._tg_ids.get(user_id)
+        if tg_id is not None:
+            user, __ = self._entries[tg_id]
+            user.status = status
+
+    def invalidate(self, user_id: int):
+        tg_id = self._tg_ids.get(user_id)
+        if tg_id is not None:
+            self._remove(tg_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._tg_ids.clear()
+        self.hits = self.misses = 0
+
+    def _remove(self, tg_id: int):
+        user, __ = self._entries.pop(tg_id)
+        self._tg_ids.pop(user.pk, None)
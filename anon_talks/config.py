@@ -12,6 +12,25 @@ load_dotenv(dotenv_path=(ROOT_PATH / 'envs' / 'bot' / '.env'))
 # Database
 # ------------------------------------------------------------------------------
 DATABASE_URL = os.getenv('DATABASE_URL')
+# "database", "write_behind" to keep the state of a single process in memory and write it to the database
+# behind the updates, through a journal on the local disk, or "memory" to run without a database,
+# losing the state on restart:
+STORAGE = os.getenv('STORAGE', 'database')
+JOURNAL_PATH = Path(os.getenv('JOURNAL_PATH', ROOT_PATH / 'journal'))  # a directory
+JOURNAL_SEGMENT_SIZE = int(os.getenv('JOURNAL_SEGMENT_SIZE', 1024 * 1024))  # in bytes
+JOURNAL_FLUSH_INTERVAL = float(os.getenv('JOURNAL_FLUSH_INTERVAL', 1))  # in seconds
+JOURNAL_FLUSH_BATCH_SIZE = int(os.getenv('JOURNAL_FLUSH_BATCH_SIZE', 1000))  # transitions per transaction
+# users, kept in memory by the write-behind storage, besides the ones in searches and conversations:
+WRITE_BEHIND_MAX_USERS = int(os.getenv('WRITE_BEHIND_MAX_USERS', 100000))
+
+# the connection pool of asyncpg, https://magicstack.github.io/asyncpg/current/api/index.html#connection-pools
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_MAX_QUERIES = int(os.getenv('DB_POOL_MAX_QUERIES', 50000))  # before a connection is replaced
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_POOL_MAX_INACTIVE_LIFETIME', 300))  # in seconds
+DB_CONNECT_TIMEOUT = float(os.getenv('DB_CONNECT_TIMEOUT', 10))  # in seconds
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', 10))  # in seconds
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 100))  # prepared statements per connection
 
 # Telegram Bot
 # ------------------------------------------------------------------------------
@@ -20,11 +39,69 @@ BOT_API_TOKEN = os.getenv('BOT_API_TOKEN')
 WEBAPP_HOST = os.getenv('WEBAPP_HOST', 'localhost')
 WEBAPP_PORT = os.getenv('WEBAPP_PORT', 3001)
 
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # messages per second
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))  # messages per second
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))  # messages
+
+# Long polling mode
+# ------------------------------------------------------------------------------
+POLLING_BATCH_SIZE = int(os.getenv('POLLING_BATCH_SIZE', 100))  # updates per getUpdates call, at most 100
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 20))  # in seconds
+POLLING_WORKERS = int(os.getenv('POLLING_WORKERS', 16))  # updates processed concurrently
+POLLING_STATE_PATH = Path(os.getenv('POLLING_STATE_PATH', ROOT_PATH / 'polling_state.json'))
+
+# Relay of messages
+# ------------------------------------------------------------------------------
+# messages of an album come in separate updates, so they're collected for this time to be relayed together:
+MEDIA_GROUP_DELAY = float(os.getenv('MEDIA_GROUP_DELAY', 0.5))  # in seconds
+
+# Broadcasts
+# ------------------------------------------------------------------------------
+# a part of the global rate limit, the rest is left for the bot, running at the same time:
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 20))  # messages per second
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', 1000))  # chats read from the DB at once
+BROADCAST_STATE_PATH = Path(os.getenv('BROADCAST_STATE_PATH', ROOT_PATH / 'broadcast_state.json'))
+
+# Multi-worker mode
+# ------------------------------------------------------------------------------
+# set by the supervisor for its workers, to share the matchmaking state through the broker:
+BROKER_SOCK_NAME = os.getenv('BROKER_SOCK_NAME', '')
+WORKER_RESTART_DELAY = 1  # in seconds
+
 # Bot analytics
 # https://botlytics.api-docs.io/v1/
 # ------------------------------------------------------------------------------
 BOTLYTICS_API_KEY = os.getenv('BOTLYTICS_API_KEY', '')
+BOTLYTICS_QUEUE_SIZE = int(os.getenv('BOTLYTICS_QUEUE_SIZE', 10000))
+BOTLYTICS_BATCH_SIZE = int(os.getenv('BOTLYTICS_BATCH_SIZE', 100))
+BOTLYTICS_FLUSH_INTERVAL = float(os.getenv('BOTLYTICS_FLUSH_INTERVAL', 1))  # in seconds
+BOTLYTICS_MAX_CONCURRENCY = int(os.getenv('BOTLYTICS_MAX_CONCURRENCY', 10))
+# a summary is sent per conversation, and counts of searches and matches are sent once in the interval:
+ANALYTICS_ROLLUP_INTERVAL = float(os.getenv('ANALYTICS_ROLLUP_INTERVAL', 300))  # in seconds
+# counters of conversations, finished by another worker, are dropped after this time without messages:
+ANALYTICS_FORGET_AFTER = int(os.getenv('ANALYTICS_FORGET_AFTER', 24 * 60))  # in minutes
 
 # Custom settings
 # ------------------------------------------------------------------------------
 RECENT_OPPONENT_TIMEOUT = 5  # in minutes
+
+# searches are paired by shared tags first, a search waiting longer is paired with anyone:
+MAX_TAGS = 5  # per user, the tags are stored in a column of 255 characters
+TAG_MAX_LENGTH = 32
+TAG_WIDEN_AFTER = float(os.getenv('TAG_WIDEN_AFTER', 30))  # in seconds
+
+# searches of an opponent, lasting longer, are stopped:
+SEARCH_TIMEOUT = int(os.getenv('SEARCH_TIMEOUT', 10))  # in minutes
+REAPER_BATCH_SIZE = int(os.getenv('REAPER_BATCH_SIZE', 500))
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', 60))  # in seconds
+
+# conversations, finished longer ago, are moved to the archive table:
+ARCHIVE_AFTER = max(int(os.getenv('ARCHIVE_AFTER', 60)), RECENT_OPPONENT_TIMEOUT)  # in minutes
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_BATCH_DELAY = float(os.getenv('ARCHIVE_BATCH_DELAY', 1))  # in seconds
+ARCHIVE_DUTY_CYCLE = float(os.getenv('ARCHIVE_DUTY_CYCLE', 0.1))  # max share of time spent on archiving
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 600))  # in seconds
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))  # in seconds
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+from tortoise import run_async, Tortoise
+from tortoise.backends.base.config_generator import generate_config
+
+from anon_talks import config
+from anon_talks.models import ArchivedConversation, Conversation, TelegramUser, prepare_queries
+
+
+# columns, added to the models after their tables were released, with constraints of `ALTER TABLE ... ADD COLUMN`:
+ADDED_COLUMNS = (
+    (TelegramUser, 'tags', "NOT NULL DEFAULT ''"),
+    (Conversation, 'tags', "NOT NULL DEFAULT ''"),
+    (TelegramUser, 'blocked_at', ''),
+    (ArchivedConversation, 'tags', "NOT NULL DEFAULT ''"),
+)
+
+
+def sync_db():
+    run_async(sync_schemas())
+
+
+async def init_db(db_url=None):
+    db_config = generate_config(
+        db_url=db_url or config.DATABASE_URL,
+        app_modules={'anon_talks': ['anon_talks.models']},
+        connection_label='anon_talks',
+    )
+    connection_config = db_config['connections']['anon_talks']
+    if connection_config['engine'] == 'tortoise.backends.asyncpg':
+        connection_config['credentials'].update(
+            minsize=config.DB_POOL_MIN_SIZE,
+            maxsize=config.DB_POOL_MAX_SIZE,
+            max_queries=config.DB_POOL_MAX_QUERIES,
+            max_inactive_connection_lifetime=config.DB_POOL_MAX_INACTIVE_LIFETIME,
+            timeout=config.DB_CONNECT_TIMEOUT,
+            command_timeout=config.DB_COMMAND_TIMEOUT,
+            statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+        )
+    await Tortoise.init(config=db_config)
+    prepare_queries()
+    logging.info("Tortoise-ORM started.")
+
+
+async def warm_up_db(connections_count: int):
+    """
+    Open connections of the pool and prepare the hot statements on them, concurrently.
+    """
+    await asyncio.gather(*(_warm_up_connection() for __ in range(connections_count)))
+
+
+async def _warm_up_connection():
+    await TelegramUser._meta.db.execute_query(TelegramUser.GET_BY_TG_ID_SQL, [0])
+    await Conversation.find_route(0)
+
+
+async def sync_schemas(db_url=None):
+    await init_db(db_url)
+    await generate_schemas()
+    logging.info("Model schemas are generated.")
+
+
+async def generate_schemas():
+    """
+    Create the tables, columns and indexes, which don't exist yet, so it's safe to run on an existing database.
+    """
+    await Tortoise.generate_schemas(safe=True)  # CREATE TABLE and CREATE INDEX are IF NOT EXISTS
+    await _add_columns()
+    await Tortoise.get_connection('anon_talks').execute_script('\n'.join(Conversation.PARTIAL_INDEXES_SQL))
+
+
+async def _add_columns():
+    connection = Tortoise.get_connection('anon_talks')
+    dialect = connection.capabilities.dialect
+    for model, field_name, constraints in ADDED_COLUMNS:
+        table = model._meta.db_table
+        column = model._meta.fields_db_projection[field_name]
+        sql_type = model._meta.fields_map[field_name].get_for_dialect(dialect, 'SQL_TYPE')
+        definition = f'"{column}" {sql_type} {constraints}'.rstrip()
+        if dialect == 'sqlite':  # it has no ADD COLUMN IF NOT EXISTS
+            __, rows = await connection.execute_query(f'PRAGMA table_info("{table}")')
+            if any(row['name'] == column for row in rows):
+                continue
+            await connection.execute_script(f'ALTER TABLE "{table}" ADD COLUMN {definition}')
+        else:
+            await connection.execute_script(f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS {definition}')
@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Iterator, Optional, Type
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+
+EXECUTE_METHODS = ('execute_insert', 'execute_many', 'execute_query', 'execute_query_dict', 'execute_script')
+
+
+class QueryStats:
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0  # in seconds
+
+
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar('query_stats', default=None)
+
+
+def install_query_hook(client_class: Type[BaseDBAsyncClient]):
+    """
+    Wrap the methods of the DB client class, which execute SQL, to count the statements and their duration.
+
+    Subclasses, like transaction wrappers of the client, are wrapped too. Statements are counted by `track_queries`.
+    """
+    classes = [client_class]
+    for cls in classes:
+        classes.extend(cls.__subclasses__())
+        for name in EXECUTE_METHODS:
+            method = cls.__dict__.get(name)
+            if method and not getattr(method, 'is_tracked', False):
+                setattr(cls, name, _track_query(method))
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """
+    Count SQL statements, executed in the current context, including tasks started in it.
+    """
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+def start_tracking_queries() -> QueryStats:
+    """
+    Count SQL statements, executed in the current context from now on, until `stop_tracking_queries` is called.
+
+    Unlike `track_queries`, it allows to start and stop counting in different callbacks, like the hooks of a middleware.
+    """
+    stats = QueryStats()
+    _query_stats.set(stats)
+    return stats
+
+
+def stop_tracking_queries():
+    _query_stats.set(None)
+
+
+def _track_query(method):
+    @wraps(method)
+    async def tracked_method(*args, **kwargs):
+        stats = _query_stats.get()
+        if stats is None:
+            return await method(*args, **kwargs)
+
+        started_at = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            stats.count += 1
+            stats.duration += time.perf_counter() - started_at
+
+    tracked_method.is_tracked = True
+    return tracked_method
@@ -1,3 +1,9 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+from typing import Deque, Optional
+
 import aiohttp
 import ujson
 
@@ -35,3 +41,78 @@ class BotlyticsClient:
 
     async def close_session(self):
         await self._session.close()
+
+
+class BotlyticsPipeline:
+    """
+    Bounded queue of analytics messages, sent by a background flusher.
+
+    Messages are flushed in batches, when `batch_size` of them is collected or every `flush_interval` seconds,
+    with at most `max_concurrency` requests in flight. When the queue is full, new messages are dropped.
+    """
+
+    def __init__(self, client: BotlyticsClient, max_size=10000, batch_size=100, flush_interval=1.0, max_concurrency=10):
+        self._client = client
+        self._max_size = max_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_concurrency = max_concurrency
+
+        self._queue: Deque[dict] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._is_closing = False
+
+        self.sent_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    def put(self, text, kind, conversation_id=None, sender_id=None) -> bool:
+        if len(self._queue) >= self._max_size:
+            self.dropped_count += 1
+            return False
+
+        self._queue.append({'text': text, 'kind': kind, 'conversation_id': conversation_id, 'sender_id': sender_id})
+        if len(self._queue) >= self._batch_size and self._wakeup:
+            self._wakeup.set()
+        return True
+
+    async def close(self):
+        """
+        Stop the flusher, after it sends all the queued messages.
+        """
+        self._is_closing = True
+        self._wakeup.set()
+        await self._flusher
+
+    async def _flush_forever(self):
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            self._wakeup.clear()
+
+            while self._queue:
+                batch = [self._queue.popleft() for __ in range(min(self._batch_size, len(self._queue)))]
+                await asyncio.gather(*(self._send(message) for message in batch))
+
+            if self._is_closing:
+                break
+
+    async def _send(self, message: dict):
+        async with self._semaphore:
+            try:
+                await self._client.send_message(**message)
+            except Exception as e:
+                self.failed_count += 1
+                logging.warning(f'Failed to send analytics message: {e!r}')
+            else:
+                self.sent_count += 1
@@ -1,6 +1,8 @@
+import asyncio
+
 import pytest
 
-from anon_talks.integrations.botlytics import BotlyticsClient
+from anon_talks.integrations.botlytics import BotlyticsClient, BotlyticsPipeline
 
 
 pytestmark = pytest.mark.asyncio
@@ -42,3 +44,96 @@ class TestBotlyticsClient:
     async def test_send_message_invalid_kind(self, botlytics):
         with pytest.raises(ValueError, match='.*kind.*'):
             await botlytics.send_message(text='test', kind='BAD KIND', sender_id='user_007')
+
+
+class TestBotlyticsPipeline:
+
+    @pytest.fixture
+    async def make_pipeline(self, botlytics):
+        pipelines = []
+
+        def make_pipeline(**kwargs):
+            pipeline = BotlyticsPipeline(client=botlytics, **kwargs)
+            pipeline.start()
+            pipelines.append(pipeline)
+            return pipeline
+
+        yield make_pipeline
+        for pipeline in pipelines:
+            await pipeline.close()
+        await botlytics.close_session()
+
+    async def test_flush_by_size(self, aiohttp_client_mock, botlytics_send_url, make_pipeline):
+        aiohttp_client_mock.post(botlytics_send_url, payload={}, repeat=True)
+        pipeline = make_pipeline(batch_size=3, flush_interval=60)
+
+        for number in range(3):
+            pipeline.put(text=f'test {number}', kind=BotlyticsClient.KIND_INCOMING, sender_id='user_007')
+        await asyncio.sleep(0.01)
+
+        assert pipeline.sent_count == 3
+        request_calls = list(aiohttp_client_mock.requests.values()).pop()
+        assert [call.kwargs['json']['message']['text'] for call in request_calls] == ['test 0', 'test 1', 'test 2']
+
+    async def test_flush_by_time(self, aiohttp_client_mock, botlytics_send_url, make_pipeline):
+        aiohttp_client_mock.post(botlytics_send_url, payload={}, repeat=True)
+        pipeline = make_pipeline(batch_size=100, flush_interval=0.05)
+
+        pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING)
+        await asyncio.sleep(0.01)
+        assert pipeline.sent_count == 0
+
+        await asyncio.sleep(0.1)
+        assert pipeline.sent_count == 1
+
+    async def test_drop_when_full(self, aiohttp_client_mock, botlytics_send_url, make_pipeline):
+        aiohttp_client_mock.post(botlytics_send_url, payload={}, repeat=True)
+        pipeline = make_pipeline(max_size=2, batch_size=10, flush_interval=60)
+
+        results = [pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING) for __ in range(5)]
+        assert results == [True, True, False, False, False]
+        assert len(pipeline) == 2
+        assert pipeline.dropped_count == 3
+
+    async def test_close_flushes(self, aiohttp_client_mock, botlytics_send_url, make_pipeline):
+        aiohttp_client_mock.post(botlytics_send_url, payload={}, repeat=True)
+        pipeline = make_pipeline(batch_size=10, flush_interval=60)
+
+        for __ in range(25):
+            pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING)
+        await pipeline.close()
+
+        assert len(pipeline) == 0
+        assert pipeline.sent_count == 25
+
+    async def test_failed(self, aiohttp_client_mock, botlytics_send_url, make_pipeline):
+        aiohttp_client_mock.post(botlytics_send_url, status=500, body='not json')
+        aiohttp_client_mock.post(botlytics_send_url, payload={})
+        pipeline = make_pipeline(batch_size=10, flush_interval=60)
+
+        pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING)
+        pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING)
+        await pipeline.close()
+
+        assert pipeline.sent_count == 1
+        assert pipeline.failed_count == 1
+
+    async def test_max_concurrency(self, make_pipeline, monkeypatch, botlytics):
+        in_flight = max_in_flight = 0
+
+        async def send_message(**kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+        monkeypatch.setattr(botlytics, 'send_message', send_message)
+        pipeline = make_pipeline(batch_size=20, flush_interval=60, max_concurrency=3)
+
+        for __ in range(20):
+            pipeline.put(text='test', kind=BotlyticsClient.KIND_INCOMING)
+        await pipeline.close()
+
+        assert pipeline.sent_count == 20
+        assert max_in_flight == 3
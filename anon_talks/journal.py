@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import deque
+from contextlib import suppress
+from pathlib import Path
+from typing import Deque, List, Optional, Tuple
+
+import ujson
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal:
+    """
+    Append-only log of entries on the local disk, the write-ahead part of `WriteBehindStorage`.
+
+    Entries are JSON lines `[seq, entry]` in segment files, named by the first sequence number in them.
+    Entries, appended while the previous ones are written, are written and fsynced together,
+    so an fsync is shared by all the appends of the moment (group commit). An append returns,
+    when its entry is durable. Entries up to the sequence number, saved by `set_flushed`, are applied elsewhere,
+    fully applied segments are deleted, and the rest is returned by `get_unflushed` after a restart.
+    A failed write may leave a torn line, so the journal is closed then, and appends fail until a restart.
+    """
+    WATERMARK_NAME = 'flushed'
+
+    def __init__(self, path: Path, segment_size: int):
+        self._path = path
+        self._segment_size = segment_size  # in bytes, a segment is rotated after it's exceeded
+        self._segments: List[Tuple[int, Path]] = []  # (first seq, path), in order, the last one is written
+        self._file = None
+        self._unflushed: Deque[Tuple[int, dict]] = deque()  # durable entries after the watermark
+        self._last_seq = 0  # of the last appended entry
+        self._written_seq = 0  # of the last durable entry
+        self._pending: List[Tuple[int, dict, asyncio.Future]] = []
+        self._writer: Optional[asyncio.Task] = None
+        self._error: Optional[Exception] = None  # of the failed write
+
+    def open(self):
+        self._path.mkdir(parents=True, exist_ok=True)
+        flushed_seq = 0
+        with suppress(FileNotFoundError):
+            flushed_seq = int((self._path / self.WATERMARK_NAME).read_text())
+
+        for segment_path in sorted(self._path.glob('segment-*.jsonl')):
+            self._segments.append((int(segment_path.stem.split('-')[1]), segment_path))
+            for seq, entry in self._read_segment(segment_path):
+                self._last_seq = seq
+                if seq > flushed_seq:
+                    self._unflushed.append((seq, entry))
+        self._last_seq = self._written_seq = max(self._last_seq, flushed_seq)
+        self._open_segment()
+
+    async def close(self):
+        if self._writer:
+            await self._writer
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    async def append(self, entry: dict):
+        """
+        Write the entry and wait until it's durable. Entries are written in the order of calls.
+        """
+        if self._error:
+            raise JournalError('The journal is closed after a failed write.') from self._error
+        self._last_seq += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((self._last_seq, entry, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
+        await future
+
+    @property
+    def next_seq(self) -> int:
+        return self._last_seq + 1
+
+    def get_unflushed(self, limit: int) -> List[Tuple[int, dict]]:
+        return list(itertools.islice(self._unflushed, limit))
+
+    def set_flushed(self, seq: int):
+        """
+        Mark entries up to the sequence number as applied, delete segments of them.
+        """
+        # the watermark isn't fsynced: if it's lost, the entries are applied again, which changes nothing:
+        temp_path = self._path / f'{self.WATERMARK_NAME}.tmp'
+        temp_path.write_text(str(seq))
+        os.replace(str(temp_path), str(self._path / self.WATERMARK_NAME))
+        while self._unflushed and self._unflushed[0][0] <= seq:
+            self._unflushed.popleft()
+
+        # a segment is applied, if the next one starts after the watermark, the written one is kept:
+        while len(self._segments) > 1 and self._segments[1][0] <= seq + 1:
+            __, segment_path = self._segments.pop(0)
+            with suppress(FileNotFoundError):
+                segment_path.unlink()
+
+    async def _write(self):
+        loop = asyncio.get_event_loop()
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                self._file.write(b''.join(ujson.dumps([seq, entry]).encode() + b'\n' for seq, entry, __ in batch))
+                await loop.run_in_executor(None, self._sync)
+            except Exception as e:
+                logging.exception('Failed to write to the journal, it is closed.')
+                self._fail(e, batch)
+                return
+
+            for seq, entry, future in batch:
+                self._written_seq = seq
+                self._unflushed.append((seq, entry))
+                if not future.done():
+                    future.set_result(None)
+            if self._file.tell() >= self._segment_size:
+                self._file.close()
+                self._open_segment()
+
+    def _fail(self, error: Exception, batch: List[Tuple[int, dict, asyncio.Future]]):
+        # nothing is written after a possibly torn line, the entries of the batch are either durable or not,
+        # they're replayed after a restart, if they are:
+        self._error = error
+        self._file.close()
+        self._file = None
+        # the appends fail from the last one, so the transitions, applied by the callers, are undone in reverse:
+        pending, self._pending = self._pending, []
+        for __, __, future in reversed(pending):
+            if not future.done():
+                future.set_exception(JournalError('The journal is closed after a failed write.'))
+        for __, __, future in reversed(batch):
+            if not future.done():
+                future.set_exception(error)
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _open_segment(self):
+        first_seq = self._written_seq + 1
+        segment_path = self._path / f'segment-{first_seq:012d}.jsonl'
+        if not self._segments or self._segments[-1][1] != segment_path:
+            self._segments.append((first_seq, segment_path))
+        # a segment, left by the previous run, is reused only if it has no whole entries, so it's truncated:
+        self._file = open(segment_path, 'wb')
+        # the new file is durable, once the directory entry is:
+        dir_fd = os.open(str(self._path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    @staticmethod
+    def _read_segment(segment_path: Path):
+        with open(segment_path, 'rb') as segment_file:
+            for line in segment_file:
+                try:
+                    seq, entry = ujson.loads(line)
+                except ValueError:
+                    seq = None
+                if seq is None or not line.endswith(b'\n'):
+                    # the last write, torn by a crash, wasn't acknowledged:
+                    logging.warning(f'A torn entry at the end of {segment_path.name} is skipped.')
+                    return
+                yield seq, entry
@@ -0,0 +1,19 @@
+import asyncio
+from typing import Optional
+
+
+class LazyLock:
+    """
+    Asyncio lock, created on first use, to be bound to the running event loop instead of the one at import.
+    """
+
+    def __init__(self):
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        await self._lock.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self._lock.release()
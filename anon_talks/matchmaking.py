@@ -0,0 +1,244 @@
+import asyncio
+import itertools
+import re
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from anon_talks.locks import LazyLock
+
+
+WaitingEntry = Tuple[int, int, Sequence[str], datetime]  # (conversation id, initiator id, tags, waiting since)
+RecentEntry = Tuple[int, int, datetime]  # (initiator id, opponent id, finished at)
+Snapshot = Tuple[Iterable[WaitingEntry], Iterable[RecentEntry]]
+
+UNTAGGED = ''  # the key of the queue of searches without tags
+
+
+def parse_tags(text: str, max_count: int, max_length: int) -> List[str]:
+    """
+    Parse tags, given by a user as words, separated by commas or spaces, e.g. "#music, movies".
+
+    Tags are lowercased and deduplicated, only the first `max_count` of them are kept.
+    """
+    tags = []
+    for word in re.split(r'[\s,]+', text.lower()):
+        tag = word.strip('#')[:max_length]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags[:max_count]
+
+
+class _WaitingSearch:
+    __slots__ = ('user_id', 'tags', 'waiting_since', 'order', 'reservation')
+
+    def __init__(self, user_id: int, tags: Sequence[str], waiting_since: datetime,
+                 reservation: Optional[asyncio.Future] = None):
+        self.user_id = user_id
+        self.tags = tuple(tags)
+        self.waiting_since = waiting_since
+        self.order = 0  # of adding to the queue
+        # of a reserved search, resolved with the id of its conversation, once it's created, or None if it isn't:
+        self.reservation = reservation
+
+
+class Matchmaker:
+    """
+    In-memory matchmaking state of the bot.
+
+    Keeps a FIFO queue of conversations waiting for an opponent and an index of recent opponents,
+    which users shouldn't be paired with again until `recent_timeout` passes.
+    The waiting conversations are indexed by tags of their searches too, so a match is looked up
+    in the queues of the tags of the user, not in the whole queue. A search, waiting longer than `widen_after`,
+    is widened to any opponent.
+    A search without a match is reserved in the queue by `pop_match` at once, while its conversation is created,
+    so concurrent searches are paired with each other. The reservation is fulfilled by `enqueue`
+    of the conversation, or dropped by `cancel_reservation`.
+    The state is loaded from the database by `loader` coroutine on first use,
+    after that the database is only written to, to persist the changes.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[Snapshot]], recent_timeout: timedelta, widen_after: timedelta):
+        self._loader = loader
+        self._recent_timeout = recent_timeout
+        self._widen_after = widen_after
+        self._load_lock = LazyLock()
+        self._is_loaded = False
+
+        # searches are keyed by conversation ids, reserved ones by negated ids of their users:
+        self._waiting: 'OrderedDict[int, _WaitingSearch]' = OrderedDict()
+        self._tag_queues: Dict[str, 'OrderedDict[int, int]'] = {}  # tag -> search key -> initiator id
+        self._orders = itertools.count()
+        self._reservations: Dict[int, _WaitingSearch] = {}  # by user id, until the conversation is created
+        self._reserved_keys: Dict[int, int] = {}  # conversation id -> key, of a queued search, reserved before
+        self._recent: Dict[int, Dict[int, datetime]] = {}
+        self._recent_log: Deque[RecentEntry] = deque()  # ordered by finish time, used to expire the recent index
+
+    @property
+    def is_loaded(self):
+        return self._is_loaded
+
+    async def pop_match(self, user_id: int, tags: Sequence[str] = (), reserve=False) -> Optional[int]:
+        """
+        Take the oldest waiting conversation, suitable for the user, out of the queue and return its id.
+
+        A conversation is suitable, if it's created by someone else, who was not a recent opponent of the user.
+        Conversations, sharing a tag with the search of the user, are preferred, searches without tags
+        are paired with each other. If there are none of them, the oldest widened search is taken.
+        Only the queues of the tags are looked through, so a lookup takes O(tags), not O(waiting conversations).
+        A reserved search is returned, once its conversation is created.
+
+        With `reserve`, the search of the user is reserved in the queue, if there is no match, before returning.
+        """
+        await self._ensure_loaded()
+
+        while True:
+            key = self._find_match(user_id, tags)
+            if key is None:
+                break
+            search = self._remove_waiting(key)
+            if search.reservation is None:
+                return key
+            conversation_id = await search.reservation
+            if conversation_id is not None:
+                return conversation_id
+            # the reservation is cancelled, as the conversation isn't created
+
+        if reserve:
+            self._reserve(user_id, tags)
+        return None
+
+    async def enqueue(self, conversation_id: int, user_id: int, tags: Sequence[str] = ()):
+        """
+        Put the conversation to the queue, or fulfil the reservation of the search of the user by it.
+        """
+        if not self._is_loaded:
+            return
+        search = self._reservations.pop(user_id, None)
+        if search is None:
+            self._add_waiting(conversation_id, _WaitingSearch(user_id, tags, datetime.now()))
+            return
+
+        search.reservation.set_result(conversation_id)
+        if self._waiting.get(-user_id) is search:
+            self._reserved_keys[conversation_id] = -user_id
+
+    async def cancel_reservation(self, user_id: int):
+        self._cancel_reservation(user_id)
+
+    async def discard(self, conversation_id: int):
+        key = self._reserved_keys.get(conversation_id, conversation_id)
+        if self._is_loaded and key in self._waiting:
+            self._remove_waiting(key)
+
+    async def remember_opponents(self, user_id: int, opponent_id: int, finished_at: datetime):
+        if self._is_loaded:
+            self._add_recent(user_id, opponent_id, finished_at)
+
+    def reset(self):
+        self._is_loaded = False
+        for search in self._reservations.values():
+            search.reservation.set_result(None)
+        self._reservations.clear()
+        self._reserved_keys.clear()
+        self._waiting.clear()
+        self._tag_queues.clear()
+        self._recent.clear()
+        self._recent_log.clear()
+
+    async def load(self):
+        await self._ensure_loaded()
+
+    def _find_match(self, user_id: int, tags: Sequence[str]) -> Optional[int]:
+        self._expire_recent()
+        recent_opponents = self._recent.get(user_id, {})
+        time_limit = self._recent_time_limit()
+
+        def is_suitable(initiator_id: int) -> bool:
+            if initiator_id == user_id:
+                return False
+            finished_at = recent_opponents.get(initiator_id)
+            return not (finished_at and finished_at > time_limit)
+
+        candidates = (
+            next((key for key, initiator_id in self._tag_queues.get(tag, {}).items() if is_suitable(initiator_id)),
+                 None)
+            for tag in (tags or (UNTAGGED,))
+        )
+        key = min((candidate for candidate in candidates if candidate is not None),
+                  key=lambda candidate: self._waiting[candidate].order, default=None)
+        if key is None:
+            widened_since = datetime.now() - self._widen_after
+            for waiting_key, search in self._waiting.items():
+                if search.waiting_since > widened_since:
+                    break  # the queue is ordered by time, so the rest are not widened yet
+                if is_suitable(search.user_id):
+                    key = waiting_key
+                    break
+        return key
+
+    def _reserve(self, user_id: int, tags: Sequence[str]):
+        self._cancel_reservation(user_id)
+        search = _WaitingSearch(
+            user_id, tags, datetime.now(), reservation=asyncio.get_event_loop().create_future(),
+        )
+        self._reservations[user_id] = search
+        self._add_waiting(-user_id, search)
+
+    def _cancel_reservation(self, user_id: int):
+        search = self._reservations.pop(user_id, None)
+        if search is not None:
+            search.reservation.set_result(None)
+            if self._waiting.get(-user_id) is search:
+                self._remove_waiting(-user_id)
+
+    async def _ensure_loaded(self):
+        if self._is_loaded:
+            return
+
+        async with self._load_lock:
+            if self._is_loaded:
+                return
+
+            waiting, recent = await self._loader()
+            for conversation_id, user_id, tags, waiting_since in waiting:
+                self._add_waiting(conversation_id, _WaitingSearch(user_id, tags, waiting_since))
+            for user_id, opponent_id, finished_at in sorted(recent, key=lambda entry: entry[2]):
+                self._add_recent(user_id, opponent_id, finished_at)
+            self._is_loaded = True
+
+    def _add_waiting(self, key: int, search: _WaitingSearch):
+        search.order = next(self._orders)
+        self._waiting[key] = search
+        for tag in search.tags or (UNTAGGED,):
+            self._tag_queues.setdefault(tag, OrderedDict())[key] = search.user_id
+
+    def _remove_waiting(self, key: int) -> _WaitingSearch:
+        search = self._waiting.pop(key)
+        for tag in search.tags or (UNTAGGED,):
+            queue = self._tag_queues[tag]
+            del queue[key]
+            if not queue:
+                del self._tag_queues[tag]
+        if search.reservation is not None and search.reservation.done():
+            self._reserved_keys.pop(search.reservation.result(), None)
+        return search
+
+    def _add_recent(self, user_id: int, opponent_id: int, finished_at: datetime):
+        self._recent.setdefault(user_id, {})[opponent_id] = finished_at
+        self._recent.setdefault(opponent_id, {})[user_id] = finished_at
+        self._recent_log.append((user_id, opponent_id, finished_at))
+
+    def _expire_recent(self):
+        time_limit = self._recent_time_limit()
+        while self._recent_log and self._recent_log[0][2] <= time_limit:
+            user_id, opponent_id, finished_at = self._recent_log.popleft()
+            for user, opponent in ((user_id, opponent_id), (opponent_id, user_id)):
+                opponents = self._recent.get(user, {})
+                if opponents.get(opponent) == finished_at:  # may be refreshed by a newer conversation
+                    del opponents[opponent]
+                    if not opponents:
+                        del self._recent[user]
+
+    def _recent_time_limit(self) -> datetime:
+        return datetime.now() - self._recent_timeout
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiogram.types import Message
+
+
+class _MediaGroup:
+    __slots__ = ('chat_id', 'messages', 'callback', 'task')
+
+    def __init__(self, chat_id: int, callback: Callable[[List[Message]], Awaitable]):
+        self.chat_id = chat_id
+        self.messages: List[Message] = []
+        self.callback = callback
+        self.task: Optional[asyncio.Task] = None
+
+
+class MediaGroupCollector:
+    """
+    Collector of messages of media groups (albums), to relay every group by a single call.
+
+    Telegram sends each message of a group in a separate update, one right after another.
+    Messages of a group are collected for `delay` seconds after the first one,
+    then they're passed to the callback, given with the first message.
+    """
+
+    def __init__(self, delay: float):
+        self._delay = delay
+        self._groups: Dict[str, _MediaGroup] = {}
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, message: Message, callback: Callable[[List[Message]], Awaitable]):
+        group = self._groups.get(message.media_group_id)
+        if group is None:
+            group = self._groups[message.media_group_id] = _MediaGroup(message.chat.id, callback)
+            group.task = asyncio.create_task(self._flush_later(message.media_group_id))
+        group.messages.append(message)
+
+    async def flush_chat(self, chat_id: int):
+        """
+        Pass the groups of the chat to their callbacks at once, e.g. to relay them before a later message.
+        """
+        media_group_ids = [media_group_id for media_group_id, group in self._groups.items() if group.chat_id == chat_id]
+        for media_group_id in media_group_ids:
+            await self._flush(media_group_id)
+
+    async def close(self):
+        for media_group_id in list(self._groups):
+            await self._flush(media_group_id)
+
+    async def _flush_later(self, media_group_id: str):
+        await asyncio.sleep(self._delay)
+        try:
+            await self._flush(media_group_id)
+        except Exception:
+            logging.exception(f'Failed to relay media group {media_group_id}.')
+
+    async def _flush(self, media_group_id: str):
+        group = self._groups.pop(media_group_id, None)
+        if group is None:
+            return
+        if group.task is not asyncio.current_task():
+            group.task.cancel()
+        await group.callback(group.messages)
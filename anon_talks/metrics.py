@@ -0,0 +1,120 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+from aiohttp import web
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # in seconds
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50)
+
+
+class Histogram:
+    """
+    Histogram of observed values, rendered in Prometheus text format.
+
+    Bucket counters are cumulative only on rendering, so an observation increments a single counter.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # counters of the buckets (with +Inf one in the end) and sum of the values, by label values:
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        label_values = tuple(str(labels[name]) for name in self.label_names)
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+        counters, total = series
+        counters[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def get_count(self, **labels) -> int:
+        label_values = tuple(str(labels[name]) for name in self.label_names)
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def clear(self):
+        self._series.clear()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counters, total) in sorted(self._series.items()):
+            labels = ''.join(f'{name}="{value}",' for name, value in zip(self.label_names, label_values))
+            count = 0
+            for bound, counter in zip(self.buckets + ('+Inf',), counters):
+                count += counter
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {count}')
+            labels = labels.rstrip(',')
+            lines.append(f'{self.name}_sum{{{labels}}} {total[0]}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Gauge:
+    """
+    Current value of some state, taken by the function on rendering.
+    """
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._function: Callable[[], float] = lambda: 0
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def render(self) -> str:
+        return f'# HELP {self.name} {self.documentation}\n# TYPE {self.name} gauge\n{self.name} {self._function()}\n'
+
+
+UPDATE_DURATION = Histogram(
+    'anon_talks_update_duration_seconds', 'Duration of processing of an incoming message.', label_names=['branch'],
+)
+UPDATE_QUERIES = Histogram(
+    'anon_talks_update_queries', 'SQL statements, executed to process an incoming message.',
+    label_names=['branch'], buckets=COUNT_BUCKETS,
+)
+UPDATE_QUERIES_DURATION = Histogram(
+    'anon_talks_update_queries_duration_seconds', 'Total duration of SQL statements of an incoming message.',
+    label_names=['branch'],
+)
+TELEGRAM_API_DURATION = Histogram(
+    'anon_talks_telegram_api_duration_seconds', 'Duration of a Telegram Bot API call.', label_names=['method'],
+)
+
+UPDATE_QUEUE_WAIT = Histogram(
+    'anon_talks_update_queue_wait_seconds', 'Time an incoming update waits for earlier updates of its chat.',
+)
+
+CHAT_QUEUES = Gauge('anon_talks_chat_queues', 'Chats with updates in progress.')
+CHAT_QUEUE_DEPTH = Gauge('anon_talks_chat_queue_depth', 'Updates waiting for earlier updates of their chats.')
+CHAT_QUEUE_MAX_DEPTH = Gauge('anon_talks_chat_queue_max_depth', 'Updates waiting in the longest queue of a chat.')
+CHAT_QUEUE_LAG = Gauge('anon_talks_chat_queue_lag_seconds', 'How long the oldest waiting update has waited.')
+
+HISTOGRAMS = (
+    UPDATE_DURATION, UPDATE_QUERIES, UPDATE_QUERIES_DURATION, TELEGRAM_API_DURATION, UPDATE_QUEUE_WAIT,
+)
+GAUGES = (CHAT_QUEUES, CHAT_QUEUE_DEPTH, CHAT_QUEUE_MAX_DEPTH, CHAT_QUEUE_LAG)
+
+
+def render_metrics() -> str:
+    return ''.join(metric.render() for metric in HISTOGRAMS + GAUGES)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
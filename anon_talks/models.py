@@ -1,14 +1,22 @@
 import asyncio
+import sqlite3
 from datetime import datetime, timedelta
 from enum import Enum
+from typing import Iterable, List, Optional, Sequence, Tuple
 
+from pypika import Order
 from pypika.queries import Query, Table
-from tortoise import Model, fields, Tortoise
+from pypika.terms import Case
+from tortoise import Model, fields
 from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 from tortoise.query_utils import Q
 
 from anon_talks import config
-from anon_talks.utils import ExistsCriterion
+from anon_talks.broker import BrokerClient, RemoteMatchmaker
+from anon_talks.cache import UserCache
+from anon_talks.matchmaking import Matchmaker
+from anon_talks.routing import ConversationRoutes, Route
 
 
 class TimestampMixin:
@@ -27,10 +35,72 @@ class TelegramUser(TimestampMixin, Model):
     tg_id = fields.BigIntField(unique=True)
     tg_chat_id = fields.BigIntField(unique=True)
     status = fields.CharEnumField(Status, default=Status.IN_MENU, max_length=30)
+    tags = fields.CharField(max_length=255, default='')  # comma-separated, searches are paired by them
+    blocked_at = fields.DatetimeField(null=True)  # when the bot was found blocked by the user, skipped by broadcasts
+
+    # SQL of the hot queries, built by `prepare_queries`:
+    GET_BY_TG_ID_SQL = None
+    SET_STATUSES_SQL = None
+    SET_STATUSES_RETURNING_SQL = None  # None, if the DB doesn't support RETURNING
 
     def __str__(self):
         return f'TG user {self.pk}'
 
+    @classmethod
+    def prepare_queries(cls):
+        table = Table(cls._meta.db_table)
+        params = [cls._meta.db.executor_class.parameter(None, i) for i in range(3)]
+        cls.GET_BY_TG_ID_SQL = Query.from_(table).select('*').where(table.tg_id == params[0]).limit(1).get_sql()
+        # a transition changes the status of at most two users, the members of a conversation:
+        cls.SET_STATUSES_SQL = (
+            Query.update(table)
+            .set(table.status, params[0])
+            .where(table.id.isin([params[1], params[2]]))
+            .get_sql()
+        )
+        if supports_returning(cls._meta.db):
+            cls.SET_STATUSES_RETURNING_SQL = cls.SET_STATUSES_SQL + ' RETURNING *'
+
+    @classmethod
+    async def get_cached(cls, tg_id: int) -> Optional['TelegramUser']:
+        user = user_cache.get(tg_id)
+        if user is None:
+            __, rows = await cls._meta.db.execute_query(cls.GET_BY_TG_ID_SQL, [tg_id])
+            user = cls._init_from_db(**dict(rows[0])) if rows else None
+            if user:
+                user_cache.put(user)
+        return user
+
+    @classmethod
+    async def set_statuses(cls, status: 'TelegramUser.Status', *user_ids: int,
+                           returning=False) -> List['TelegramUser']:
+        """
+        Set the status of one or two users in one statement.
+
+        With `returning`, which needs the DB to support RETURNING, the updated users are returned by the statement.
+        """
+        values = [status.value, user_ids[0], user_ids[-1]]
+        if returning:
+            rows = await cls._meta.db.execute_query_dict(cls.SET_STATUSES_RETURNING_SQL, values)
+        else:
+            await cls._meta.db.execute_query(cls.SET_STATUSES_SQL, values)
+            rows = []
+        for user_id in user_ids:
+            user_cache.set_status(user_id, status)
+        return [cls._init_from_db(**row) for row in rows]
+
+    @classmethod
+    async def mark_blocked(cls, *user_ids: int):
+        await cls.filter(id__in=user_ids).update(blocked_at=datetime.now())
+
+    def get_tags(self) -> Tuple[str, ...]:
+        return split_tags(self.tags)
+
+    async def set_tags(self, tags: Iterable[str]):
+        self.tags = ','.join(tags)
+        await self.save(update_fields=('tags', 'modified_at'))
+        await notify_users_changed(self.pk)
+
 
 class ConversationQuerySet(QuerySet):
 
@@ -48,56 +118,236 @@ class Conversation(TimestampMixin, Model):
     id = fields.IntField(pk=True)
     initiator = fields.ForeignKeyField('anon_talks.TelegramUser', related_name='started_conversations')
     opponent = fields.ForeignKeyField('anon_talks.TelegramUser', related_name='joined_conversations', null=True)
-    finished_at = fields.DatetimeField(null=True)
+    finished_at = fields.DatetimeField(null=True, index=True)
+    tags = fields.CharField(max_length=255, default='')  # of the search, comma-separated
+
+    class Meta:
+        indexes = (
+            ('initiator', 'finished_at'),
+            ('opponent', 'finished_at'),
+        )
+
+    # the ORM doesn't support partial indexes, so they are created by raw SQL:
+    PARTIAL_INDEXES_SQL = (
+        'CREATE INDEX IF NOT EXISTS "conversation_waiting_opponent_idx" ON "conversation" ("initiator_id") '
+        'WHERE "opponent_id" IS NULL AND "finished_at" IS NULL;',
+    )
+
+    # SQL of the hot queries, built by `prepare_queries`:
+    CLAIM_SQL = None
+    CLAIM_RETURNING_SQL = None  # None, if the DB doesn't support RETURNING
+    FINISH_SQL = None
+    FIND_ROUTE_SQL = None
 
     def __str__(self):
         return f'Conversation {self.pk}'
 
     @classmethod
-    async def start(cls, user: TelegramUser) -> 'Conversation':
+    def prepare_queries(cls):
         conversation_table = Table(cls._meta.db_table)
-        c1 = Table(cls._meta.db_table, alias='C1')
-        params = [cls._meta.db.executor_class.parameter(None, i) for i in range(4)]
-
-        subquery = (
-            Query.from_(c1)
-            .select(c1.id)
-            .where((((c1.opponent_id == conversation_table.initiator_id) & (c1.initiator_id == params[1]))
-                   | ((c1.initiator_id == conversation_table.opponent_id) & (c1.opponent_id == params[2])))
-                   & c1.finished_at > params[3])  # is recent
+        user_table = Table(TelegramUser._meta.db_table)
+        params = [cls._meta.db.executor_class.parameter(None, i) for i in range(3)]
+
+        cls.CLAIM_SQL = (
+            Query.update(conversation_table)
+            .set(conversation_table.opponent_id, params[0])
+            .set(conversation_table.modified_at, params[1])
+            .where((conversation_table.id == params[2])
+                   & conversation_table.opponent_id.isnull()
+                   & conversation_table.finished_at.isnull())
+            .get_sql()
+        )
+        if supports_returning(cls._meta.db):
+            cls.CLAIM_RETURNING_SQL = cls.CLAIM_SQL + ' RETURNING *'
+        cls.FINISH_SQL = (
+            Query.update(conversation_table)
+            .set(conversation_table.finished_at, params[0])
+            .set(conversation_table.modified_at, params[1])
+            .where((conversation_table.id == params[2]) & conversation_table.finished_at.isnull())
+            .get_sql()
         )
-        query = (
+        opponent_id = (Case()
+                       .when(conversation_table.initiator_id == params[0], conversation_table.opponent_id)
+                       .else_(conversation_table.initiator_id))
+        cls.FIND_ROUTE_SQL = (
             Query.from_(conversation_table)
-            .select(conversation_table.id)
+            .join(user_table).on(user_table.id == opponent_id)
+            .select(conversation_table.id, user_table.id, user_table.tg_chat_id)
+            .where(((conversation_table.initiator_id == params[1]) | (conversation_table.opponent_id == params[2]))
+                   & conversation_table.opponent_id.notnull()
+                   & conversation_table.finished_at.isnull())
+            .orderby(conversation_table.id, order=Order.desc)
             .limit(1)
-            .where(conversation_table.opponent_id.isnull()
-                   & conversation_table.finished_at.isnull()
-                   & (conversation_table.initiator_id != params[0])  # not own created
-                   & ExistsCriterion(subquery).negate())  # should not have the same recent opponent
+            .get_sql()
         )
 
-        time_limit = datetime.now() - timedelta(minutes=config.RECENT_OPPONENT_TIMEOUT)
-        connection = Tortoise.get_connection('anon_talks')
-
-        __, suitable_conversations = await connection.execute_query(query.get_sql(), ([user.id] * 3) + [time_limit])
-        if suitable_conversations:
-            conversation = await cls.all().select_related('initiator').get(id=suitable_conversations[0][0])
-            conversation.opponent = user
-            conversation.initiator.status = conversation.opponent.status = TelegramUser.Status.IN_CONVERSATION
-            await asyncio.gather(
-                conversation.save(update_fields=['opponent_id', 'modified_at']),
-                conversation.initiator.save(update_fields=['status']),
-                conversation.opponent.save(update_fields=['status']),
-            )
+    @classmethod
+    async def start(cls, user: TelegramUser, tags: Optional[Sequence[str]] = None) -> 'Conversation':
+        """
+        Pair the user with a waiting conversation or create a new one to wait for an opponent.
+
+        The search is by the given tags, the tags of the user by default.
+        Either transition is a transaction of two statements: the conversation is claimed or created,
+        and the statuses of its members are set.
+        If there is no match, the search is reserved in the matchmaker at once, so concurrent searches
+        are paired with it, while the conversation is created.
+        """
+        tags = user.get_tags() if tags is None else tuple(tags)
+        conversation = None
+        conversation_id = await matchmaker.pop_match(user.pk, tags, reserve=True)
+        while conversation_id:
+            conversation = await cls._pair(conversation_id, opponent=user)
+            if conversation:
+                break
+            # the conversation is already taken by another worker or finished, try the next one:
+            conversation_id = await matchmaker.pop_match(user.pk, tags, reserve=True)
+
+        if conversation:
+            conversation_routes.add(conversation.pk, conversation.initiator, user)
+            await notify_users_changed(conversation.initiator_id, user.pk)
         else:
+            try:
+                async with in_transaction('anon_talks') as connection:
+                    conversation = await cls.create(initiator=user, tags=','.join(tags), using_db=connection)
+                    await TelegramUser.set_statuses(TelegramUser.Status.WAITING_OPPONENT, user.pk)
+            except BaseException:  # cancellation too
+                await matchmaker.cancel_reservation(user.pk)
+                raise
             user.status = TelegramUser.Status.WAITING_OPPONENT
-            conversation, __ = await asyncio.gather(
-                cls.create(initiator=user),
-                user.save(update_fields=['status']),
-            )
+            await matchmaker.enqueue(conversation.pk, user.pk, tags)
+            await notify_users_changed(user.pk)
 
         return conversation
 
+    @classmethod
+    async def _pair(cls, conversation_id: int, opponent: TelegramUser) -> Optional['Conversation']:
+        """
+        Set the opponent of the conversation, if it's still waiting for one, and put its members in the conversation.
+
+        The claim is a single conditional UPDATE, so a conversation can't be claimed twice by concurrent searches.
+        With RETURNING, the claimed conversation and its initiator are returned by the two UPDATEs of the transaction,
+        otherwise they're read by a SELECT between them.
+        """
+        async with in_transaction('anon_talks') as connection:
+            values = [opponent.pk, datetime.now(), conversation_id]
+            if cls.CLAIM_RETURNING_SQL:
+                rows = await connection.execute_query_dict(cls.CLAIM_RETURNING_SQL, values)
+                if not rows:
+                    return None
+                conversation = cls._init_from_db(**rows[0])
+                members = await TelegramUser.set_statuses(
+                    TelegramUser.Status.IN_CONVERSATION, conversation.initiator_id, opponent.pk, returning=True,
+                )
+                conversation.initiator = next(member for member in members if member.pk == conversation.initiator_id)
+            else:
+                claimed_count, __ = await connection.execute_query(cls.CLAIM_SQL, values)
+                if not claimed_count:
+                    return None
+                conversation = await (cls
+                                      .filter(id=conversation_id)
+                                      .using_db(connection)
+                                      .select_related('initiator')
+                                      .get())
+                await TelegramUser.set_statuses(
+                    TelegramUser.Status.IN_CONVERSATION, conversation.initiator_id, opponent.pk,
+                )
+                conversation.initiator.status = TelegramUser.Status.IN_CONVERSATION
+
+        opponent.status = TelegramUser.Status.IN_CONVERSATION
+        conversation.opponent = opponent
+        return conversation
+
+    @classmethod
+    async def finish_stale_waiting(cls, created_before: datetime, limit: int) -> List[Tuple[int, int]]:
+        """
+        Finish at most `limit` conversations, waiting for an opponent since before the time,
+        and return their initiators to the menu, in a transaction. Return ids and chat ids of the initiators.
+
+        The conversations are finished by one conditional UPDATE, so a conversation, claimed concurrently,
+        is either paired or finished, and its initiator is set to the menu only in the latter case.
+        With RETURNING, the transaction is the two UPDATEs, otherwise the finished conversations
+        and the chat ids of their initiators are read by a SELECT between them.
+        """
+        conversation_table = Table(cls._meta.db_table)
+        params = [cls._meta.db.executor_class.parameter(None, i) for i in range(3)]
+        is_waiting = conversation_table.opponent_id.isnull() & conversation_table.finished_at.isnull()
+        stale_ids = (Query
+                     .from_(conversation_table)
+                     .select(conversation_table.id)
+                     .where(is_waiting & (conversation_table.created_at < params[2]))
+                     .orderby(conversation_table.id)
+                     .limit(limit))
+        finish_sql = (
+            Query.update(conversation_table)
+            .set(conversation_table.finished_at, params[0])
+            .set(conversation_table.modified_at, params[1])
+            .where(conversation_table.id.isin(stale_ids) & is_waiting)
+            .get_sql()
+        )
+        finished_at = datetime.now()
+        values = [finished_at, finished_at, created_before]
+
+        async with in_transaction('anon_talks') as connection:
+            if supports_returning(connection):
+                rows = await connection.execute_query_dict(f'{finish_sql} RETURNING "id", "initiator_id"', values)
+                finished = [(row['id'], row['initiator_id']) for row in rows]
+            else:
+                await connection.execute_query(finish_sql, values)
+                # the conversations, just finished, are found by the time of the finish:
+                finished = await (cls
+                                  .filter(finished_at=finished_at, opponent_id__isnull=True)
+                                  .using_db(connection)
+                                  .values_list('id', 'initiator_id', 'initiator__tg_chat_id'))
+            if not finished:
+                return []
+
+            user_table = Table(TelegramUser._meta.db_table)
+            set_menu_sql = (
+                Query.update(user_table)
+                .set(user_table.status, TelegramUser.Status.IN_MENU.value)
+                .where(user_table.id.isin([user_id for __, user_id, *__ in finished]))
+                .get_sql()
+            )
+            if supports_returning(connection):
+                rows = await connection.execute_query_dict(f'{set_menu_sql} RETURNING "id", "tg_chat_id"')
+                initiators = [(row['id'], row['tg_chat_id']) for row in rows]
+            else:
+                await connection.execute_query(set_menu_sql)
+                initiators = [(user_id, chat_id) for __, user_id, chat_id in finished]
+
+        await asyncio.gather(*(matchmaker.discard(conversation_id) for conversation_id, *__ in finished))
+        for user_id, __ in initiators:
+            user_cache.set_status(user_id, TelegramUser.Status.IN_MENU)
+        return initiators
+
+    @classmethod
+    async def find_route(cls, user_id: int) -> Optional[Route]:
+        """
+        Look up the route to the opponent of the user in a conversation in progress.
+        """
+        __, rows = await cls._meta.db.execute_query(cls.FIND_ROUTE_SQL, [user_id] * 3)
+        return Route(*rows[0]) if rows else None
+
+    @classmethod
+    async def matchmaking_snapshot(cls):
+        """
+        Fetch the state for the matchmaker: conversations waiting for an opponent and recent pairs of opponents.
+        """
+        time_limit = datetime.now() - timedelta(minutes=config.RECENT_OPPONENT_TIMEOUT)
+        waiting_qs = (cls
+                      .waiting_opponent()
+                      .order_by('id')
+                      .values_list('id', 'initiator_id', 'tags', 'created_at'))
+        recent_qs = (cls
+                     .filter(opponent_id__isnull=False, finished_at__gt=time_limit)
+                     .values_list('initiator_id', 'opponent_id', 'finished_at'))
+        waiting, recent = await asyncio.gather(waiting_qs, recent_qs)
+        waiting = [(conversation_id, initiator_id, split_tags(tags), to_naive(created_at))
+                   for conversation_id, initiator_id, tags, created_at in waiting]
+        recent = [(initiator_id, opponent_id, to_naive(finished_at))
+                  for initiator_id, opponent_id, finished_at in recent]
+        return waiting, recent
+
     @classmethod
     def in_progress(cls):
         return cls._qs().in_progress()
@@ -116,18 +366,124 @@ class Conversation(TimestampMixin, Model):
         return self.opponent
 
     async def finish(self):
+        """
+        Finish the conversation and return its members to the menu, in a transaction of two statements.
+        """
         member_users = [self.initiator]
         if self.opponent_id:
             member_users.append(self.opponent)
 
-        self.finished_at = datetime.now()
-        coros = [self.save(update_fields=['finished_at'])]
-        for user in member_users:
-            user.status = TelegramUser.Status.IN_MENU
-            coros.append(user.save(update_fields=['status']))
+        finished_at = await self.finish_by_id(self.pk, [user.pk for user in member_users])
+        if finished_at:
+            self.finished_at = self.modified_at = finished_at
+            for user in member_users:
+                user.status = TelegramUser.Status.IN_MENU
+
+    @classmethod
+    async def finish_by_id(cls, conversation_id: int, member_ids: Sequence[int]) -> Optional[datetime]:
+        """
+        Finish the conversation and return its members to the menu, in a transaction of two statements.
+
+        The conversation isn't read: its members, the initiator and the opponent if there is one, are given,
+        like by a route. Return the time of the finish, or None if the conversation is already finished.
+        """
+        finished_at = datetime.now()
+        async with in_transaction('anon_talks') as connection:
+            finished_count, __ = await connection.execute_query(
+                cls.FINISH_SQL, [finished_at, finished_at, conversation_id],
+            )
+            if not finished_count:
+                return None
+            await TelegramUser.set_statuses(TelegramUser.Status.IN_MENU, *member_ids)
 
-        await asyncio.gather(*coros)
+        await matchmaker.discard(conversation_id)
+        if len(member_ids) == 2:
+            conversation_routes.remove(*member_ids)
+            await matchmaker.remember_opponents(*member_ids, finished_at)
+        await notify_users_changed(*member_ids)
+        return finished_at
 
     @classmethod
     def _qs(cls):
         return ConversationQuerySet(model=cls)
+
+
+class ArchivedConversation(Model):
+    """
+    Conversation, finished long ago, moved from the hot table by `ConversationArchiver`.
+    """
+    id = fields.IntField(pk=True, generated=False)
+    initiator = fields.ForeignKeyField('anon_talks.TelegramUser', related_name='archived_started_conversations')
+    opponent = fields.ForeignKeyField('anon_talks.TelegramUser', related_name='archived_joined_conversations',
+                                      null=True)
+    tags = fields.CharField(max_length=255, default='')  # of the search, comma-separated
+    created_at = fields.DatetimeField(null=True)
+    modified_at = fields.DatetimeField(null=True)
+    finished_at = fields.DatetimeField(index=True)
+
+    def __str__(self):
+        return f'Archived conversation {self.pk}'
+
+
+def prepare_queries():
+    """
+    Build SQL of the hot queries once, with placeholders of parameters, in the dialect of the DB.
+
+    The text of a statement is the same on every call, so asyncpg prepares it once per connection
+    and reuses it from the statement cache, instead of parsing and planning a query with inlined values every time.
+    """
+    TelegramUser.prepare_queries()
+    Conversation.prepare_queries()
+
+
+def supports_returning(connection) -> bool:
+    """
+    Whether the DB returns rows, changed by a statement, by RETURNING.
+
+    It's in SQLite since 3.35, older versions, like the one of the Docker image, read the rows by another statement.
+    """
+    dialect = connection.capabilities.dialect
+    return dialect == 'postgres' or (dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35))
+
+
+def split_tags(tags: str) -> Tuple[str, ...]:
+    return tuple(tags.split(',')) if tags else ()
+
+
+def to_naive(value: datetime) -> datetime:
+    """
+    Drop the timezone, which the ORM gives to fetched values, while the models write naive local time.
+    """
+    return value.replace(tzinfo=None)
+
+
+async def notify_users_changed(*user_ids: int):
+    """
+    Tell other workers, that the state of the users is changed, so they drop it from local caches.
+    """
+    if broker_client:
+        await broker_client.publish('users_changed', user_ids)
+
+
+def _on_broker_event(event: str, data):
+    if event == 'users_changed':
+        for user_id in data:
+            user_cache.invalidate(user_id)
+            conversation_routes.remove(user_id)
+
+
+user_cache = UserCache(max_size=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+conversation_routes = ConversationRoutes(loader=Conversation.find_route)
+if config.BROKER_SOCK_NAME:
+    broker_client = BrokerClient(
+        path=str(config.ROOT_PATH / 'socks' / config.BROKER_SOCK_NAME),
+        on_event=_on_broker_event,
+    )
+    matchmaker = RemoteMatchmaker(client=broker_client)
+else:
+    broker_client = None
+    matchmaker = Matchmaker(
+        loader=Conversation.matchmaking_snapshot,
+        recent_timeout=timedelta(minutes=config.RECENT_OPPONENT_TIMEOUT),
+        widen_after=timedelta(seconds=config.TAG_WIDEN_AFTER),
+    )
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
+
+import ujson
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.types import Update
+
+from anon_talks.bot import get_chat_id
+from anon_talks.sender import MessageSender
+
+
+class OffsetStore:
+    """
+    Persistent state of long polling: the offset of the next update to fetch
+    and ids of later updates, which are processed already.
+
+    The state is saved to a JSON file by atomic replacement, so a crash leaves either the old state or the new one.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+
+    def load(self) -> Tuple[int, Set[int]]:
+        try:
+            with open(self._path) as state_file:
+                state = ujson.load(state_file)
+        except FileNotFoundError:
+            return 0, set()
+        return state['offset'], set(state['done'])
+
+    def save(self, offset: int, done: Iterable[int]):
+        temp_path = f'{self._path}.tmp'
+        with open(temp_path, 'w') as state_file:
+            ujson.dump({'offset': offset, 'done': sorted(done)}, state_file)
+        os.replace(temp_path, self._path)
+
+
+class UpdatePoller:
+    """
+    Long polling of Telegram updates, processed concurrently by at most `max_workers` workers.
+
+    Updates of a chat are processed one by one, in the order they were sent, while different chats are served
+    in parallel. Replies of handlers are sent through the rate-limited sender.
+
+    Telegram forgets updates before the offset of a getUpdates call, so the offset is advanced only up to
+    the earliest update in progress. Updates after it, which are processed already, are remembered
+    in the offset store and skipped, when they're fetched again, also after a restart.
+    The state is saved off the event loop, changes, made while it's written, are saved together by the next write.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, sender: MessageSender, offset_store: OffsetStore,
+                 batch_size=100, poll_timeout=20, max_workers=16):
+        self._dispatcher = dispatcher
+        self._sender = sender
+        self._offset_store = offset_store
+        self._batch_size = batch_size
+        self._poll_timeout = poll_timeout
+        self._max_workers = max_workers
+
+        self._offset = 0
+        self._done: Set[int] = set()
+        self._in_flight: Set[int] = set()
+        self._chats: Dict[int, Deque[Update]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._processed: Optional[asyncio.Event] = None
+        self._is_closing = False
+        self._saver: Optional[asyncio.Task] = None
+        self._is_state_changed = False
+
+        self.processed_count = 0
+
+    async def run(self):
+        """
+        Poll and process updates until `stop` is called, then wait for the fetched updates to be processed.
+        """
+        self._offset, self._done = self._offset_store.load()
+        self._ready = asyncio.Queue()
+        self._processed = asyncio.Event()
+        workers = [asyncio.create_task(self._work()) for __ in range(self._max_workers)]
+        try:
+            while not self._is_closing:
+                await self.poll()
+            await self._drain()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self._saver:
+                await self._saver
+
+    def stop(self):
+        self._is_closing = True
+
+    async def poll(self):
+        """
+        Fetch a batch of updates and schedule the new ones for processing.
+        """
+        # while updates are in progress, new ones are fetched at once, not to hold the polling of the workers:
+        timeout = 0 if self._in_flight else self._poll_timeout
+        try:
+            updates = await self._dispatcher.bot.get_updates(offset=self._offset, limit=self._batch_size,
+                                                             timeout=timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f'Failed to get updates: {e!r}')
+            await asyncio.sleep(1)
+            return
+
+        new_updates = [
+            update for update in updates
+            if update.update_id >= self._offset
+            and update.update_id not in self._done
+            and update.update_id not in self._in_flight
+        ]
+        for update in new_updates:
+            self._schedule(update)
+
+        if not new_updates and self._in_flight:
+            # all the fetched updates are in progress, so wait for one of them to be processed:
+            self._processed.clear()
+            await self._processed.wait()
+
+    def _schedule(self, update: Update):
+        self._in_flight.add(update.update_id)
+        chat_id = get_chat_id(update)
+        if chat_id is None:
+            # updates without a chat aren't ordered:
+            chat_id = -update.update_id
+        updates = self._chats.get(chat_id)
+        if updates is None:
+            updates = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        updates.append(update)
+
+    async def _work(self):
+        while True:
+            chat_id = await self._ready.get()
+            updates = self._chats[chat_id]
+            update = updates[0]
+            await self._process(update)
+
+            updates.popleft()
+            if updates:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+            self._mark_done(update.update_id)
+
+    async def _process(self, update: Update):
+        try:
+            results = await self._dispatcher.process_update(update)
+            for result in results or ():
+                if isinstance(result, SendMessage):
+                    await self._send_response(result)
+        except Exception:
+            logging.exception(f'Failed to process update {update.update_id}.')
+
+    async def _send_response(self, response: SendMessage):
+        kwargs = {key: value for key, value in response.prepare().items() if key not in ('chat_id', 'text')}
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = response.reply_markup
+        await self._sender.send_message(response.chat_id, response.text, priority=MessageSender.PRIORITY_HIGH,
+                                        **kwargs)
+
+    def _mark_done(self, update_id: int):
+        self._in_flight.discard(update_id)
+        self._done.add(update_id)
+        self.processed_count += 1
+
+        # the offset advances up to the earliest update in progress, or past all the fetched ones:
+        self._offset = min(self._in_flight) if self._in_flight else max(self._done) + 1
+        self._done = {done_id for done_id in self._done if done_id >= self._offset}
+        self._is_state_changed = True
+        if self._saver is None or self._saver.done():
+            self._saver = asyncio.ensure_future(self._save_state())
+        self._processed.set()
+
+    async def _save_state(self):
+        loop = asyncio.get_running_loop()
+        while self._is_state_changed:
+            self._is_state_changed = False
+            try:
+                await loop.run_in_executor(None, self._offset_store.save, self._offset, list(self._done))
+            except Exception:
+                # the state is saved again by the next processed update:
+                logging.exception('Failed to save the state of polling.')
+
+    async def _drain(self):
+        while self._in_flight:
+            self._processed.clear()
+            await self._processed.wait()
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from anon_talks.models import notify_users_changed
+from anon_talks.sender import MessageSender
+from anon_talks.services import BotService, conversation_analytics
+from anon_talks.storage import Storage, default_storage
+
+
+class WaitingReaper:
+    """
+    Background task, finishing searches of an opponent, which last longer than `search_timeout`.
+
+    Every `interval` seconds at most `batch_size` stale conversations are finished,
+    and their initiators are told about it through the rate-limited sender.
+    """
+
+    def __init__(self, sender: MessageSender, search_timeout: timedelta, batch_size=500, interval=60.0,
+                 on_users_changed: Callable[..., Awaitable[None]] = notify_users_changed,
+                 storage: Storage = default_storage):
+        self._sender = sender
+        self._storage = storage
+        self._search_timeout = search_timeout
+        self._batch_size = batch_size
+        self._interval = interval
+        self._on_users_changed = on_users_changed
+
+        self._task: Optional[asyncio.Task] = None
+        self.reaped_count = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._reap_forever())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def reap(self) -> int:
+        """
+        Finish a batch of stale searches and notify their users, return the count of finished searches.
+        """
+        initiators = await self._storage.finish_stale_searches(
+            created_before=datetime.now() - self._search_timeout, limit=self._batch_size,
+        )
+        if not initiators:
+            return 0
+
+        self.reaped_count += len(initiators)
+        user_ids = [user_id for user_id, __ in initiators]
+        conversation_analytics.search_stopped(*user_ids, timed_out=True)
+        await self._on_users_changed(*user_ids)
+        service = BotService(self._sender, self._storage)
+        await service.notify_search_timed_out(chat_ids=[chat_id for __, chat_id in initiators])
+        return len(initiators)
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                count = await self.reap()
+            except Exception:
+                logging.exception('Reaping of stale searches failed.')
+            else:
+                if count:
+                    logging.info(f'{count} stale searches are finished, {self.reaped_count} in total.')
@@ -0,0 +1,52 @@
+from typing import Optional
+
+import ujson
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.types.reply_keyboard import KeyboardButton, ReplyKeyboardMarkup
+from aiohttp import web
+
+
+class StaticReply:
+    """
+    Reply with static text, parse mode and keyboard, serialized once.
+
+    The keyboard is kept as JSON, which is sent as is, and the webhook response
+    is the chat id, put between pre-encoded parts of its JSON body.
+    """
+    __slots__ = ('text', 'parse_mode', 'reply_markup', '_body_head', '_body_tail')
+
+    def __init__(self, text: str, parse_mode: Optional[str] = None, keyboard: Optional[ReplyKeyboardMarkup] = None):
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = ujson.dumps(keyboard.to_python(), ensure_ascii=False) if keyboard else None
+
+        params = {'text': text, 'parse_mode': parse_mode, 'reply_markup': self.reply_markup}
+        params = {key: value for key, value in params.items() if value is not None}
+        params_json = ujson.dumps(params, ensure_ascii=False)
+        self._body_head = f'{{"method":"{SendMessage.method}","chat_id":'.encode()
+        self._body_tail = f',{params_json[1:]}'.encode()
+
+    def encode(self, chat_id: int) -> bytes:
+        return b'%s%d%s' % (self._body_head, chat_id, self._body_tail)
+
+    def to(self, chat_id: int) -> 'StaticSendMessage':
+        return StaticSendMessage(chat_id, self)
+
+
+class StaticSendMessage(SendMessage):
+    """
+    Webhook response with a static reply, rendered from its pre-encoded body.
+    """
+
+    def __init__(self, chat_id: int, reply: StaticReply):
+        super().__init__(chat_id, reply.text, parse_mode=reply.parse_mode, reply_markup=reply.reply_markup)
+        self.reply = reply
+
+    def get_web_response(self) -> web.Response:
+        return web.Response(body=self.reply.encode(self.chat_id), content_type='application/json')
+
+
+def make_keyboard(*buttons: str) -> ReplyKeyboardMarkup:
+    markup = ReplyKeyboardMarkup(row_width=1)
+    markup.add(*(KeyboardButton(button) for button in buttons))
+    return markup
@@ -0,0 +1,42 @@
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+
+class Route(NamedTuple):
+    conversation_id: int
+    opponent_id: int
+    opponent_chat_id: int
+
+
+class ConversationRoutes:
+    """
+    Routing table of conversations in progress, maps a participant to the chat of the opponent.
+
+    Routes are added when users are paired and removed when the conversation is finished.
+    On a miss, e.g. after a restart, the route is looked up by `loader` coroutine and remembered.
+    """
+
+    def __init__(self, loader: Callable[[int], Awaitable[Optional[Route]]]):
+        self._loader = loader
+        self._routes: Dict[int, Route] = {}
+
+    def __len__(self):
+        return len(self._routes)
+
+    async def get(self, user_id: int) -> Optional[Route]:
+        route = self._routes.get(user_id)
+        if route is None:
+            route = await self._loader(user_id)
+            if route:
+                self._routes[user_id] = route
+        return route
+
+    def add(self, conversation_id: int, user, opponent):
+        self._routes[user.pk] = Route(conversation_id, opponent.pk, opponent.tg_chat_id)
+        self._routes[opponent.pk] = Route(conversation_id, user.pk, user.tg_chat_id)
+
+    def remove(self, *user_ids: int):
+        for user_id in user_ids:
+            self._routes.pop(user_id, None)
+
+    def clear(self):
+        self._routes.clear()
@@ -0,0 +1,232 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram.bot import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+
+class TokenBucket:
+    """
+    Rate limiter, allowing `rate` actions per second on average, with bursts of at most `capacity` actions.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def time_to_token(self, now: float) -> float:
+        """
+        Return how many seconds to wait until an action is allowed.
+        """
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+    def time_to_full(self, now: float) -> float:
+        self._refill(now)
+        return (self._capacity - self._tokens) / self._rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self._tokens -= 1
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+
+class _Job:
+    __slots__ = ('method', 'args', 'kwargs', 'priority', 'future', 'attempts')
+
+    def __init__(self, method: str, args: tuple, kwargs: dict, priority: int, future: asyncio.Future):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+
+class _ChatQueue:
+    __slots__ = ('jobs', 'bucket')
+
+    def __init__(self, bucket: TokenBucket):
+        self.jobs: Deque[_Job] = deque()  # the first job is the one being scheduled or sent
+        self.bucket = bucket  # outlives the queue, until it's full again
+
+
+class MessageSender:
+    """
+    Scheduler of outgoing Telegram API calls, which respects the rate limits of Telegram.
+
+    The global and per chat limits are enforced by token buckets. Calls to a chat are made one by one,
+    in the order they were requested, while different chats are served concurrently.
+    Among chats, that are ready to be sent to, calls with higher priority go first.
+    Calls, rejected by flood control, are retried after the requested delay.
+    The bucket of a chat is kept after its queue is drained, and dropped only once it's refilled,
+    so calls, made one at a time, are limited too.
+    """
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+
+    def __init__(self, bot: Bot, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int = 3):
+        self._bot = bot
+        self._global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+
+        self._chats: Dict[int, _ChatQueue] = {}  # chats with calls to make
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._idle_buckets: List[Tuple[float, int]] = []  # heap of (full at, chat id) of drained chats
+        self._ready: List[Tuple[int, int, int]] = []  # heap of (priority, sequence number, chat id)
+        self._delayed: List[Tuple[float, int, int]] = []  # heap of (ready at, sequence number, chat id)
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    def set_global_rate(self, rate: float):
+        self._global_bucket = TokenBucket(rate=rate, capacity=rate)
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.call('send_message', chat_id, text, priority=priority, **kwargs)
+
+    async def call(self, method: str, chat_id: int, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        """
+        Schedule a call of the bot method, which sends something to the chat, and wait for its result.
+        """
+        self._ensure_started()
+
+        job = _Job(method, (chat_id, *args), kwargs, priority, asyncio.get_running_loop().create_future())
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            self._evict_buckets(time.monotonic())
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(rate=self._chat_rate, capacity=self._chat_burst)
+            chat = self._chats[chat_id] = _ChatQueue(bucket)
+
+        chat.jobs.append(job)
+        if len(chat.jobs) == 1:  # otherwise the chat is already scheduled
+            self._schedule(chat_id, chat)
+
+        return await job.future
+
+    async def close(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._dispatcher
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._chats.clear()
+        self._chat_buckets.clear()
+        self._idle_buckets.clear()
+        self._ready.clear()
+        self._delayed.clear()
+        self._dispatcher = None
+
+    def _ensure_started(self):
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch_forever())
+
+    def _schedule(self, chat_id: int, chat: _ChatQueue, delay: float = 0):
+        now = time.monotonic()
+        delay = max(delay, chat.bucket.time_to_token(now))
+        if delay > 0:
+            heapq.heappush(self._delayed, (now + delay, next(self._sequence), chat_id))
+        else:
+            heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    async def _dispatch_forever(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                __, __, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats[chat_id]
+                heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._sequence), chat_id))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                continue
+
+            wait_time = self._global_bucket.time_to_token(now)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+                continue
+
+            __, __, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            self._global_bucket.take(now)
+            chat.bucket.take(now)
+
+            task = asyncio.create_task(self._send(chat_id, chat, chat.jobs[0]))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, chat_id: int, chat: _ChatQueue, job: _Job):
+        try:
+            result = await getattr(self._bot, job.method)(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            job.attempts += 1
+            if job.attempts <= self._max_retries:
+                logging.warning(f'Flood control exceeded for chat {chat_id}, retry in {e.timeout} seconds.')
+                self._schedule(chat_id, chat, delay=e.timeout)
+                return
+            self._resolve(job, exception=e)
+        except Exception as e:
+            self._resolve(job, exception=e)
+        else:
+            self._resolve(job, result=result)
+
+        chat.jobs.popleft()
+        if chat.jobs:
+            self._schedule(chat_id, chat)
+        else:
+            del self._chats[chat_id]
+            now = time.monotonic()
+            heapq.heappush(self._idle_buckets, (now + chat.bucket.time_to_full(now), chat_id))
+
+    def _evict_buckets(self, now: float):
+        while self._idle_buckets and self._idle_buckets[0][0] <= now:
+            __, chat_id = heapq.heappop(self._idle_buckets)
+            bucket = self._chat_buckets.get(chat_id)
+            # a chat, which got calls since, is pushed again, when it's drained:
+            if bucket is None or chat_id in self._chats:
+                continue
+            full_at = now + bucket.time_to_full(now)
+            if full_at > now:
+                heapq.heappush(self._idle_buckets, (full_at, chat_id))
+            else:
+                del self._chat_buckets[chat_id]
+
+    @staticmethod
+    def _resolve(job: _Job, result=None, exception: Exception = None):
+        if job.future.done():  # the caller doesn't wait for it anymore
+            return
+        if exception:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
@@ -1,12 +1,27 @@
 import asyncio
-from typing import Optional
+import logging
+from functools import partial
+from typing import List, Optional
 
-from aiogram.bot import Bot
-from aiogram.types.message import Message
-from aiogram.types.reply_keyboard import ReplyKeyboardMarkup, KeyboardButton
-from tortoise.exceptions import DoesNotExist
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.types.input_media import InputMedia, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from aiogram.types.message import ContentType, Message
 
-from anon_talks.models import Conversation, TelegramUser
+from anon_talks import config
+from anon_talks.analytics import ConversationAnalytics
+from anon_talks.matchmaking import parse_tags
+from anon_talks.media_groups import MediaGroupCollector
+from anon_talks.models import TelegramUser
+from anon_talks.replies import StaticReply, make_keyboard
+from anon_talks.sender import MessageSender
+from anon_talks.storage import Storage, default_storage
+
+
+media_groups = MediaGroupCollector(delay=config.MEDIA_GROUP_DELAY)
+conversation_analytics = ConversationAnalytics(
+    rollup_interval=config.ANALYTICS_ROLLUP_INTERVAL,
+    forget_after=config.ANALYTICS_FORGET_AFTER * 60,
+)
 
 
 class BotService:
@@ -21,30 +36,75 @@ class BotService:
     )
     HELP_TEXT = (
         "Приветствую!\n\n"
-        "Чтобы начать ознакомление с ботом, введите комманду /start."
+        "Чтобы начать ознакомление с ботом, введите комманду /start.\n"
+        "Чтобы искать собеседников по интересам, задайте теги, например: /tags музыка, кино"
     )
+    TAGS_TEXT = "Теги поиска: {tags}. Сначала ищем собеседников с общими тегами."
+
+    INPUT_MEDIA_TYPES = {
+        ContentType.PHOTO: InputMediaPhoto,
+        ContentType.VIDEO: InputMediaVideo,
+        ContentType.DOCUMENT: InputMediaDocument,
+        ContentType.AUDIO: InputMediaAudio,
+    }
 
     START_CONVERSATION_BTN = "[Искать собеседника]"
     CANCEL_WAITING_OPPONENT_BTN = "[Остановить]"
     COMPLETE_CONVERSATION_BTN = "[Отключиться]"
 
-    def __init__(self, bot: Bot):
-        self._bot = bot
-
-    async def register_user(self, user_id: int, chat_id: int) -> TelegramUser:
-        user, is_created = await TelegramUser.get_or_create(tg_id=user_id, defaults={'tg_chat_id': chat_id})
-        if is_created:
-            keyboard = self.get_menu_keyboard()
-        else:
-            keyboard = None
-
-        await self._bot.send_message(chat_id, self.START_TEXT, parse_mode=self.MARKDOWN_MODE, reply_markup=keyboard)
-        return user
-
-    async def handle_message(self, message: Message):
-        user = await self.authenticate_user(user_id=message.from_user.id, chat_id=message.chat.id)
+    # static replies are serialized once, not on every send:
+    MENU_KEYBOARD = make_keyboard(START_CONVERSATION_BTN)
+    CANCEL_WAITING_OPPONENT_KEYBOARD = make_keyboard(CANCEL_WAITING_OPPONENT_BTN)
+    END_CONVERSATION_KEYBOARD = make_keyboard(COMPLETE_CONVERSATION_BTN)
+
+    START_REPLY = StaticReply(START_TEXT, MARKDOWN_MODE)
+    START_NEW_USER_REPLY = StaticReply(START_TEXT, MARKDOWN_MODE, MENU_KEYBOARD)
+    HELP_REPLY = StaticReply(HELP_TEXT)
+    NOT_REGISTERED_REPLY = StaticReply("Пожалуйста, введите комманду /start, чтобы начать.")
+    SEARCHING_REPLY = StaticReply("Ищем свободного собеседника...", keyboard=CANCEL_WAITING_OPPONENT_KEYBOARD)
+    OPPONENT_FOUND_REPLY = StaticReply("*Собеседник найден \\- общайтесь*", MARKDOWN_MODE, END_CONVERSATION_KEYBOARD)
+    SEARCH_TIMED_OUT_REPLY = StaticReply(
+        "*Собеседник не найден, поиск остановлен\\.* Попробуйте позже\\.", MARKDOWN_MODE, MENU_KEYBOARD,
+    )
+    TAGS_CLEARED_REPLY = StaticReply("Теги поиска удалены, ищем любого собеседника.")
+    SEARCH_CANCELLED_REPLY = StaticReply("*Поиск отменён\\.*", MARKDOWN_MODE, MENU_KEYBOARD)
+    USER_FINISHED_REPLY = StaticReply("*Вы завершили чат\\.*", MARKDOWN_MODE, MENU_KEYBOARD)
+    OPPONENT_FINISHED_REPLY = StaticReply("*Собеседник завершил чат\\.*", MARKDOWN_MODE, MENU_KEYBOARD)
+    CONVERSATION_NOT_FOUND_REPLY = StaticReply("*Чат уже завершён\\.*", MARKDOWN_MODE, MENU_KEYBOARD)
+
+    def __init__(self, sender: MessageSender, storage: Storage = default_storage):
+        self._sender = sender
+        self._storage = storage
+
+    async def register_user(self, user_id: int, chat_id: int) -> SendMessage:
+        user, is_created = await self._storage.register_user(tg_id=user_id, chat_id=chat_id)
+        reply = self.START_NEW_USER_REPLY if is_created else self.START_REPLY
+        return reply.to(chat_id)
+
+    async def set_tags(self, user_id: int, chat_id: int, text: str) -> SendMessage:
+        """
+        Set tags of the user, to be paired with opponents by them in next searches, or clear them by empty text.
+        """
+        user = await self.authenticate_user(user_id=user_id)
         if not user:
-            return
+            return self.NOT_REGISTERED_REPLY.to(chat_id)
+
+        tags = parse_tags(text, max_count=config.MAX_TAGS, max_length=config.TAG_MAX_LENGTH)
+        await self._storage.set_tags(user, tags)
+        if not tags:
+            return self.TAGS_CLEARED_REPLY.to(chat_id)
+        return SendMessage(chat_id, self.TAGS_TEXT.format(tags=', '.join(tags)))
+
+    async def handle_message(self, message: Message) -> Optional[SendMessage]:
+        """
+        Handle a message of the user, depending on the user status.
+
+        The reply to the user is returned, to be sent as the webhook response,
+        while messages to other users are sent by API calls.
+        """
+        user = await self.authenticate_user(user_id=message.from_user.id)
+        if not user:
+            return self.NOT_REGISTERED_REPLY.to(message.chat.id)
 
         handlers_mapping = {
             TelegramUser.Status.IN_MENU: self.handle_in_menu,
@@ -52,88 +112,89 @@ class BotService:
             TelegramUser.Status.IN_CONVERSATION: self.handle_in_conversation,
         }
         handler = handlers_mapping[user.status]
-        await handler(message, user)
+        return await handler(message, user)
 
-    async def authenticate_user(self, user_id: int, chat_id: int) -> Optional[TelegramUser]:
-        try:
-            return await TelegramUser.get(tg_id=user_id)
-        except DoesNotExist:
-            await self._bot.send_message(chat_id, "Пожалуйста, введите комманду /start, чтобы начать.")
-            return None
+    async def authenticate_user(self, user_id: int) -> Optional[TelegramUser]:
+        return await self._storage.get_user(tg_id=user_id)
 
-    async def handle_in_menu(self, message: Message, user: TelegramUser):
+    async def handle_in_menu(self, message: Message, user: TelegramUser) -> Optional[SendMessage]:
         if message.text == self.START_CONVERSATION_BTN:
-            conversation = await Conversation.start(user=user)
-            bot = self._bot
-            if conversation.opponent:
-                message_text = "*Собеседник найден \\- общайтесь*"
-                end_conversation_keyboard = self.get_end_conversation_keyboard()
-                coros = [
-                    bot.send_message(
-                        user.tg_chat_id, message_text,
-                        reply_markup=end_conversation_keyboard, parse_mode=self.MARKDOWN_MODE,
-                    )
-                    for user in (conversation.initiator, conversation.opponent)
-                ]
-                await asyncio.gather(*coros)
-            else:
-                await bot.send_message(
-                    conversation.initiator.tg_chat_id, "Ищем свободного собеседника...",
-                    reply_markup=self.get_cancel_waiting_opponent_keyboard(),
+            opponent = await self._storage.start_conversation(user)
+            if opponent:
+                if conversation_analytics.is_started:
+                    route = await self._storage.get_route(user.pk)
+                    conversation_analytics.conversation_started(route.conversation_id, initiator_id=opponent.pk)
+                await self.send_reply(
+                    opponent.tg_chat_id, self.OPPONENT_FOUND_REPLY, priority=MessageSender.PRIORITY_HIGH,
                 )
-
-    async def handle_waiting_opponent(self, message: Message, user: TelegramUser):
+                return self.OPPONENT_FOUND_REPLY.to(user.tg_chat_id)
+
+            conversation_analytics.search_started(user.pk)
+            return self.SEARCHING_REPLY.to(user.tg_chat_id)
+
+    async def notify_search_timed_out(self, chat_ids: List[int]):
+        """
+        Tell the users, that their search of an opponent is stopped by timeout.
+        """
+        results = await asyncio.gather(*(
+            self.send_reply(chat_id, self.SEARCH_TIMED_OUT_REPLY) for chat_id in chat_ids
+        ), return_exceptions=True)
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                logging.warning(f'Failed to notify chat {chat_id} about search timeout: {result!r}')
+
+    async def handle_waiting_opponent(self, message: Message, user: TelegramUser) -> Optional[SendMessage]:
         if message.text == self.CANCEL_WAITING_OPPONENT_BTN:
-            chats = (Conversation
-                     .waiting_opponent()
-                     .select_related('initiator')
-                     .order_by('-id')
-                     .filter(initiator_id=user.pk))
-            chat = await chats.first()
-            await chat.finish()
-            message_text = "*Поиск отменён\\.*"
-            await self._bot.send_message(
-                user.tg_chat_id, message_text, parse_mode=self.MARKDOWN_MODE, reply_markup=self.get_menu_keyboard(),
-            )
-
-    async def handle_in_conversation(self, message: Message, user: TelegramUser):
-        conversation_qs = (Conversation
-                           .with_user_participant(user)
-                           .filter(opponent_id__isnull=False, finished_at__isnull=True)
-                           .select_related('initiator', 'opponent')
-                           .order_by('-id'))
-        conversation = await conversation_qs.first()
-        opponent = conversation.get_opponent(user)
+            if await self._storage.cancel_search(user):
+                conversation_analytics.search_stopped(user.pk)
+            return self.SEARCH_CANCELLED_REPLY.to(user.tg_chat_id)
+
+    async def handle_in_conversation(self, message: Message, user: TelegramUser) -> Optional[SendMessage]:
+        route = await self._storage.get_route(user.pk)
+        if route is None:
+            # the conversation is finished, while the status of the user was read:
+            await self._storage.return_to_menu(user)
+            return self.CONVERSATION_NOT_FOUND_REPLY.to(user.tg_chat_id)
+
+        if message.media_group_id:
+            conversation_analytics.message_relayed(route.conversation_id)
+            media_groups.add(message, callback=partial(self.relay_media_group, route.opponent_chat_id))
+            return
+        # albums, sent before the message, go first:
+        await media_groups.flush_chat(message.chat.id)
 
         if message.text == self.COMPLETE_CONVERSATION_BTN:
-            await conversation.finish()
+            await self._storage.finish_conversation(route.conversation_id, (user.pk, route.opponent_id))
+            conversation_analytics.conversation_finished(route.conversation_id, user_id=user.pk)
 
-            user_text = "*Вы завершили чат\\.*"
-            opponent_text = "*Собеседник завершил чат\\.*"
+            await self.send_reply(
+                route.opponent_chat_id, self.OPPONENT_FINISHED_REPLY, priority=MessageSender.PRIORITY_HIGH,
+            )
+            return self.USER_FINISHED_REPLY.to(user.tg_chat_id)
 
-            menu_keyboard = self.get_menu_keyboard()
-            coros = [
-                self._bot.send_message(chat_id, text, reply_markup=menu_keyboard, parse_mode=self.MARKDOWN_MODE)
-                for chat_id, text in [(user.tg_chat_id, user_text), (opponent.tg_chat_id, opponent_text)]
-            ]
-            await asyncio.gather(*coros)
+        conversation_analytics.message_relayed(route.conversation_id)
+        if message.text:
+            await self._sender.send_message(route.opponent_chat_id, message.text)
         else:
-            await self._bot.send_message(opponent.tg_chat_id, message.text)
+            # media is sent by its file_id on the servers of Telegram, never downloaded by the bot:
+            await self._sender.call('copy_message', route.opponent_chat_id, message.chat.id, message.message_id)
 
-    @classmethod
-    def get_menu_keyboard(cls):
-        markup = ReplyKeyboardMarkup(row_width=1)
-        markup.add(KeyboardButton(str(cls.START_CONVERSATION_BTN)))
-        return markup
+    async def send_reply(self, chat_id: int, reply: StaticReply, priority: int = MessageSender.PRIORITY_NORMAL):
+        await self._sender.send_message(
+            chat_id, reply.text, priority=priority, parse_mode=reply.parse_mode, reply_markup=reply.reply_markup,
+        )
 
-    @classmethod
-    def get_cancel_waiting_opponent_keyboard(cls):
-        markup = ReplyKeyboardMarkup(row_width=1)
-        markup.add(KeyboardButton(str(cls.CANCEL_WAITING_OPPONENT_BTN)))
-        return markup
+    async def relay_media_group(self, chat_id: int, messages: List[Message]):
+        await self._sender.call('send_media_group', chat_id, [self.get_input_media(message) for message in messages])
 
     @classmethod
-    def get_end_conversation_keyboard(cls):
-        markup = ReplyKeyboardMarkup(row_width=1)
-        markup.add(KeyboardButton(str(cls.COMPLETE_CONVERSATION_BTN)))
-        return markup
+    def get_input_media(cls, message: Message) -> InputMedia:
+        """
+        Describe the media of the message by its file_id, to send it again without uploading.
+        """
+        if message.content_type == ContentType.PHOTO:
+            file_id = message.photo[-1].file_id  # the largest size
+        else:
+            file_id = getattr(message, message.content_type).file_id
+        input_media_type = cls.INPUT_MEDIA_TYPES[message.content_type]
+        return input_media_type(file_id, caption=message.caption, caption_entities=message.caption_entities or None)
@@ -0,0 +1,610 @@
+import abc
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from tortoise.transactions import in_transaction
+
+from anon_talks import config
+from anon_talks.journal import Journal
+from anon_talks.matchmaking import Matchmaker
+from anon_talks.models import (
+    ArchivedConversation, Conversation, TelegramUser, conversation_routes, matchmaker, notify_users_changed, split_tags,
+    to_naive, user_cache,
+)
+from anon_talks.routing import Route
+
+
+class Storage(abc.ABC):
+    """
+    State of the bot: users, their searches of an opponent and conversations.
+
+    Users are returned as objects with `pk`, `tg_id`, `tg_chat_id`, `status` and `tags` attributes,
+    like `TelegramUser`. Changes of the state are made by the storage, which keeps the statuses of the users
+    it has returned up to date.
+    """
+
+    async def load(self):
+        """
+        Load the state, needed by the first updates.
+        """
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def get_user(self, tg_id: int):
+        """
+        Return the user by the telegram user id, or None if the user is not registered.
+        """
+
+    @abc.abstractmethod
+    async def register_user(self, tg_id: int, chat_id: int) -> Tuple[object, bool]:
+        """
+        Get or create the user, return it and whether it's created. A user, who blocked the bot, is unblocked.
+        """
+
+    @abc.abstractmethod
+    async def set_tags(self, user, tags: Sequence[str]):
+        pass
+
+    @abc.abstractmethod
+    async def start_conversation(self, user, tags: Optional[Sequence[str]] = None):
+        """
+        Pair the user with a waiting user or make it wait for an opponent, return the opponent if it's found.
+
+        The search is by the given tags, the tags of the user by default.
+        """
+
+    @abc.abstractmethod
+    async def cancel_search(self, user) -> bool:
+        """
+        Stop the search of an opponent by the user, return whether there was one.
+        """
+
+    @abc.abstractmethod
+    async def get_route(self, user_id: int) -> Optional[Route]:
+        """
+        Look up the conversation of the user in progress and the opponent in it.
+        """
+
+    @abc.abstractmethod
+    async def finish_conversation(self, conversation_id: int, member_ids: Sequence[int]):
+        """
+        Finish the conversation and return its members to the menu, if it's not finished yet.
+
+        The members are known by the route of a member, so the conversation isn't looked up.
+        """
+
+    @abc.abstractmethod
+    async def return_to_menu(self, user):
+        """
+        Return the user, who is in a conversation by the status, but has no route, to the menu.
+        """
+
+    @abc.abstractmethod
+    async def finish_stale_searches(self, created_before: datetime, limit: int) -> List[Tuple[int, int]]:
+        """
+        Stop at most `limit` searches, started before the time. Return ids and chat ids of their users.
+        """
+
+
+class TortoiseStorage(Storage):
+    """
+    Storage of the state in the database, by the models.
+    """
+
+    async def load(self):
+        await matchmaker.load()
+
+    async def get_user(self, tg_id: int) -> Optional[TelegramUser]:
+        return await TelegramUser.get_cached(tg_id=tg_id)
+
+    async def register_user(self, tg_id: int, chat_id: int) -> Tuple[TelegramUser, bool]:
+        user, is_created = await TelegramUser.get_or_create(tg_id=tg_id, defaults={'tg_chat_id': chat_id})
+        if user.blocked_at:  # the user has restarted the bot
+            user.blocked_at = None
+            await user.save(update_fields=('blocked_at', 'modified_at'))
+        user_cache.put(user)
+        return user, is_created
+
+    async def set_tags(self, user: TelegramUser, tags: Sequence[str]):
+        await user.set_tags(tags)
+
+    async def start_conversation(self, user: TelegramUser, tags: Optional[Sequence[str]] = None):
+        conversation = await Conversation.start(user=user, tags=tags)
+        return conversation.initiator if conversation.opponent else None
+
+    async def cancel_search(self, user: TelegramUser) -> bool:
+        conversation = await (Conversation
+                              .waiting_opponent()
+                              .select_related('initiator')
+                              .order_by('-id')
+                              .filter(initiator_id=user.pk)
+                              .first())
+        if conversation is None:
+            return False
+        await conversation.finish()
+        return True
+
+    async def get_route(self, user_id: int) -> Optional[Route]:
+        return await conversation_routes.get(user_id)
+
+    async def finish_conversation(self, conversation_id: int, member_ids: Sequence[int]):
+        await Conversation.finish_by_id(conversation_id, member_ids)
+
+    async def return_to_menu(self, user: TelegramUser):
+        if await conversation_routes.get(user.pk):
+            return
+        # the status is checked by the statement, the user may have started a search since it's read:
+        updated_count = await (TelegramUser
+                               .filter(id=user.pk, status=TelegramUser.Status.IN_CONVERSATION)
+                               .update(status=TelegramUser.Status.IN_MENU))
+        if updated_count:
+            user.status = TelegramUser.Status.IN_MENU
+        user_cache.invalidate(user.pk)
+        await notify_users_changed(user.pk)
+
+    async def finish_stale_searches(self, created_before: datetime, limit: int) -> List[Tuple[int, int]]:
+        return await Conversation.finish_stale_waiting(created_before=created_before, limit=limit)
+
+
+class MemoryUser:
+    __slots__ = ('pk', 'tg_id', 'tg_chat_id', 'status', 'tags', 'blocked_at')
+
+    def __init__(self, pk: int, tg_id: int, tg_chat_id: int):
+        self.pk = pk
+        self.tg_id = tg_id
+        self.tg_chat_id = tg_chat_id
+        self.status = TelegramUser.Status.IN_MENU
+        self.tags = ''
+        self.blocked_at = None
+
+    @classmethod
+    def from_model(cls, user: TelegramUser) -> 'MemoryUser':
+        memory_user = cls(user.pk, user.tg_id, user.tg_chat_id)
+        memory_user.status = user.status
+        memory_user.tags = user.tags
+        memory_user.blocked_at = user.blocked_at
+        return memory_user
+
+    def get_tags(self) -> Tuple[str, ...]:
+        return split_tags(self.tags)
+
+
+class _MemoryConversation:
+    __slots__ = ('pk', 'initiator_id', 'opponent_id', 'tags', 'created_at')
+
+    def __init__(self, pk: int, initiator_id: int, tags: Sequence[str]):
+        self.pk = pk
+        self.initiator_id = initiator_id
+        self.opponent_id: Optional[int] = None
+        self.tags = tags
+        self.created_at = datetime.now()
+
+
+class MemoryStorage(Storage):
+    """
+    Storage of the state in memory of the process, with the same semantics as `TortoiseStorage`.
+
+    It's for tests and a single process, running without a database: the state is lost on restart.
+    Finished conversations are not kept, except the recent opponents, known by the matchmaker.
+    Every transition is passed to `_record`, which subclasses use to persist it.
+    """
+
+    def __init__(self, recent_timeout: timedelta, widen_after: timedelta):
+        self._users: Dict[int, MemoryUser] = {}  # by telegram user id
+        self._users_by_pk: Dict[int, MemoryUser] = {}
+        self._conversations: Dict[int, _MemoryConversation] = {}  # not finished ones
+        self._user_conversations: Dict[int, int] = {}  # user id -> id of the not finished conversation of the user
+        self._waiting: 'OrderedDict[int, _MemoryConversation]' = OrderedDict()  # by the start of the search
+        self._user_ids = itertools.count(1)
+        self._conversation_ids = itertools.count(1)
+        self._matchmaker = Matchmaker(
+            loader=self._load_matchmaking, recent_timeout=recent_timeout, widen_after=widen_after,
+        )
+
+    async def get_user(self, tg_id: int) -> Optional[MemoryUser]:
+        return self._users.get(tg_id)
+
+    async def register_user(self, tg_id: int, chat_id: int) -> Tuple[MemoryUser, bool]:
+        user = self._users.get(tg_id)
+        if user:
+            user.blocked_at = None
+            return user, False
+
+        user = MemoryUser(next(self._user_ids), tg_id, chat_id)
+        self._add_user(user)
+        return user, True
+
+    async def set_tags(self, user: MemoryUser, tags: Sequence[str]):
+        previous_tags, user.tags = user.tags, ','.join(tags)
+
+        async def undo():
+            user.tags = previous_tags
+
+        await self._record_or_undo(undo, 'tags', user_id=user.pk, tags=list(tags))
+
+    async def start_conversation(self, user: MemoryUser, tags: Optional[Sequence[str]] = None):
+        tags = user.get_tags() if tags is None else tuple(tags)
+        conversation_id = await self._matchmaker.pop_match(user.pk, tags)
+        if conversation_id:
+            conversation = self._waiting.pop(conversation_id)
+            conversation.opponent_id = user.pk
+            self._user_conversations[user.pk] = conversation.pk
+            initiator = self._users_by_pk[conversation.initiator_id]
+            statuses = initiator.status, user.status
+            initiator.status = user.status = TelegramUser.Status.IN_CONVERSATION
+
+            async def undo_pair():
+                conversation.opponent_id = None
+                del self._user_conversations[user.pk]
+                self._restore_conversation(conversation)
+                initiator.status, user.status = statuses
+                await self._matchmaker.enqueue(conversation.pk, initiator.pk, conversation.tags)
+
+            await self._record_or_undo(undo_pair, 'pair', conversation_id=conversation.pk,
+                                       member_ids=[initiator.pk, user.pk], at=datetime.now().isoformat())
+            return initiator
+
+        conversation = _MemoryConversation(next(self._conversation_ids), user.pk, tags)
+        self._add_conversation(conversation)
+        status, user.status = user.status, TelegramUser.Status.WAITING_OPPONENT
+        await self._matchmaker.enqueue(conversation.pk, user.pk, tags)
+
+        async def undo_start():
+            self._remove_conversation(conversation)
+            user.status = status
+            await self._matchmaker.discard(conversation.pk)
+
+        await self._record_or_undo(undo_start, 'start', conversation_id=conversation.pk, user_id=user.pk,
+                                   tags=list(tags), at=conversation.created_at.isoformat())
+        return None
+
+    async def cancel_search(self, user: MemoryUser) -> bool:
+        conversation = self._conversations.get(self._user_conversations.get(user.pk))
+        if conversation is None or conversation.opponent_id:
+            return False
+        await self._finish(conversation)
+        return True
+
+    async def get_route(self, user_id: int) -> Optional[Route]:
+        conversation = self._conversations.get(self._user_conversations.get(user_id))
+        if conversation is None or not conversation.opponent_id:
+            return None
+        opponent_id = conversation.opponent_id if user_id == conversation.initiator_id else conversation.initiator_id
+        return Route(conversation.pk, opponent_id, self._users_by_pk[opponent_id].tg_chat_id)
+
+    async def finish_conversation(self, conversation_id: int, member_ids: Sequence[int]):
+        conversation = self._conversations.get(conversation_id)
+        if conversation:
+            await self._finish(conversation)
+
+    async def return_to_menu(self, user: MemoryUser):
+        if user.status != TelegramUser.Status.IN_CONVERSATION or user.pk in self._user_conversations:
+            return
+        user.status = TelegramUser.Status.IN_MENU
+
+        async def undo():
+            user.status = TelegramUser.Status.IN_CONVERSATION
+
+        await self._record_or_undo(undo, 'menu', user_id=user.pk)
+
+    async def finish_stale_searches(self, created_before: datetime, limit: int) -> List[Tuple[int, int]]:
+        stale = []
+        for conversation in self._waiting.values():
+            if conversation.created_at >= created_before or len(stale) == limit:
+                break
+            stale.append(conversation)
+
+        # the searches are finished in memory at once, while their records are persisted together:
+        await asyncio.gather(*(self._finish(conversation) for conversation in stale))
+        return [(conversation.initiator_id, self._users_by_pk[conversation.initiator_id].tg_chat_id)
+                for conversation in stale]
+
+    async def _finish(self, conversation: _MemoryConversation):
+        self._remove_conversation(conversation)
+        member_ids = [conversation.initiator_id]
+        if conversation.opponent_id:
+            member_ids.append(conversation.opponent_id)
+        statuses = [(self._users_by_pk[user_id], self._users_by_pk[user_id].status) for user_id in member_ids]
+        for user, __ in statuses:
+            user.status = TelegramUser.Status.IN_MENU
+
+        finished_at = datetime.now()
+        await self._matchmaker.discard(conversation.pk)
+        if conversation.opponent_id:
+            await self._matchmaker.remember_opponents(conversation.initiator_id, conversation.opponent_id, finished_at)
+
+        async def undo():
+            self._restore_conversation(conversation)
+            for user, status in statuses:
+                user.status = status
+            # the opponents stay remembered, which only defers pairing them again:
+            if not conversation.opponent_id:
+                await self._matchmaker.enqueue(conversation.pk, conversation.initiator_id, conversation.tags)
+
+        await self._record_or_undo(undo, 'finish', conversation_id=conversation.pk, member_ids=member_ids,
+                                   at=finished_at.isoformat())
+
+    def _add_user(self, user: MemoryUser):
+        self._users[user.tg_id] = self._users_by_pk[user.pk] = user
+
+    def _add_conversation(self, conversation: _MemoryConversation):
+        self._conversations[conversation.pk] = conversation
+        if not conversation.opponent_id:
+            self._waiting[conversation.pk] = conversation
+        for user_id in (conversation.initiator_id, conversation.opponent_id):
+            if user_id:
+                self._user_conversations[user_id] = conversation.pk
+
+    def _restore_conversation(self, conversation: _MemoryConversation):
+        self._add_conversation(conversation)
+        if not conversation.opponent_id:
+            # the search is put back to its place among the ones, started after it:
+            for conversation_id in [pk for pk, waiting in self._waiting.items()
+                                    if waiting.created_at > conversation.created_at]:
+                self._waiting.move_to_end(conversation_id)
+
+    def _remove_conversation(self, conversation: _MemoryConversation):
+        del self._conversations[conversation.pk]
+        self._waiting.pop(conversation.pk, None)
+        for user_id in (conversation.initiator_id, conversation.opponent_id):
+            if user_id:
+                del self._user_conversations[user_id]
+
+    async def _record_or_undo(self, undo: Callable[[], Awaitable[None]], operation: str, **data):
+        """
+        Record the transition, just applied to the state, or undo it, if it's not persisted.
+        """
+        try:
+            await self._record(operation, **data)
+        except asyncio.CancelledError:
+            raise  # the record may be persisted still
+        except Exception:
+            await undo()
+            raise
+
+    async def _record(self, operation: str, **data):
+        """
+        Persist the transition, just applied to the state. The order of calls is the order of transitions,
+        the ones, which fail together, fail in the reverse order, so they're undone in it.
+        """
+
+    async def _load_matchmaking(self):
+        return [], []
+
+
+class WriteBehindStorage(MemoryStorage):
+    """
+    Storage of the state in memory, persisted to the database behind the updates.
+
+    A transition is applied in memory and appended to the journal on the local disk, it's acknowledged,
+    once the journal entry is durable. Journaled transitions are applied to the database in batches
+    by a background task, entries, not applied before a crash, are replayed on `load`.
+    Users are read from the database and kept in memory, conversations in progress are loaded on `load`.
+    Least recently used users over `max_users` are dropped, if they may be read from the database again:
+    ones in the menu, with all their transitions flushed.
+    It's for a single process, the state in the database is behind it by the flush interval.
+    """
+
+    def __init__(self, recent_timeout: timedelta, widen_after: timedelta, journal: Journal,
+                 flush_interval: float, flush_batch_size: int, max_users: int):
+        super().__init__(recent_timeout=recent_timeout, widen_after=widen_after)
+        self._journal = journal
+        self._flush_interval = flush_interval  # in seconds
+        self._flush_batch_size = flush_batch_size
+        self._flusher: Optional[asyncio.Task] = None
+
+        self._max_users = max_users
+        self._users: 'OrderedDict[int, MemoryUser]' = OrderedDict()  # by telegram user id, in the order of use
+        self._user_seqs: Dict[int, int] = {}  # user id -> sequence number of the last entry of the user
+        self._flushed_seq = 0
+
+    async def load(self):
+        self._journal.open()
+        replayed_count = await self.flush()
+        if replayed_count:
+            logging.warning(f'{replayed_count} transitions, not flushed before, are replayed from the journal.')
+
+        conversations = await Conversation.filter(finished_at__isnull=True).order_by('id')
+        user_ids = {conversation.initiator_id for conversation in conversations}
+        user_ids.update(conversation.opponent_id for conversation in conversations if conversation.opponent_id)
+        for user in await TelegramUser.filter(id__in=user_ids):
+            self._add_user(MemoryUser.from_model(user))
+        for conversation in conversations:
+            memory_conversation = _MemoryConversation(
+                conversation.pk, conversation.initiator_id, split_tags(conversation.tags),
+            )
+            memory_conversation.opponent_id = conversation.opponent_id
+            memory_conversation.created_at = to_naive(conversation.created_at)
+            self._add_conversation(memory_conversation)
+
+        # ids are given in memory, after the ones in the database:
+        last_ids = await asyncio.gather(*(
+            model.all().order_by('-id').limit(1).values_list('id', flat=True)
+            for model in (Conversation, ArchivedConversation)
+        ))
+        self._conversation_ids = itertools.count(max(itertools.chain([0], *last_ids)) + 1)
+        await self._matchmaker.load()
+        self._flusher = asyncio.ensure_future(self._flush_forever())
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+        await self._journal.close()
+        await self.flush()
+
+    async def get_user(self, tg_id: int) -> Optional[MemoryUser]:
+        user = self._users.get(tg_id)
+        if user is None:
+            db_user = await TelegramUser.get_or_none(tg_id=tg_id)
+            if db_user:
+                user = MemoryUser.from_model(db_user)
+                self._add_user(user)
+        else:
+            self._users.move_to_end(tg_id)
+        return user
+
+    async def register_user(self, tg_id: int, chat_id: int) -> Tuple[MemoryUser, bool]:
+        # users are created in the database at once, the bot may be blocked by a broadcast in another process:
+        db_user, is_created = await TelegramUser.get_or_create(tg_id=tg_id, defaults={'tg_chat_id': chat_id})
+        if db_user.blocked_at:
+            db_user.blocked_at = None
+            await db_user.save(update_fields=('blocked_at', 'modified_at'))
+
+        user = self._users.get(tg_id)
+        if user is None:
+            user = MemoryUser.from_model(db_user)
+            self._add_user(user)
+        else:
+            self._users.move_to_end(tg_id)
+        user.blocked_at = None
+        return user, is_created
+
+    async def flush(self) -> int:
+        """
+        Apply the journaled transitions to the database, in transactions of a batch. Return the number of them.
+        """
+        flushed_count = 0
+        while True:
+            entries = self._journal.get_unflushed(self._flush_batch_size)
+            if not entries:
+                return flushed_count
+            await self._apply([entry for __, entry in entries])
+            self._journal.set_flushed(entries[-1][0])
+            self._flushed_seq = entries[-1][0]
+            flushed_count += len(entries)
+            self._evict_users()
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # the transitions stay in the journal, they're applied by the next flush:
+                logging.exception('Failed to flush the journal to the database.')
+
+    @staticmethod
+    async def _apply(entries: List[dict]):
+        """
+        Apply the transitions, coalesced to the last values of every row. Applying them again changes nothing.
+        """
+        started_ids = []
+        conversation_fields: Dict[int, dict] = {}
+        statuses: Dict[int, TelegramUser.Status] = {}
+        tags: Dict[int, str] = {}
+        for entry in entries:
+            operation = entry['operation']
+            if operation == 'tags':
+                tags[entry['user_id']] = ','.join(entry['tags'])
+                continue
+            if operation == 'menu':
+                statuses[entry['user_id']] = TelegramUser.Status.IN_MENU
+                continue
+
+            at = datetime.fromisoformat(entry['at'])
+            fields = conversation_fields.setdefault(entry['conversation_id'], {})
+            if operation == 'start':
+                started_ids.append(entry['conversation_id'])
+                fields.update(initiator_id=entry['user_id'], tags=','.join(entry['tags']), created_at=at)
+                statuses[entry['user_id']] = TelegramUser.Status.WAITING_OPPONENT
+            elif operation == 'pair':
+                fields['opponent_id'] = entry['member_ids'][-1]
+                statuses.update(dict.fromkeys(entry['member_ids'], TelegramUser.Status.IN_CONVERSATION))
+            elif operation == 'finish':
+                fields['finished_at'] = at
+                statuses.update(dict.fromkeys(entry['member_ids'], TelegramUser.Status.IN_MENU))
+            fields['modified_at'] = at
+
+        async with in_transaction('anon_talks') as connection:
+            existing_ids = set()
+            # an entry, replayed after the watermark is lost, may start a conversation, archived since:
+            for model in (Conversation, ArchivedConversation):
+                unknown_ids = [started_id for started_id in started_ids if started_id not in existing_ids]
+                if unknown_ids:
+                    existing_ids.update(await (model
+                                               .filter(id__in=unknown_ids)
+                                               .using_db(connection)
+                                               .values_list('id', flat=True)))
+            # conversations are created with the ids, given in memory:
+            new_ids = [conversation_id for conversation_id in started_ids if conversation_id not in existing_ids]
+            if new_ids:
+                await Conversation.bulk_create(
+                    [Conversation(id=conversation_id, **conversation_fields.pop(conversation_id))
+                     for conversation_id in new_ids],
+                    using_db=connection,
+                )
+            for conversation_id, fields in conversation_fields.items():
+                await Conversation.filter(id=conversation_id).using_db(connection).update(**fields)
+
+            for status in TelegramUser.Status:
+                user_ids = [user_id for user_id, user_status in statuses.items() if user_status == status]
+                if user_ids:
+                    await TelegramUser.filter(id__in=user_ids).using_db(connection).update(status=status)
+            for user_id, user_tags in tags.items():
+                await TelegramUser.filter(id=user_id).using_db(connection).update(tags=user_tags)
+
+            if new_ids and connection.capabilities.dialect == 'postgres':
+                # the sequence of ids is moved past the given ones, so the database may be used without the journal:
+                await connection.execute_query(
+                    "SELECT setval(pg_get_serial_sequence('conversation', 'id'), "
+                    "(SELECT MAX(id) FROM conversation))"
+                )
+
+    async def _record(self, operation: str, **data):
+        seq = self._journal.next_seq  # given to the entry by the append
+        for user_id in data.get('member_ids') or [data['user_id']]:
+            self._user_seqs[user_id] = seq
+        await self._journal.append({'operation': operation, **data})
+
+    def _add_user(self, user: MemoryUser):
+        super()._add_user(user)
+        self._evict_users()
+
+    def _evict_users(self):
+        excess_count = len(self._users) - self._max_users
+        if excess_count <= 0:
+            return
+        evicted = []
+        # the last used user, just read by an update, is kept, even if the others are all in use:
+        for user in itertools.islice(self._users.values(), len(self._users) - 1):
+            if (user.status == TelegramUser.Status.IN_MENU and user.pk not in self._user_conversations
+                    and self._user_seqs.get(user.pk, 0) <= self._flushed_seq):
+                evicted.append(user)
+                if len(evicted) == excess_count:
+                    break
+        for user in evicted:
+            del self._users[user.tg_id]
+            del self._users_by_pk[user.pk]
+            self._user_seqs.pop(user.pk, None)
+
+    async def _load_matchmaking(self):
+        return await Conversation.matchmaking_snapshot()
+
+
+def make_storage() -> Storage:
+    recent_timeout = timedelta(minutes=config.RECENT_OPPONENT_TIMEOUT)
+    widen_after = timedelta(seconds=config.TAG_WIDEN_AFTER)
+    if config.STORAGE == 'memory':
+        return MemoryStorage(recent_timeout=recent_timeout, widen_after=widen_after)
+    if config.STORAGE == 'write_behind':
+        return WriteBehindStorage(
+            recent_timeout=recent_timeout,
+            widen_after=widen_after,
+            journal=Journal(config.JOURNAL_PATH, segment_size=config.JOURNAL_SEGMENT_SIZE),
+            flush_interval=config.JOURNAL_FLUSH_INTERVAL,
+            flush_batch_size=config.JOURNAL_FLUSH_BATCH_SIZE,
+            max_users=config.WRITE_BEHIND_MAX_USERS,
+        )
+    return TortoiseStorage()
+
+
+default_storage = make_storage()
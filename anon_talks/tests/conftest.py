@@ -1,10 +1,108 @@
 import asyncio
+import itertools
+import os
 
 import pytest
+import ujson
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
 from pypika.queries import Query
 from tortoise import Tortoise
 
-from anon_talks import _sync_db
+# the bot is built, when the app modules are imported, so a token of the valid format is needed before that:
+TEST_BOT_API_TOKEN = '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+os.environ.setdefault('BOT_API_TOKEN', TEST_BOT_API_TOKEN)
+
+from anon_talks.db import sync_schemas  # noqa: E402
+from anon_talks.models import conversation_routes, matchmaker, user_cache  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL', "sqlite://:memory:")
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'postgres: races concurrent transactions, so it needs PostgreSQL')
+
+
+def pytest_runtest_setup(item):
+    if item.get_closest_marker('postgres') and not TEST_DATABASE_URL.startswith('postgres'):
+        pytest.skip('SQLite serializes transactions, set TEST_DATABASE_URL to a PostgreSQL database')
+
+
+class FakeBotAPI:
+    """
+    Local stub of Telegram Bot API: serves the given updates by getUpdates and records other calls.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.offsets = []
+        self.calls = []  # (method, params, content type of the request)
+        self.errors = {}  # chat id -> (error code, description), returned to calls to the chat
+        self.runner = None
+        self.url = None
+        self._message_ids = itertools.count(1)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle_api_call)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+    def get_calls(self, method):
+        return [params for called_method, params, __ in self.calls if called_method == method]
+
+    async def handle_api_call(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if method == 'getUpdates':
+            return await self.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)))
+
+        self.calls.append((method, params, request.content_type))
+        error = self.errors.get(int(params.get('chat_id', 0)))
+        if error:
+            return web.json_response({'ok': False, 'error_code': error[0], 'description': error[1]}, status=error[0])
+        if method == 'sendMediaGroup':
+            result = [self.make_message(params) for __ in range(len(ujson.loads(params['media'])))]
+        else:
+            result = self.make_message(params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, offset, limit):
+        self.offsets.append(offset)
+        # confirmed updates are forgotten, like Telegram does:
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            await asyncio.sleep(0.01)
+        return web.json_response({'ok': True, 'result': self.updates[:limit]})
+
+    def make_message(self, params):
+        return {
+            'message_id': next(self._message_ids),
+            'date': 0,
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+        }
+
+
+@pytest.fixture
+async def bot_api():
+    api = FakeBotAPI()
+    await api.start()
+    yield api
+    await api.close()
+
+
+@pytest.fixture
+async def api_bot(bot_api):
+    bot = Bot(token=TEST_BOT_API_TOKEN, server=TelegramAPIServer.from_base(bot_api.url))
+    yield bot
+    await bot.session.close()
 
 
 @pytest.fixture(scope='session')
@@ -14,15 +112,16 @@ def event_loop():
     loop.close()
 
 
-@pytest.fixture(scope='session', autouse=True)
-def initialize_tests(event_loop):
-    event_loop.run_until_complete(_sync_db(db_url="sqlite://:memory:"))
+@pytest.fixture(scope='session')
+def database(event_loop):
+    # the schemas are generated once, by the first test, which needs the database:
+    event_loop.run_until_complete(sync_schemas(db_url=TEST_DATABASE_URL))
     yield
     event_loop.run_until_complete(Tortoise.close_connections())
 
 
-@pytest.fixture(scope='function', autouse=True)
-async def cleanup_db_tables():
+@pytest.fixture
+async def db(database):
     yield
 
     coros = [
@@ -33,3 +132,6 @@ async def cleanup_db_tables():
         for model in app.values()
     ]
     await asyncio.gather(*coros)
+    matchmaker.reset()
+    user_cache.clear()
+    conversation_routes.clear()
@@ -0,0 +1,94 @@
+import pytest
+
+from anon_talks.analytics import ConversationAnalytics
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakePipeline:
+
+    def __init__(self):
+        self.messages = []
+
+    def put(self, text, kind, conversation_id=None, sender_id=None):
+        self.messages.append((text, conversation_id, sender_id))
+        return True
+
+
+@pytest.fixture
+def pipeline():
+    return FakePipeline()
+
+
+@pytest.fixture
+async def analytics(pipeline):
+    analytics = ConversationAnalytics(rollup_interval=3600, forget_after=600)
+    analytics.start(pipeline)
+    yield analytics
+    await analytics.close()
+
+
+class TestConversationAnalytics:
+
+    async def test_conversation_summary(self, analytics, pipeline, freezer):
+        freezer.move_to("2021-03-07 12:00")
+        analytics.conversation_started(1, initiator_id=5)
+        for __ in range(3):
+            analytics.message_relayed(1)
+        analytics.message_relayed(2)
+
+        freezer.move_to("2021-03-07 12:02")
+        analytics.conversation_finished(1, user_id=6)
+        assert pipeline.messages == [('Conversation finished: 3 messages, 120 s', 1, 'user_6')]
+
+        # the conversation is started by another process:
+        analytics.conversation_finished(2, user_id=7)
+        assert pipeline.messages[-1] == ('Conversation finished: 1 messages', 2, 'user_7')
+
+    async def test_roll_up(self, analytics, pipeline, freezer):
+        freezer.move_to("2021-03-07 12:00")
+        analytics.search_started(1)
+        analytics.search_started(2)
+        analytics.search_started(3)
+        analytics.search_started(4)
+        analytics.search_stopped(3)
+        analytics.search_stopped(4, timed_out=True)
+
+        freezer.move_to("2021-03-07 12:00:10")
+        analytics.conversation_started(10, initiator_id=1)
+        analytics.conversation_started(11, initiator_id=2)
+        analytics.conversation_started(12, initiator_id=100)  # the search is started by another process
+        analytics.roll_up()
+        assert pipeline.messages == [(
+            'Rollup: 4 searches, 3 matches, 1 cancelled, 1 timed out; waits for a match up to 5 s: 0, '
+            'up to 15 s: 2, up to 30 s: 0, up to 60 s: 0, up to 120 s: 0, up to 300 s: 0, up to 600 s: 0, '
+            'over 600 s: 0',
+            None,
+            None,
+        )]
+
+        analytics.roll_up()
+        assert len(pipeline.messages) == 1
+
+    async def test_left_counters_are_forgotten(self, analytics, pipeline, freezer):
+        freezer.move_to("2021-03-07 12:00")
+        analytics.search_started(1)
+        analytics.message_relayed(10)
+
+        freezer.move_to("2021-03-07 12:11")
+        analytics.roll_up()
+        analytics.conversation_started(11, initiator_id=1)
+        analytics.conversation_finished(10, user_id=2)
+        assert pipeline.messages[-1] == ('Conversation finished: 0 messages', 10, 'user_2')
+        analytics.roll_up()
+        assert 'up to 600 s: 0, over 600 s: 0' in pipeline.messages[-1][0]
+
+    async def test_not_started(self, pipeline):
+        analytics = ConversationAnalytics(rollup_interval=3600, forget_after=600)
+        analytics.search_started(1)
+        analytics.conversation_started(10, initiator_id=1)
+        analytics.message_relayed(10)
+        analytics.conversation_finished(10, user_id=1)
+        await analytics.close()
+        assert not analytics._conversations and not analytics._search_started_at
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from anon_talks.archive import ConversationArchiver
+from anon_talks.models import ArchivedConversation, Conversation, TelegramUser
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+@pytest.fixture
+async def users():
+    return [await TelegramUser.create(tg_id=tg_id, tg_chat_id=tg_id) for tg_id in (1, 2)]
+
+
+class TestConversationArchiver:
+
+    async def test_archive_all(self, users):
+        initiator, opponent = users
+        now = datetime.now()
+        old_conversations = [
+            await Conversation.create(
+                initiator=initiator, opponent=opponent, tags='music,movies', finished_at=now - timedelta(hours=2),
+            )
+            for __ in range(5)
+        ]
+        recent = await Conversation.create(
+            initiator=initiator, opponent=opponent, finished_at=now - timedelta(minutes=1),
+        )
+        in_progress = await Conversation.create(initiator=initiator, opponent=opponent)
+        waiting = await Conversation.create(initiator=initiator)
+
+        archiver = ConversationArchiver(archive_after=timedelta(hours=1), batch_size=2, batch_delay=0)
+        assert await archiver.archive_all() == 5
+        assert archiver.archived_count == 5
+
+        assert set(await Conversation.all().values_list('id', flat=True)) == {recent.pk, in_progress.pk, waiting.pk}
+        archived = await ArchivedConversation.all().order_by('id')
+        assert [conversation.pk for conversation in archived] == [conversation.pk for conversation in old_conversations]
+        assert archived[0].initiator_id == initiator.pk
+        assert archived[0].opponent_id == opponent.pk
+        assert archived[0].tags == 'music,movies'
+        assert archived[0].finished_at == old_conversations[0].finished_at
+
+    async def test_archive_batch_is_bounded(self, users):
+        initiator, opponent = users
+        finished_at = datetime.now() - timedelta(hours=2)
+        for __ in range(3):
+            await Conversation.create(initiator=initiator, opponent=opponent, finished_at=finished_at)
+
+        archiver = ConversationArchiver(archive_after=timedelta(hours=1), batch_size=2)
+        assert await archiver.archive_batch(finished_before=datetime.now()) == 2
+        assert await Conversation.all().count() == 1
+        assert await ArchivedConversation.all().count() == 2
+
+    async def test_throttles_batches(self, users, monkeypatch):
+        initiator, opponent = users
+        finished_at = datetime.now() - timedelta(hours=2)
+        for __ in range(5):
+            await Conversation.create(initiator=initiator, opponent=opponent, finished_at=finished_at)
+
+        delays = []
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        monkeypatch.setattr('anon_talks.archive.asyncio.sleep', sleep)
+        archiver = ConversationArchiver(archive_after=timedelta(hours=1), batch_size=2, batch_delay=0.5)
+        assert await archiver.archive_all() == 5
+        assert len(delays) == 2  # after the full batches
+        assert all(delay >= 0.5 for delay in delays)
@@ -0,0 +1,100 @@
+import pytest
+
+from anon_talks.broadcast import BroadcastCheckpoint, BroadcastProgress, Broadcaster
+from anon_talks.models import TelegramUser
+from anon_talks.sender import MessageSender
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+@pytest.fixture
+async def api_sender(api_bot):
+    sender = MessageSender(api_bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    yield sender
+    await sender.close()
+
+
+@pytest.fixture
+async def users():
+    return [await TelegramUser.create(tg_id=tg_id, tg_chat_id=tg_id * 10) for tg_id in range(1, 8)]
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    return BroadcastCheckpoint(tmp_path / 'broadcast_state.json')
+
+
+def get_chat_ids(bot_api):
+    return [int(params['chat_id']) for params in bot_api.get_calls('sendMessage')]
+
+
+class TestBroadcastCheckpoint:
+
+    def test_save_and_load(self, checkpoint):
+        assert checkpoint.load('digest').last_user_id == 0
+
+        checkpoint.save(BroadcastProgress('digest', last_user_id=5, sent_count=4, blocked_count=1))
+        progress = checkpoint.load('digest')
+        assert (progress.last_user_id, progress.sent_count, progress.blocked_count) == (5, 4, 1)
+
+        assert checkpoint.load('other digest').last_user_id == 0
+
+        checkpoint.clear()
+        checkpoint.clear()
+        assert checkpoint.load('digest').last_user_id == 0
+
+
+class TestBroadcaster:
+
+    async def test_run(self, api_sender, bot_api, users, checkpoint):
+        progress = await Broadcaster(api_sender, checkpoint, chunk_size=3).run('Maintenance', parse_mode='HTML')
+
+        assert sorted(get_chat_ids(bot_api)) == [user.tg_chat_id for user in users]
+        assert bot_api.get_calls('sendMessage')[0]['text'] == 'Maintenance'
+        assert bot_api.get_calls('sendMessage')[0]['parse_mode'] == 'HTML'
+        assert progress.sent_count == 7
+        assert not checkpoint.load(progress.digest).last_user_id
+
+    async def test_blocked_chats_are_marked_and_skipped(self, api_sender, bot_api, users, checkpoint):
+        bot_api.errors[20] = (403, 'Forbidden: bot was blocked by the user')
+        bot_api.errors[30] = (400, 'Bad Request: chat not found')
+        bot_api.errors[40] = (400, 'Bad Request: message text is empty')
+
+        progress = await Broadcaster(api_sender, checkpoint, chunk_size=3).run('Maintenance')
+        assert (progress.sent_count, progress.blocked_count, progress.failed_count) == (4, 2, 1)
+        blocked = await TelegramUser.filter(blocked_at__isnull=False).values_list('tg_chat_id', flat=True)
+        assert sorted(blocked) == [20, 30]
+
+        bot_api.calls.clear()
+        await Broadcaster(api_sender, checkpoint, chunk_size=3).run('Maintenance')
+        assert 20 not in get_chat_ids(bot_api)
+        assert 30 not in get_chat_ids(bot_api)
+        assert 40 in get_chat_ids(bot_api)
+
+    async def test_resume(self, api_sender, bot_api, users, checkpoint, monkeypatch):
+        broadcaster = Broadcaster(api_sender, checkpoint, chunk_size=3)
+        send_chunk = broadcaster._send_chunk
+        chunks = []
+
+        async def interrupted_send_chunk(chats, *args):
+            chunks.append(chats)
+            if len(chunks) == 2:
+                raise ConnectionError('the DB is gone')
+            await send_chunk(chats, *args)
+
+        monkeypatch.setattr(broadcaster, '_send_chunk', interrupted_send_chunk)
+        with pytest.raises(ConnectionError):
+            await broadcaster.run('Maintenance')
+        assert get_chat_ids(bot_api) == [10, 20, 30]
+
+        monkeypatch.undo()
+        await Broadcaster(api_sender, checkpoint, chunk_size=3).run('Maintenance')
+        assert sorted(get_chat_ids(bot_api)) == [user.tg_chat_id for user in users]
+
+    async def test_another_message_starts_over(self, api_sender, bot_api, users, checkpoint):
+        broadcaster = Broadcaster(api_sender, checkpoint)
+        checkpoint.save(BroadcastProgress('digest of another message', last_user_id=users[-2].pk))
+        await broadcaster.run('Maintenance')
+
+        assert len(get_chat_ids(bot_api)) == 7
@@ -0,0 +1,135 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from anon_talks.broker import BrokerClient, BrokerError, RemoteMatchmaker, StateBroker
+from anon_talks.matchmaking import Matchmaker
+
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+async def broker(tmp_path):
+    async def loader():
+        return [(10, 1, (), datetime.now())], []
+
+    matchmaker = Matchmaker(loader=loader, recent_timeout=timedelta(minutes=5), widen_after=timedelta(seconds=30))
+    broker = StateBroker(matchmaker=matchmaker)
+    await broker.start(path=str(tmp_path / 'broker.sock'))
+    yield broker
+    await broker.close()
+
+
+@pytest.fixture
+def broker_path(broker, tmp_path):
+    return str(tmp_path / 'broker.sock')
+
+
+@pytest.fixture
+async def make_client(broker_path):
+    clients = []
+
+    def make_client(on_event=lambda event, data: None):
+        client = BrokerClient(path=broker_path, on_event=on_event)
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        await client.close()
+
+
+class TestStateBroker:
+
+    async def test_shared_matchmaker(self, make_client):
+        matchmaker1 = RemoteMatchmaker(client=make_client())
+        matchmaker2 = RemoteMatchmaker(client=make_client())
+
+        assert await matchmaker2.pop_match(user_id=3) == 10
+        await matchmaker1.enqueue(conversation_id=11, user_id=2)
+        assert await matchmaker2.pop_match(user_id=3) == 11
+        assert await matchmaker1.pop_match(user_id=3) is None
+
+    async def test_tags(self, make_client):
+        matchmaker1 = RemoteMatchmaker(client=make_client())
+        matchmaker2 = RemoteMatchmaker(client=make_client())
+        await matchmaker1.pop_match(user_id=1)  # loads the state, skipping own conversation
+
+        await matchmaker1.enqueue(conversation_id=11, user_id=2, tags=['music'])
+        assert await matchmaker2.pop_match(user_id=3, tags=['movies', 'music']) == 11
+
+    async def test_remember_opponents(self, make_client):
+        matchmaker = RemoteMatchmaker(client=make_client())
+        await matchmaker.pop_match(user_id=1)  # loads the state, skipping own conversation
+
+        await matchmaker.remember_opponents(user_id=1, opponent_id=2, finished_at=datetime.now())
+        assert await matchmaker.pop_match(user_id=2) is None
+        assert await matchmaker.pop_match(user_id=3) == 10
+
+    async def test_concurrent_pop_match(self, make_client):
+        matchmakers = [RemoteMatchmaker(client=make_client()) for __ in range(5)]
+        await matchmakers[0].pop_match(user_id=1)  # loads the state, skipping own conversation
+        for conversation_id in range(11, 20):
+            await matchmakers[0].enqueue(conversation_id=conversation_id, user_id=conversation_id)
+
+        results = await asyncio.gather(*(
+            matchmakers[user_id % 5].pop_match(user_id=user_id) for user_id in range(100, 150)
+        ))
+        matched = [conversation_id for conversation_id in results if conversation_id]
+        assert sorted(matched) == list(range(10, 20))
+
+    async def test_reserved_search(self, make_client):
+        matchmaker1 = RemoteMatchmaker(client=make_client())
+        matchmaker2 = RemoteMatchmaker(client=make_client())
+        assert await matchmaker1.pop_match(user_id=3) == 10
+        assert await matchmaker1.pop_match(user_id=1, reserve=True) is None
+
+        # the reserved search is taken by a call, which waits for another call of the worker to create it:
+        match = asyncio.ensure_future(matchmaker1.pop_match(user_id=2, reserve=True))
+        await asyncio.sleep(0.01)
+        assert not match.done()
+        await matchmaker1.enqueue(conversation_id=11, user_id=1)
+        assert await asyncio.wait_for(match, timeout=1) == 11
+        assert await matchmaker2.pop_match(user_id=4) is None
+
+    async def test_reservations_of_disconnected_worker_are_cancelled(self, make_client):
+        client1 = make_client()
+        matchmaker1 = RemoteMatchmaker(client=client1)
+        matchmaker2 = RemoteMatchmaker(client=make_client())
+        await matchmaker1.pop_match(user_id=3)  # takes conversation 10
+        await matchmaker1.pop_match(user_id=1, reserve=True)
+
+        match = asyncio.ensure_future(matchmaker2.pop_match(user_id=2, reserve=True))
+        await asyncio.sleep(0.01)
+        await client1.close()  # the worker is stopped before creating the search
+        assert await asyncio.wait_for(match, timeout=1) is None
+
+    async def test_publish(self, make_client):
+        events1, events2 = [], []
+        client1 = make_client(on_event=lambda event, data: events1.append((event, data)))
+        client2 = make_client(on_event=lambda event, data: events2.append((event, data)))
+        await RemoteMatchmaker(client=client2).discard(conversation_id=10)  # connects the client
+
+        await client1.publish('users_changed', [1, 2])
+        await RemoteMatchmaker(client=client1).discard(conversation_id=10)  # waits for the broadcast
+        await asyncio.sleep(0.01)
+
+        assert events1 == []
+        assert events2 == [('users_changed', [1, 2])]
+
+    async def test_publish_by_broker(self, broker, make_client):
+        events = []
+        client = make_client(on_event=lambda event, data: events.append((event, data)))
+        await RemoteMatchmaker(client=client).discard(conversation_id=10)  # connects the client
+
+        await broker.publish('users_changed', [1, 2])
+        await asyncio.sleep(0.01)
+
+        assert events == [('users_changed', [1, 2])]
+
+    async def test_unknown_method(self, make_client):
+        client = make_client()
+        with pytest.raises(BrokerError, match='Unknown method'):
+            await client.call('reset')
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+from anon_talks.cache import UserCache
+
+
+def make_user(pk, status='in_menu'):
+    return SimpleNamespace(pk=pk, tg_id=pk * 10, status=status)
+
+
+class TestUserCache:
+
+    def test_get(self):
+        cache = UserCache(max_size=10, ttl=60)
+        user = make_user(pk=1)
+        cache.put(user)
+
+        assert cache.get(10) is user
+        assert cache.get(20) is None
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_evicts_least_recently_used(self):
+        cache = UserCache(max_size=2, ttl=60)
+        user1, user2, user3 = make_user(pk=1), make_user(pk=2), make_user(pk=3)
+        cache.put(user1)
+        cache.put(user2)
+        cache.get(user1.tg_id)
+        cache.put(user3)
+
+        assert len(cache) == 2
+        assert cache.get(user1.tg_id) is user1
+        assert cache.get(user2.tg_id) is None
+        assert cache.get(user3.tg_id) is user3
+
+    def test_expires(self, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr('anon_talks.cache.time.monotonic', lambda: now)
+        cache = UserCache(max_size=10, ttl=60)
+        user = make_user(pk=1)
+        cache.put(user)
+
+        now += 59
+        assert cache.get(user.tg_id) is user
+
+        now += 1
+        assert cache.get(user.tg_id) is None
+        assert len(cache) == 0
+
+    def test_set_status(self):
+        cache = UserCache(max_size=10, ttl=60)
+        user = make_user(pk=1)
+        cache.put(user)
+
+        cache.set_status(user_id=1, status='in_conversation')
+        cache.set_status(user_id=2, status='in_conversation')  # not cached, ignored
+        assert cache.get(user.tg_id).status == 'in_conversation'
+
+    def test_invalidate(self):
+        cache = UserCache(max_size=10, ttl=60)
+        cache.put(make_user(pk=1))
+
+        cache.invalidate(user_id=1)
+        assert cache.get(10) is None
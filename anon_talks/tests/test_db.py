@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from anon_talks.db import generate_schemas
+from anon_talks.models import ArchivedConversation, Conversation, TelegramUser
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+async def test_generate_schemas_on_existing_db():
+    user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+    await Conversation.create(initiator=user)
+
+    await generate_schemas()
+    await generate_schemas()
+    assert await TelegramUser.filter(tg_id=1).exists()
+    assert await Conversation.filter(initiator_id=user.pk).exists()
+
+
+async def drop_column(model, field_name):
+    await model._meta.db.execute_script(
+        f'ALTER TABLE "{model._meta.db_table}" DROP COLUMN "{model._meta.fields_db_projection[field_name]}"'
+    )
+
+
+async def test_generate_schemas_adds_tags():
+    user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+    await drop_column(TelegramUser, 'tags')
+    await drop_column(Conversation, 'tags')
+    await drop_column(ArchivedConversation, 'tags')
+
+    await generate_schemas()
+    await generate_schemas()
+    user = await TelegramUser.get(pk=user.pk)
+    assert user.tags == ''
+    conversation = await Conversation.create(initiator=user, tags='music')
+    assert (await Conversation.get(pk=conversation.pk)).tags == 'music'
+    await ArchivedConversation.create(id=conversation.pk, initiator=user, tags='music', finished_at=datetime.now())
+    assert (await ArchivedConversation.get(pk=conversation.pk)).tags == 'music'
+
+
+async def test_generate_schemas_adds_blocked_at():
+    user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+    await drop_column(TelegramUser, 'blocked_at')
+
+    await generate_schemas()
+    await generate_schemas()
+    assert (await TelegramUser.get(pk=user.pk)).blocked_at is None
+    await TelegramUser.filter(pk=user.pk).update(blocked_at=datetime(2020, 1, 1))
+    assert (await TelegramUser.get(pk=user.pk)).blocked_at is not None
+
+
+async def test_generate_schemas_creates_archive():
+    user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+    await ArchivedConversation._meta.db.execute_script(f'DROP TABLE "{ArchivedConversation._meta.db_table}"')
+
+    await generate_schemas()
+    await generate_schemas()
+    await ArchivedConversation.create(id=1, initiator=user, finished_at=datetime(2020, 1, 1))
+    assert await ArchivedConversation.filter(initiator_id=user.pk).count() == 1
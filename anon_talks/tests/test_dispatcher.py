@@ -0,0 +1,126 @@
+import asyncio
+import random
+
+import pytest
+from aiogram import Bot
+from aiogram.types import Update
+
+from anon_talks import metrics
+from anon_talks.bot import ChatOrderedDispatcher
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_update(update_id, chat_id, text):
+    return Update.to_object({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    })
+
+
+@pytest.fixture
+async def dispatcher():
+    bot = Bot(token='123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+    yield ChatOrderedDispatcher(bot)
+    await bot.session.close()
+    metrics.UPDATE_QUEUE_WAIT.clear()
+
+
+class TestChatOrderedDispatcher:
+
+    async def test_ordered_by_chat(self, dispatcher):
+        processed = []
+        in_progress = set()
+        max_concurrency = 0
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            nonlocal max_concurrency
+            assert message.chat.id not in in_progress
+            in_progress.add(message.chat.id)
+            max_concurrency = max(max_concurrency, len(in_progress))
+            await asyncio.sleep(random.uniform(0, 0.005))
+            in_progress.discard(message.chat.id)
+            processed.append((message.chat.id, int(message.text)))
+            return int(message.text)
+
+        updates = [make_update(update_id, chat_id=update_id % 5 + 1, text=str(update_id)) for update_id in range(1, 51)]
+        results = await asyncio.gather(*(dispatcher.process_update(update) for update in updates))
+
+        assert results == [[update_id] for update_id in range(1, 51)]
+        for chat_id in range(1, 6):
+            update_ids = [update_id for chat, update_id in processed if chat == chat_id]
+            assert update_ids == [update_id for update_id in range(1, 51) if update_id % 5 + 1 == chat_id]
+        assert max_concurrency == 5
+        assert dispatcher.chat_queues == {}
+        assert metrics.UPDATE_QUEUE_WAIT.get_count() == 50
+
+    async def test_queue_stats(self, dispatcher):
+        released = asyncio.Event()
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            await released.wait()
+
+        tasks = [
+            asyncio.create_task(dispatcher.process_update(make_update(update_id, chat_id, text='hi')))
+            for update_id, chat_id in enumerate((1, 1, 1, 2, 2, 3), start=1)
+        ]
+        await asyncio.sleep(0.01)
+
+        assert len(dispatcher.chat_queues) == 3
+        assert dispatcher.get_queue_depth() == 3
+        assert dispatcher.get_max_queue_depth() == 2
+        assert 0.01 <= dispatcher.get_queue_lag() < 1
+
+        released.set()
+        await asyncio.gather(*tasks)
+        assert dispatcher.chat_queues == {}
+        assert dispatcher.get_queue_depth() == 0
+        assert dispatcher.get_queue_lag() == 0
+
+    async def test_cancel_waiting(self, dispatcher):
+        released = asyncio.Event()
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            await released.wait()
+            processed.append(message.text)
+
+        tasks = [
+            asyncio.create_task(dispatcher.process_update(make_update(update_id, chat_id=1, text=text)))
+            for update_id, text in enumerate(('first', 'cancelled', 'last'), start=1)
+        ]
+        await asyncio.sleep(0.01)
+        tasks[1].cancel()
+        released.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        assert processed == ['first', 'last']
+        assert dispatcher.chat_queues == {}
+
+    async def test_update_without_chat(self, dispatcher):
+        processed = []
+
+        @dispatcher.inline_handler()
+        async def handle(inline_query):
+            processed.append(inline_query.query)
+
+        update = Update.to_object({
+            'update_id': 1,
+            'inline_query': {
+                'id': '1', 'from': {'id': 1, 'is_bot': False, 'first_name': 'User'}, 'query': 'hi', 'offset': '',
+            },
+        })
+        await dispatcher.process_update(update)
+
+        assert processed == ['hi']
+        assert metrics.UPDATE_QUEUE_WAIT.get_count() == 0
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+from tortoise import Tortoise
+
+from anon_talks.instrumentation import install_query_hook, track_queries
+from anon_talks.models import TelegramUser
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+@pytest.fixture(scope='module', autouse=True)
+def query_hook():
+    install_query_hook(type(Tortoise.get_connection('anon_talks')))
+
+
+async def test_track_queries():
+    with track_queries() as stats:
+        await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        await TelegramUser.filter(tg_id=1).first()
+
+    assert stats.count == 2
+    assert stats.duration > 0
+
+
+async def test_track_queries__of_tasks():
+    async def get_user():
+        return await TelegramUser.filter(tg_id=1).first()
+
+    with track_queries() as stats:
+        await asyncio.gather(get_user(), get_user())
+
+    assert stats.count == 2
+
+
+async def test_track_queries__not_tracked():
+    with track_queries() as stats:
+        pass
+    await TelegramUser.filter(tg_id=1).first()
+
+    assert stats.count == 0
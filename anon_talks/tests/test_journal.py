@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from anon_talks.journal import Journal, JournalError
+
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+async def journal(tmp_path):
+    journal = Journal(tmp_path / 'journal', segment_size=1024)
+    journal.open()
+    yield journal
+    await journal.close()
+
+
+async def reopen(journal, tmp_path):
+    await journal.close()
+    reopened = Journal(tmp_path / 'journal', segment_size=1024)
+    reopened.open()
+    return reopened
+
+
+def get_segment_names(tmp_path):
+    return sorted(path.name for path in (tmp_path / 'journal').glob('segment-*'))
+
+
+class TestJournal:
+
+    async def test_append(self, journal, tmp_path):
+        await journal.append({'operation': 'start', 'conversation_id': 1})
+        await journal.append({'operation': 'finish', 'conversation_id': 1})
+        assert journal.get_unflushed(10) == [
+            (1, {'operation': 'start', 'conversation_id': 1}),
+            (2, {'operation': 'finish', 'conversation_id': 1}),
+        ]
+        assert journal.get_unflushed(1) == [(1, {'operation': 'start', 'conversation_id': 1})]
+
+        journal = await reopen(journal, tmp_path)
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [1, 2]
+        await journal.append({'operation': 'start', 'conversation_id': 2})
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [1, 2, 3]
+        await journal.close()
+
+    async def test_concurrent_appends_are_synced_together(self, journal, monkeypatch):
+        sync_calls = []
+        sync = journal._sync
+        monkeypatch.setattr(journal, '_sync', lambda: sync_calls.append(1) or sync())
+
+        await asyncio.gather(*(journal.append({'conversation_id': i}) for i in range(10)))
+        # the entries are appended before the writer runs, so they're written together:
+        assert len(sync_calls) == 1
+
+        await asyncio.gather(*(journal.append({'conversation_id': i}) for i in range(10, 13)))
+        assert len(sync_calls) == 2
+        assert [entry['conversation_id'] for __, entry in journal.get_unflushed(20)] == list(range(13))
+
+    async def test_set_flushed(self, journal, tmp_path):
+        for i in range(3):
+            await journal.append({'conversation_id': i})
+        journal.set_flushed(2)
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [3]
+
+        journal = await reopen(journal, tmp_path)
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [3]
+        await journal.append({'conversation_id': 3})
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [3, 4]
+        await journal.close()
+
+    async def test_flushed_segments_are_deleted(self, journal, tmp_path):
+        for i in range(20):
+            await journal.append({'operation': 'start', 'conversation_id': i, 'tags': ['music'] * 10})
+        segment_names = get_segment_names(tmp_path)
+        assert len(segment_names) > 2
+
+        journal.set_flushed(10)
+        assert get_segment_names(tmp_path) != segment_names
+        assert [seq for seq, __ in journal.get_unflushed(100)] == list(range(11, 21))
+
+        journal.set_flushed(20)
+        assert get_segment_names(tmp_path) == segment_names[-1:]
+
+        journal = await reopen(journal, tmp_path)
+        assert journal.get_unflushed(100) == []
+        await journal.append({'conversation_id': 20})
+        assert [seq for seq, __ in journal.get_unflushed(100)] == [21]
+        await journal.close()
+
+    async def test_torn_entry(self, journal, tmp_path):
+        await journal.append({'conversation_id': 1})
+        await journal.append({'conversation_id': 2})
+        # a crash in the middle of a write:
+        journal._file.write(b'[3,{"conversation_')
+        journal._file.flush()
+
+        journal = await reopen(journal, tmp_path)
+        assert [seq for seq, __ in journal.get_unflushed(10)] == [1, 2]
+        await journal.append({'conversation_id': 3})
+
+        journal = await reopen(journal, tmp_path)
+        assert journal.get_unflushed(10)[-1] == (3, {'conversation_id': 3})
+        await journal.close()
+
+    async def test_failed_write_closes_journal(self, journal, tmp_path, monkeypatch):
+        await journal.append({'conversation_id': 1})
+
+        def fail():
+            raise OSError('No space left on device')
+
+        monkeypatch.setattr(journal, '_sync', fail)
+        with pytest.raises(OSError):
+            await journal.append({'conversation_id': 2})
+        # nothing is appended after a possibly torn line:
+        with pytest.raises(JournalError):
+            await journal.append({'conversation_id': 3})
+
+        journal = await reopen(journal, tmp_path)
+        assert journal.get_unflushed(10)[0] == (1, {'conversation_id': 1})
+        await journal.append({'conversation_id': 3})
+        assert journal.get_unflushed(10)[-1][1] == {'conversation_id': 3}
+        await journal.close()
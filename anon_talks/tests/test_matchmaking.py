@@ -0,0 +1,218 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from anon_talks.matchmaking import Matchmaker, parse_tags
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_matchmaker(waiting=(), recent=()):
+    async def loader():
+        # waiting conversations are given by (conversation id, initiator id) or with tags and waiting time too:
+        entries = [entry if len(entry) == 4 else (*entry, (), datetime.now()) for entry in waiting]
+        return entries, recent
+
+    return Matchmaker(loader=loader, recent_timeout=timedelta(minutes=5), widen_after=timedelta(seconds=30))
+
+
+class TestMatchmaker:
+
+    async def test_pop_match_loads_state(self):
+        matchmaker = make_matchmaker(waiting=[(10, 2), (11, 3)])
+        assert not matchmaker.is_loaded
+
+        assert await matchmaker.pop_match(user_id=1) == 10
+        assert matchmaker.is_loaded
+        assert await matchmaker.pop_match(user_id=1) == 11
+        assert await matchmaker.pop_match(user_id=1) is None
+
+    async def test_pop_match_skips_own(self):
+        matchmaker = make_matchmaker(waiting=[(10, 1), (11, 2)])
+
+        assert await matchmaker.pop_match(user_id=1) == 11
+        assert await matchmaker.pop_match(user_id=1) is None
+        assert await matchmaker.pop_match(user_id=2) == 10
+
+    @pytest.mark.freeze_time("2021-03-07 12:30")
+    async def test_pop_match_skips_recent_opponents(self):
+        matchmaker = make_matchmaker(
+            waiting=[(10, 2), (11, 3), (12, 4)],
+            recent=[
+                (1, 2, datetime(2021, 3, 7, 12, 29)),  # recent, initiated by the user
+                (3, 1, datetime(2021, 3, 7, 12, 28)),  # recent, initiated by the opponent
+                (1, 4, datetime(2021, 3, 7, 12, 20)),  # expired
+            ],
+        )
+
+        assert await matchmaker.pop_match(user_id=1) == 12
+        assert await matchmaker.pop_match(user_id=1) is None
+
+    async def test_recent_opponents_expire(self, freezer):
+        freezer.move_to("2021-03-07 12:30")
+        matchmaker = make_matchmaker(waiting=[(10, 2)])
+        await matchmaker.pop_match(user_id=3)  # loads the state
+        await matchmaker.enqueue(conversation_id=10, user_id=2)
+        await matchmaker.remember_opponents(user_id=1, opponent_id=2, finished_at=datetime.now())
+
+        assert await matchmaker.pop_match(user_id=1) is None
+
+        freezer.move_to("2021-03-07 12:36")
+        assert await matchmaker.pop_match(user_id=1) == 10
+
+    async def test_discard(self):
+        matchmaker = make_matchmaker(waiting=[(10, 2), (11, 3)])
+        await matchmaker.pop_match(user_id=4)
+        await matchmaker.discard(conversation_id=11)
+
+        assert await matchmaker.pop_match(user_id=1) is None
+
+    async def test_reset(self):
+        matchmaker = make_matchmaker(waiting=[(10, 2)])
+        await matchmaker.pop_match(user_id=1)
+        matchmaker.reset()
+
+        assert not matchmaker.is_loaded
+        assert await matchmaker.pop_match(user_id=1) == 10
+
+    async def test_reset_clears_tags(self):
+        matchmaker = make_matchmaker()
+        await matchmaker.load()
+        await matchmaker.enqueue(conversation_id=10, user_id=2, tags=('music',))
+        matchmaker.reset()
+
+        assert await matchmaker.pop_match(user_id=1, tags=('music',)) is None
+
+
+class TestReservations:
+
+    async def test_reserved_search_is_matched_once_created(self):
+        matchmaker = make_matchmaker()
+        assert await matchmaker.pop_match(user_id=1, reserve=True) is None
+
+        match = asyncio.ensure_future(matchmaker.pop_match(user_id=2, reserve=True))
+        await asyncio.sleep(0)
+        assert not match.done()  # the conversation of the reserved search isn't created yet
+
+        await matchmaker.enqueue(conversation_id=10, user_id=1)
+        assert await match == 10
+        assert await matchmaker.pop_match(user_id=3) is None
+
+    async def test_enqueue_fulfils_reservation(self):
+        matchmaker = make_matchmaker(waiting=[(10, 1)])
+        assert await matchmaker.pop_match(user_id=1, tags=('music',), reserve=True) is None
+        await matchmaker.enqueue(conversation_id=11, user_id=1, tags=('music',))
+
+        # the reserved search keeps its place in the queue:
+        assert await matchmaker.pop_match(user_id=2, tags=('music',)) == 11
+        assert await matchmaker.pop_match(user_id=2) == 10
+        assert await matchmaker.pop_match(user_id=2) is None
+
+    async def test_discard_fulfilled_reservation(self):
+        matchmaker = make_matchmaker()
+        await matchmaker.pop_match(user_id=1, reserve=True)
+        await matchmaker.enqueue(conversation_id=10, user_id=1)
+        await matchmaker.discard(conversation_id=10)
+
+        assert await matchmaker.pop_match(user_id=2) is None
+
+    async def test_cancel_reservation(self):
+        matchmaker = make_matchmaker()
+        await matchmaker.pop_match(user_id=1, reserve=True)
+
+        match = asyncio.ensure_future(matchmaker.pop_match(user_id=2, reserve=True))
+        await asyncio.sleep(0)
+        await matchmaker.enqueue(conversation_id=10, user_id=3)
+        await matchmaker.cancel_reservation(user_id=1)
+        # the conversation of the reserved search isn't created, so the next match is taken:
+        assert await match == 10
+
+        await matchmaker.pop_match(user_id=4, reserve=True)
+        await matchmaker.cancel_reservation(user_id=4)
+        assert await matchmaker.pop_match(user_id=5) is None
+
+    async def test_reset_cancels_reservations(self):
+        matchmaker = make_matchmaker()
+        await matchmaker.pop_match(user_id=1, reserve=True)
+        match = asyncio.ensure_future(matchmaker.pop_match(user_id=2))
+        await asyncio.sleep(0)
+        matchmaker.reset()
+
+        assert await match is None
+
+
+@pytest.mark.freeze_time("2021-03-07 12:30")
+class TestTags:
+
+    async def test_pop_match_by_shared_tag(self):
+        now = datetime.now()
+        matchmaker = make_matchmaker(waiting=[
+            (10, 2, ('music',), now),
+            (11, 3, ('movies',), now),
+            (12, 4, ('books', 'movies'), now),
+            (13, 5, (), now),
+        ])
+
+        assert await matchmaker.pop_match(user_id=1, tags=('books', 'movies')) == 11
+        assert await matchmaker.pop_match(user_id=1, tags=('books',)) == 12
+        assert await matchmaker.pop_match(user_id=1, tags=('movies',)) is None
+        assert await matchmaker.pop_match(user_id=1, tags=('sports',)) is None
+        assert await matchmaker.pop_match(user_id=1) == 13
+        assert await matchmaker.pop_match(user_id=1) is None
+        assert await matchmaker.pop_match(user_id=1, tags=('music',)) == 10
+
+    async def test_pop_match_skips_own_and_recent_in_tag_queue(self):
+        now = datetime.now()
+        matchmaker = make_matchmaker(
+            waiting=[(10, 1, ('music',), now), (11, 2, ('music',), now), (12, 3, ('music',), now)],
+            recent=[(1, 2, datetime(2021, 3, 7, 12, 29))],
+        )
+
+        assert await matchmaker.pop_match(user_id=1, tags=('music',)) == 12
+
+    async def test_widening(self, freezer):
+        matchmaker = make_matchmaker()
+        await matchmaker.load()
+        await matchmaker.enqueue(conversation_id=10, user_id=2, tags=('music',))
+        freezer.move_to("2021-03-07 12:30:20")
+        await matchmaker.enqueue(conversation_id=11, user_id=3, tags=('movies',))
+
+        assert await matchmaker.pop_match(user_id=1, tags=('books',)) is None
+        assert await matchmaker.pop_match(user_id=1) is None
+
+        freezer.move_to("2021-03-07 12:30:31")
+        assert await matchmaker.pop_match(user_id=1, tags=('books',)) == 10
+        assert await matchmaker.pop_match(user_id=1) is None
+        freezer.move_to("2021-03-07 12:30:51")
+        assert await matchmaker.pop_match(user_id=1) == 11
+
+    async def test_widening_prefers_shared_tag(self, freezer):
+        matchmaker = make_matchmaker(waiting=[(10, 2, ('music',), datetime(2021, 3, 7, 12, 20))])
+        await matchmaker.load()
+        await matchmaker.enqueue(conversation_id=11, user_id=3, tags=('books',))
+
+        assert await matchmaker.pop_match(user_id=1, tags=('books',)) == 11
+        assert await matchmaker.pop_match(user_id=1, tags=('books',)) == 10
+
+    async def test_discard_removes_from_tag_queues(self):
+        matchmaker = make_matchmaker(waiting=[(10, 2, ('music', 'movies'), datetime.now())])
+        await matchmaker.load()
+        await matchmaker.discard(conversation_id=10)
+        await matchmaker.discard(conversation_id=10)
+
+        assert await matchmaker.pop_match(user_id=1, tags=('music',)) is None
+        assert await matchmaker.pop_match(user_id=1, tags=('movies',)) is None
+
+
+@pytest.mark.parametrize('text, tags', [
+    ('music', ['music']),
+    ('#Music, movies  books', ['music', 'movies', 'books']),
+    ('music,music,,#', ['music']),
+    ('a b c d e f', ['a', 'b', 'c', 'd', 'e']),
+    ('x' * 40, ['x' * 32]),
+    ('', []),
+])
+def test_parse_tags(text, tags):
+    assert parse_tags(text, max_count=5, max_length=32) == tags
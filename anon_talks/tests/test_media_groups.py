@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from anon_talks.media_groups import MediaGroupCollector
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_message(message_id, chat_id, media_group_id):
+    return SimpleNamespace(message_id=message_id, chat=SimpleNamespace(id=chat_id), media_group_id=media_group_id)
+
+
+class TestMediaGroupCollector:
+
+    async def test_flush_after_delay(self):
+        relayed = []
+
+        async def relay(messages):
+            relayed.append([message.message_id for message in messages])
+
+        collector = MediaGroupCollector(delay=0.01)
+        for message_id in (1, 2, 3):
+            collector.add(make_message(message_id, chat_id=10, media_group_id='album'), callback=relay)
+        collector.add(make_message(4, chat_id=20, media_group_id='other'), callback=relay)
+        assert len(collector) == 2
+        assert relayed == []
+
+        await asyncio.sleep(0.05)
+        assert sorted(relayed) == [[1, 2, 3], [4]]
+        assert len(collector) == 0
+
+    async def test_flush_chat(self):
+        relayed = []
+
+        async def relay(messages):
+            relayed.append([message.message_id for message in messages])
+
+        collector = MediaGroupCollector(delay=10)
+        collector.add(make_message(1, chat_id=10, media_group_id='album'), callback=relay)
+        collector.add(make_message(2, chat_id=20, media_group_id='other'), callback=relay)
+
+        await collector.flush_chat(10)
+        assert relayed == [[1]]
+        assert len(collector) == 1
+
+        await collector.close()
+        assert relayed == [[1], [2]]
@@ -0,0 +1,130 @@
+import pytest
+from aiogram import Bot
+from aiogram.types import Message
+from tortoise import Tortoise
+
+from anon_talks import metrics
+from anon_talks.bot import MeasuredBot, MetricsMiddleware
+from anon_talks.instrumentation import install_query_hook
+from anon_talks.models import TelegramUser
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    install_query_hook(type(Tortoise.get_connection('anon_talks')))
+    yield
+    for histogram in metrics.HISTOGRAMS:
+        histogram.clear()
+
+
+def make_message(user_id, text):
+    return Message.to_object({
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': user_id * 10, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+        'text': text,
+    })
+
+
+async def process_message(message, handler):
+    middleware, data = MetricsMiddleware(), {}
+    await middleware.on_pre_process_message(message, data)
+    await handler()
+    await middleware.on_post_process_message(message, [], data)
+
+
+class TestHistogram:
+
+    def test_render(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', label_names=['kind'], buckets=(0.1, 1))
+        histogram.observe(0.05, kind='a')
+        histogram.observe(0.1, kind='a')
+        histogram.observe(0.5, kind='a')
+        histogram.observe(2, kind='a')
+        histogram.observe(0.5, kind='b')
+
+        assert histogram.get_count(kind='a') == 4
+        assert histogram.get_count(kind='c') == 0
+        assert histogram.render() == (
+            '# HELP test_seconds Test.\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{kind="a",le="0.1"} 2\n'
+            'test_seconds_bucket{kind="a",le="1"} 3\n'
+            'test_seconds_bucket{kind="a",le="+Inf"} 4\n'
+            'test_seconds_sum{kind="a"} 2.65\n'
+            'test_seconds_count{kind="a"} 4\n'
+            'test_seconds_bucket{kind="b",le="0.1"} 0\n'
+            'test_seconds_bucket{kind="b",le="1"} 1\n'
+            'test_seconds_bucket{kind="b",le="+Inf"} 1\n'
+            'test_seconds_sum{kind="b"} 0.5\n'
+            'test_seconds_count{kind="b"} 1\n'
+        )
+
+    def test_render_without_labels(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', buckets=(1,))
+        histogram.observe(0.5)
+
+        assert 'test_seconds_bucket{le="1"} 1\n' in histogram.render()
+        assert 'test_seconds_count{} 1\n' in histogram.render()
+
+
+class TestGauge:
+
+    def test_render(self):
+        gauge = metrics.Gauge('test_depth', 'Test.')
+        assert gauge.render() == '# HELP test_depth Test.\n# TYPE test_depth gauge\ntest_depth 0\n'
+
+        gauge.set_function(lambda: 5)
+        assert gauge.render().endswith('test_depth 5\n')
+
+
+class TestMetricsMiddleware:
+
+    async def test_command(self):
+        async def handler():
+            await TelegramUser.create(tg_id=1, tg_chat_id=10)
+
+        await process_message(make_message(user_id=1, text='/start'), handler)
+
+        assert metrics.UPDATE_DURATION.get_count(branch='start') == 1
+        assert metrics.UPDATE_QUERIES.get_count(branch='start') == 1
+        assert 'anon_talks_update_queries_bucket{branch="start",le="1"} 1\n' in metrics.render_metrics()
+
+    async def test_status_branch(self):
+        await TelegramUser.create(tg_id=1, tg_chat_id=10, status=TelegramUser.Status.WAITING_OPPONENT)
+
+        async def handler():
+            await TelegramUser.filter(tg_id=1).first()
+            await TelegramUser.filter(tg_id=1).first()
+
+        await process_message(make_message(user_id=1, text='hello'), handler)
+
+        assert metrics.UPDATE_DURATION.get_count(branch='waiting_opponent') == 1
+        # the lookup of the user by the middleware and both queries of the handler:
+        assert 'anon_talks_update_queries_bucket{branch="waiting_opponent",le="2"} 0\n' in metrics.render_metrics()
+        assert 'anon_talks_update_queries_bucket{branch="waiting_opponent",le="3"} 1\n' in metrics.render_metrics()
+
+    async def test_not_registered(self):
+        async def handler():
+            pass
+
+        await process_message(make_message(user_id=1, text='hello'), handler)
+
+        assert metrics.UPDATE_DURATION.get_count(branch=MetricsMiddleware.NOT_REGISTERED_BRANCH) == 1
+
+
+class TestMeasuredBot:
+
+    async def test_request(self, monkeypatch):
+        async def request(self, method, data=None, files=None, **kwargs):
+            return {'message_id': 1}
+
+        monkeypatch.setattr(Bot, 'request', request)
+        bot = MeasuredBot(token='123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+
+        assert await bot.request('sendMessage', {'chat_id': 10}) == {'message_id': 1}
+        assert metrics.TELEGRAM_API_DURATION.get_count(method='sendMessage') == 1
@@ -1,11 +1,77 @@
+import asyncio
+import re
+from collections import deque
 from datetime import datetime
 
 import pytest
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
 
-from anon_talks.models import Conversation, TelegramUser
+from anon_talks.models import Conversation, TelegramUser, conversation_routes, matchmaker, user_cache
+from anon_talks.routing import Route
 
 
-pytestmark = pytest.mark.asyncio
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+@pytest.fixture
+def executed_sql(monkeypatch):
+    client_class = type(Tortoise.get_connection('anon_talks'))
+    statements = []
+
+    def capture_sql(execute):
+        async def capture(self, query, values=None):
+            statements.append((query, values))
+            return await execute(self, query, values)
+        return capture
+
+    # patched in the class, to capture statements of transactions too:
+    for name in ('execute_insert', 'execute_query', 'execute_query_dict'):
+        monkeypatch.setattr(client_class, name, capture_sql(getattr(client_class, name)))
+    return statements
+
+
+async def explain(sql, values=None):
+    connection = Tortoise.get_connection('anon_talks')
+    if connection.capabilities.dialect == 'postgres':
+        async with in_transaction('anon_talks') as transaction:
+            # tables of tests are tiny, so the planner must be forced to prefer indexes:
+            await transaction.execute_script('SET LOCAL enable_seqscan = off')
+            rows = await transaction.execute_query_dict(f'EXPLAIN {sql}', values)
+        return [row['QUERY PLAN'] for row in rows]
+
+    rows = await connection.execute_query_dict(f'EXPLAIN QUERY PLAN {sql}', values)
+    return [row['detail'] for row in rows]
+
+
+def is_sequential_scan(plan_line):
+    return (
+        'Seq Scan on conversation ' in plan_line
+        or (bool(re.match(r'SCAN (TABLE )?conversation\b', plan_line)) and 'INDEX' not in plan_line)
+    )
+
+
+class TestTelegramUser:
+
+    async def test_get_cached(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+
+        cached_user = await TelegramUser.get_cached(tg_id=1)
+        assert cached_user == user
+        assert user_cache.misses == 1
+
+        assert await TelegramUser.get_cached(tg_id=1) is cached_user
+        assert user_cache.hits == 1
+
+        assert await TelegramUser.get_cached(tg_id=2) is None
+
+    async def test_tags(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        assert user.get_tags() == ()
+
+        await user.set_tags(['music', 'movies'])
+        user = await TelegramUser.get(tg_id=1)
+        assert user.get_tags() == ('music', 'movies')
 
 
 class TestConversation:
@@ -67,6 +133,191 @@ class TestConversation:
         assert not conversation.opponent
         assert not conversation.finished_at
 
+    async def test_start_not_with_just_finished_opponent(self, freezer):
+        freezer.move_to("2021-03-07 12:30")
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=2)
+
+        waiting_conversation = await Conversation.start(user=other_user)
+        conversation = await Conversation.start(user=user)
+        assert conversation.id == waiting_conversation.id
+        await conversation.finish()
+
+        waiting_conversation = await Conversation.start(user=user)
+        conversation = await Conversation.start(user=other_user)
+        assert conversation.id != waiting_conversation.id
+        assert not conversation.opponent
+
+        freezer.move_to("2021-03-07 12:36")
+        await conversation.finish()
+        conversation = await Conversation.start(user=other_user)
+        assert conversation.id == waiting_conversation.id
+        assert conversation.opponent == other_user
+
+    @pytest.mark.postgres
+    async def test_start_stress(self):
+        """
+        Hundreds of concurrent searches through the matchmaker, claiming conversations in concurrent transactions.
+        """
+        initiators = [
+            await TelegramUser.create(tg_id=i, tg_chat_id=i, status=TelegramUser.Status.WAITING_OPPONENT)
+            for i in range(100)
+        ]
+        waiting_ids = [(await Conversation.create(initiator=user)).pk for user in initiators]
+        searchers = [await TelegramUser.create(tg_id=i, tg_chat_id=i) for i in range(100, 400)]
+
+        conversations = await asyncio.gather(*(Conversation.start(user=user) for user in searchers))
+        claimed_ids = [conversation.pk for conversation in conversations if conversation.opponent]
+        assert len(claimed_ids) == len(set(claimed_ids)) == 200
+        assert set(waiting_ids) <= set(claimed_ids)
+
+        stored = await Conversation.filter(finished_at__isnull=True).values_list('initiator_id', 'opponent_id')
+        assert len(stored) == 200
+        member_ids = [user_id for pair in stored for user_id in pair]
+        # every user is a member of one conversation:
+        assert sorted(member_ids) == sorted(user.pk for user in initiators + searchers)
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 400
+
+    @pytest.mark.postgres
+    async def test_start_concurrent_claims(self, monkeypatch):
+        initiators = [
+            await TelegramUser.create(tg_id=i, tg_chat_id=i, status=TelegramUser.Status.WAITING_OPPONENT)
+            for i in range(10)
+        ]
+        waiting_conversations = [await Conversation.create(initiator=user) for user in initiators]
+        searchers = [await TelegramUser.create(tg_id=i, tg_chat_id=i) for i in range(100, 400)]
+
+        # every searcher acts like a separate worker, with its own copy of the waiting queue:
+        queues = {user.pk: deque(conversation.pk for conversation in waiting_conversations) for user in searchers}
+
+        async def pop_match(user_id, tags, reserve=False):
+            await asyncio.sleep(0)
+            queue = queues[user_id]
+            return queue.popleft() if queue else None
+
+        monkeypatch.setattr(matchmaker, 'pop_match', pop_match)
+
+        conversations = await asyncio.gather(*(Conversation.start(user=user) for user in searchers))
+        paired = {conversation.id: conversation.opponent.pk for conversation in conversations if conversation.opponent}
+        assert sorted(paired) == sorted(conversation.id for conversation in waiting_conversations)
+
+        stored = await (Conversation
+                        .filter(id__in=list(paired))
+                        .values_list('id', 'opponent_id'))
+        assert dict(stored) == paired
+
+        in_conversation_count = await TelegramUser.filter(status=TelegramUser.Status.IN_CONVERSATION).count()
+        waiting_count = await TelegramUser.filter(status=TelegramUser.Status.WAITING_OPPONENT).count()
+        assert in_conversation_count == len(initiators) * 2
+        assert waiting_count == len(searchers) - len(initiators)
+
+    async def test_start_concurrent_searches(self):
+        users = [await TelegramUser.create(tg_id=i, tg_chat_id=i) for i in range(20)]
+        await matchmaker.load()
+
+        conversations = await asyncio.gather(*(Conversation.start(user=user) for user in users))
+        assert sum(1 for conversation in conversations if conversation.opponent) == 10
+        assert await Conversation.in_progress().count() == 10
+        assert not await Conversation.waiting_opponent().exists()
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 20
+
+    async def test_start_failed_search_cancels_reservation(self, monkeypatch):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=2)
+        await matchmaker.load()
+        create = Conversation.create
+
+        async def create_or_fail(**kwargs):
+            if kwargs['initiator'] == user:
+                await asyncio.sleep(0.01)  # the search of the other user takes the reserved one meanwhile
+                raise ConnectionError
+            return await create(**kwargs)
+
+        monkeypatch.setattr(Conversation, 'create', create_or_fail)
+        failed_start = asyncio.ensure_future(Conversation.start(user=user))
+        await asyncio.sleep(0)
+
+        conversation = await Conversation.start(user=other_user)
+        with pytest.raises(ConnectionError):
+            await failed_start
+        assert conversation.initiator == other_user
+        assert not conversation.opponent
+        assert (await TelegramUser.get(id=user.pk)).status == TelegramUser.Status.IN_MENU
+
+    async def test_start_skips_finished_conversation(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=2)
+        waiting_conversation = await Conversation.start(user=other_user)
+
+        # finished by another worker, so the matchmaker of this one wasn't notified:
+        await Conversation.filter(id=waiting_conversation.id).update(finished_at=datetime.now())
+
+        conversation = await Conversation.start(user=user)
+        assert conversation.id != waiting_conversation.id
+        assert not conversation.opponent
+
+    async def test_start_by_tags(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1, tags='music,movies')
+        other_user1 = await TelegramUser.create(tg_id=2, tg_chat_id=2)
+        other_user2 = await TelegramUser.create(tg_id=3, tg_chat_id=3)
+        untagged_conversation = await Conversation.start(user=other_user1)
+        tagged_conversation = await Conversation.start(user=other_user2, tags=['movies'])
+        assert tagged_conversation.tags == 'movies'
+
+        conversation = await Conversation.start(user=user)
+        assert conversation.id == tagged_conversation.id
+        assert conversation.opponent == user
+
+        matchmaker.reset()  # the waiting conversation is loaded from the database, with its tags
+        conversation = await Conversation.start(user=user, tags=['movies'])
+        assert conversation.id != untagged_conversation.id
+        assert conversation.tags == 'movies'
+
+    async def test_start_writes_status_to_cache(self):
+        cached_user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        cached_other_user = await TelegramUser.create(tg_id=2, tg_chat_id=2)
+        user_cache.put(cached_user)
+        user_cache.put(cached_other_user)
+
+        conversation = await Conversation.start(user=await TelegramUser.get(tg_id=1))
+        assert cached_user.status == TelegramUser.Status.WAITING_OPPONENT
+
+        await Conversation.start(user=await TelegramUser.get(tg_id=2))
+        assert cached_user.status == TelegramUser.Status.IN_CONVERSATION
+        assert cached_other_user.status == TelegramUser.Status.IN_CONVERSATION
+
+        conversation = await Conversation.all().select_related('initiator', 'opponent').get(id=conversation.id)
+        await conversation.finish()
+        assert cached_user.status == TelegramUser.Status.IN_MENU
+        assert cached_other_user.status == TelegramUser.Status.IN_MENU
+
+    async def test_start_adds_routes(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+
+        await Conversation.start(user=other_user)
+        conversation = await Conversation.start(user=user)
+        assert len(conversation_routes) == 2
+        assert await conversation_routes.get(user.pk) == Route(conversation.pk, other_user.pk, 20)
+        assert await conversation_routes.get(other_user.pk) == Route(conversation.pk, user.pk, 10)
+
+        await conversation.finish()
+        assert len(conversation_routes) == 0
+
+    async def test_find_route(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10, status=TelegramUser.Status.IN_CONVERSATION)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20, status=TelegramUser.Status.IN_CONVERSATION)
+        await Conversation.create(initiator=user, opponent=other_user, finished_at=datetime(2021, 3, 7, 12, 29))
+        conversation = await Conversation.create(initiator=user, opponent=other_user)
+
+        assert await Conversation.find_route(user.pk) == Route(conversation.pk, other_user.pk, 20)
+        assert await Conversation.find_route(other_user.pk) == Route(conversation.pk, user.pk, 10)
+
+        await conversation.finish()
+        assert await Conversation.find_route(user.pk) is None
+
     async def test_in_progress(self):
         initiator = await TelegramUser.create(tg_id=1, tg_chat_id=1, status=TelegramUser.Status.IN_CONVERSATION)
         opponent = await TelegramUser.create(tg_id=2, tg_chat_id=2, status=TelegramUser.Status.IN_CONVERSATION)
@@ -133,3 +384,179 @@ class TestConversation:
 
         await opponent.refresh_from_db(fields=['status'])
         assert opponent.status == TelegramUser.Status.IN_MENU
+
+
+class TestTransitions:
+
+    async def test_start_waiting(self, executed_sql):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        await matchmaker.pop_match(user.pk)  # loads the state of the matchmaker
+        executed_sql.clear()
+
+        conversation = await Conversation.start(user)
+        assert len(executed_sql) == 2
+        assert (await TelegramUser.get(id=user.pk)).status == TelegramUser.Status.WAITING_OPPONENT
+        assert await Conversation.waiting_opponent().filter(id=conversation.pk).exists()
+
+    async def test_start_pairing(self, executed_sql):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        waiting_conversation = await Conversation.start(other_user)
+        executed_sql.clear()
+
+        conversation = await Conversation.start(user)
+        assert [sql for sql, __ in executed_sql] == [
+            Conversation.CLAIM_RETURNING_SQL, TelegramUser.SET_STATUSES_RETURNING_SQL,
+        ]
+        assert conversation.pk == waiting_conversation.pk
+        assert conversation.initiator.tg_chat_id == 20
+        assert conversation.initiator.status == TelegramUser.Status.IN_CONVERSATION
+        assert user.status == TelegramUser.Status.IN_CONVERSATION
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 2
+
+    async def test_start_pairing_without_returning(self, executed_sql, monkeypatch):
+        # like SQLite before 3.35:
+        monkeypatch.setattr(Conversation, 'CLAIM_RETURNING_SQL', None)
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        waiting_conversation = await Conversation.start(other_user)
+        executed_sql.clear()
+
+        conversation = await Conversation.start(user)
+        statements = [sql for sql, __ in executed_sql]
+        assert len(statements) == 3
+        assert (statements[0], statements[-1]) == (Conversation.CLAIM_SQL, TelegramUser.SET_STATUSES_SQL)
+        assert conversation.pk == waiting_conversation.pk
+        assert conversation.initiator.tg_chat_id == 20
+        assert conversation.initiator.status == TelegramUser.Status.IN_CONVERSATION
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 2
+
+        assert await Conversation._pair(conversation.pk, opponent=user) is None
+
+    async def test_finish(self, executed_sql):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        await Conversation.start(other_user)
+        conversation = await Conversation.start(user)
+        executed_sql.clear()
+
+        await conversation.finish()
+        assert [sql for sql, __ in executed_sql] == [Conversation.FINISH_SQL, TelegramUser.SET_STATUSES_SQL]
+        assert (await Conversation.get(id=conversation.pk)).finished_at is not None
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_MENU] * 2
+
+    async def test_finish_by_id(self, executed_sql):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        await Conversation.start(other_user)
+        conversation = await Conversation.start(user)
+        executed_sql.clear()
+
+        assert await Conversation.finish_by_id(conversation.pk, [user.pk, other_user.pk])
+        assert [sql for sql, __ in executed_sql] == [Conversation.FINISH_SQL, TelegramUser.SET_STATUSES_SQL]
+        assert await conversation_routes.get(user.pk) is None
+
+        await Conversation.start(user)
+        executed_sql.clear()
+        # already finished by the other member:
+        assert await Conversation.finish_by_id(conversation.pk, [other_user.pk, user.pk]) is None
+        assert [sql for sql, __ in executed_sql] == [Conversation.FINISH_SQL]
+        assert (await TelegramUser.get(id=user.pk)).status == TelegramUser.Status.WAITING_OPPONENT
+
+    async def test_failed_pairing_is_rolled_back(self, monkeypatch):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        waiting_conversation = await Conversation.start(other_user)
+
+        async def set_statuses(status, *user_ids, **kwargs):
+            raise ConnectionError
+
+        monkeypatch.setattr(TelegramUser, 'set_statuses', set_statuses)
+        with pytest.raises(ConnectionError):
+            await Conversation.start(user)
+
+        conversation = await Conversation.get(id=waiting_conversation.pk)
+        assert conversation.opponent_id is None
+        assert (await TelegramUser.get(id=user.pk)).status == TelegramUser.Status.IN_MENU
+
+    async def test_failed_finish_is_rolled_back(self, monkeypatch):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10)
+        other_user = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        await Conversation.start(other_user)
+        conversation = await Conversation.start(user)
+
+        async def set_statuses(status, *user_ids, **kwargs):
+            raise ConnectionError
+
+        monkeypatch.setattr(TelegramUser, 'set_statuses', set_statuses)
+        with pytest.raises(ConnectionError):
+            await conversation.finish()
+
+        assert (await Conversation.get(id=conversation.pk)).finished_at is None
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 2
+
+
+class TestPreparedQueries:
+
+    async def test_search_and_relay(self, executed_sql):
+        users = [await TelegramUser.create(tg_id=tg_id, tg_chat_id=tg_id) for tg_id in range(1, 5)]
+        user_cache.clear()
+        executed_sql.clear()
+
+        for user in users:
+            await TelegramUser.get_cached(tg_id=user.tg_id)
+            await Conversation.start(user)
+            await Conversation.find_route(user.pk)
+
+        statements = [sql for sql, __ in executed_sql]
+        assert statements.count(TelegramUser.GET_BY_TG_ID_SQL) == 4
+        assert statements.count(TelegramUser.SET_STATUSES_SQL) == 2
+        assert statements.count(TelegramUser.SET_STATUSES_RETURNING_SQL) == 2
+        assert statements.count(Conversation.CLAIM_RETURNING_SQL) == 2
+        assert statements.count(Conversation.FIND_ROUTE_SQL) == 4
+
+    async def test_get_cached(self):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=10, status=TelegramUser.Status.WAITING_OPPONENT)
+        user_cache.clear()
+
+        cached_user = await TelegramUser.get_cached(tg_id=1)
+        assert (cached_user.pk, cached_user.tg_chat_id, cached_user.status) == (user.pk, 10, user.status)
+        assert cached_user.created_at == (await TelegramUser.get(pk=user.pk)).created_at
+        assert await TelegramUser.get_cached(tg_id=2) is None
+
+
+class TestQueryPlans:
+
+    async def assert_no_sequential_scans(self, statements):
+        assert statements
+        for sql, values in list(statements):
+            plan = await explain(sql, values)
+            assert not any(is_sequential_scan(line) for line in plan), (sql, plan)
+
+    async def test_matchmaking_snapshot(self, executed_sql):
+        await Conversation.matchmaking_snapshot()
+        await self.assert_no_sequential_scans(executed_sql)
+
+    async def test_find_route(self, executed_sql):
+        await Conversation.find_route(user_id=1)
+        await self.assert_no_sequential_scans(executed_sql)
+
+    async def test_with_user_participant(self, executed_sql):
+        user = await TelegramUser.create(tg_id=1, tg_chat_id=1)
+        executed_sql.clear()
+
+        await Conversation.with_user_participant(user).filter(finished_at__isnull=True).first()
+        await Conversation.waiting_opponent().filter(initiator_id=user.pk).order_by('-id').first()
+        await self.assert_no_sequential_scans(executed_sql)
+
+    def test_is_sequential_scan(self):
+        assert is_sequential_scan('SCAN conversation')
+        assert is_sequential_scan('SCAN TABLE conversation')
+        assert is_sequential_scan('Seq Scan on conversation  (cost=0.00..1.01 rows=1 width=4)')
+        assert not is_sequential_scan('SCAN conversation USING COVERING INDEX conversation_waiting_opponent_idx')
+        assert not is_sequential_scan('SEARCH conversation USING INDEX idx_conversatio_finishe_6ef170 (finished_at>?)')
+        assert not is_sequential_scan('SCAN conversation__initiator')
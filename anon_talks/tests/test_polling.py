@@ -0,0 +1,181 @@
+import asyncio
+import random
+
+import pytest
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.webhook import SendMessage
+
+from anon_talks.polling import OffsetStore, UpdatePoller
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeSender:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    }
+
+
+@pytest.fixture
+def dispatcher(api_bot):
+    return Dispatcher(api_bot)
+
+
+@pytest.fixture
+def offset_store(tmp_path):
+    return OffsetStore(tmp_path / 'polling_state.json')
+
+
+async def run_poller(poller, processed_count):
+    task = asyncio.create_task(poller.run())
+    while poller.processed_count < processed_count:
+        await asyncio.sleep(0.01)
+    poller.stop()
+    await asyncio.wait_for(task, timeout=5)
+
+
+class TestOffsetStore:
+
+    def test_load_empty(self, offset_store):
+        assert offset_store.load() == (0, set())
+
+    def test_save(self, offset_store):
+        offset_store.save(10, {13, 12})
+        assert offset_store.load() == (10, {12, 13})
+
+
+class TestUpdatePoller:
+
+    async def test_ordered_by_chat(self, bot_api, dispatcher, offset_store):
+        bot_api.updates = [
+            make_update(update_id, chat_id=update_id % 5, text=str(update_id)) for update_id in range(1, 101)
+        ]
+        processed = []
+        in_progress = set()
+        max_concurrency = 0
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            nonlocal max_concurrency
+            assert message.chat.id not in in_progress
+            in_progress.add(message.chat.id)
+            max_concurrency = max(max_concurrency, len(in_progress))
+            await asyncio.sleep(random.uniform(0, 0.005))
+            in_progress.discard(message.chat.id)
+            processed.append((message.chat.id, int(message.text)))
+
+        poller = UpdatePoller(dispatcher, FakeSender(), offset_store, batch_size=20, poll_timeout=0, max_workers=3)
+        await run_poller(poller, processed_count=100)
+
+        assert len(processed) == 100
+        for chat_id in range(5):
+            update_ids = [update_id for chat, update_id in processed if chat == chat_id]
+            assert update_ids == list(range(chat_id or 5, 101, 5))
+        assert 1 < max_concurrency <= 3
+        assert offset_store.load() == (101, set())
+
+    async def test_offset_waits_for_update_in_progress(self, bot_api, dispatcher, offset_store):
+        bot_api.updates = [make_update(1, chat_id=1, text='slow')] + [
+            make_update(update_id, chat_id=2, text='fast') for update_id in range(2, 6)
+        ]
+        slow_update_released = asyncio.Event()
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            if message.text == 'slow':
+                await slow_update_released.wait()
+
+        poller = UpdatePoller(dispatcher, FakeSender(), offset_store, poll_timeout=0, max_workers=2)
+        task = asyncio.create_task(poller.run())
+        while poller.processed_count < 4:
+            await asyncio.sleep(0.01)
+        await poller._saver
+
+        # the slow update is still to be fetched, if the process crashes:
+        assert offset_store.load() == (1, {2, 3, 4, 5})
+        assert max(bot_api.offsets) <= 1
+
+        slow_update_released.set()
+        poller.stop()
+        await asyncio.wait_for(task, timeout=5)
+        assert offset_store.load() == (6, set())
+
+    async def test_state_saves_are_coalesced(self, bot_api, dispatcher, offset_store, monkeypatch):
+        bot_api.updates = [make_update(update_id, chat_id=update_id, text='hello') for update_id in range(1, 51)]
+        saved_offsets = []
+        save = offset_store.save
+
+        def save_counted(offset, done):
+            saved_offsets.append(offset)
+            save(offset, done)
+
+        monkeypatch.setattr(offset_store, 'save', save_counted)
+
+        poller = UpdatePoller(dispatcher, FakeSender(), offset_store, batch_size=50, poll_timeout=0, max_workers=10)
+        await run_poller(poller, processed_count=50)
+        assert len(saved_offsets) < 50
+        assert offset_store.load() == (51, set())
+
+    async def test_restart(self, bot_api, dispatcher, offset_store):
+        # the process was stopped in the middle of updates 3 and 4:
+        offset_store.save(3, {5})
+        bot_api.updates = [make_update(update_id, chat_id=update_id, text=str(update_id)) for update_id in range(1, 7)]
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            processed.append(int(message.text))
+
+        poller = UpdatePoller(dispatcher, FakeSender(), offset_store, poll_timeout=0, max_workers=2)
+        await run_poller(poller, processed_count=3)
+
+        assert sorted(processed) == [3, 4, 6]
+        assert bot_api.offsets[0] == 3
+        assert offset_store.load() == (7, set())
+
+    async def test_send_response(self, bot_api, dispatcher, offset_store):
+        bot_api.updates = [make_update(1, chat_id=10, text='hello')]
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            return SendMessage(message.chat.id, f'{message.text} back')
+
+        sender = FakeSender()
+        poller = UpdatePoller(dispatcher, sender, offset_store, poll_timeout=0)
+        await run_poller(poller, processed_count=1)
+
+        assert sender.sent == [(10, 'hello back')]
+
+    async def test_failed_update(self, bot_api, dispatcher, offset_store):
+        bot_api.updates = [make_update(update_id, chat_id=1, text=str(update_id)) for update_id in (1, 2)]
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handle(message):
+            processed.append(int(message.text))
+            if message.text == '1':
+                raise ValueError
+
+        poller = UpdatePoller(dispatcher, FakeSender(), offset_store, poll_timeout=0)
+        await run_poller(poller, processed_count=2)
+
+        # a failed update isn't retried, not to block its chat:
+        assert processed == [1, 2]
+        assert offset_store.load() == (3, set())
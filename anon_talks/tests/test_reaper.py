@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from anon_talks import models
+from anon_talks.models import Conversation, TelegramUser, matchmaker, user_cache
+from anon_talks.reaper import WaitingReaper
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures('db')]
+
+
+class FakeSender:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+async def start_search(tg_id, started_at):
+    user = await TelegramUser.create(tg_id=tg_id, tg_chat_id=tg_id * 10, status=TelegramUser.Status.WAITING_OPPONENT)
+    user_cache.put(user)
+    conversation = await Conversation.create(initiator=user)
+    await Conversation.filter(id=conversation.pk).update(created_at=started_at)
+    return user, conversation
+
+
+class TestWaitingReaper:
+
+    @pytest.fixture(params=['returning', 'without_returning'], autouse=True)
+    def returning(self, request, monkeypatch):
+        if request.param == 'without_returning':  # like SQLite before 3.35
+            monkeypatch.setattr(models, 'supports_returning', lambda connection: False)
+
+    async def test_reap(self):
+        now = datetime.now()
+        stale_searches = [await start_search(tg_id, started_at=now - timedelta(minutes=20)) for tg_id in (1, 2)]
+        fresh_user, fresh_conversation = await start_search(3, started_at=now)
+        changed_users = []
+
+        async def on_users_changed(*user_ids):
+            changed_users.extend(user_ids)
+
+        sender = FakeSender()
+        reaper = WaitingReaper(sender, search_timeout=timedelta(minutes=10), on_users_changed=on_users_changed)
+        assert await reaper.reap() == 2
+        assert reaper.reaped_count == 2
+
+        assert sorted(sender.sent) == [10, 20]
+        assert sorted(changed_users) == [user.pk for user, __ in stale_searches]
+        for user, conversation in stale_searches:
+            assert (await Conversation.get(id=conversation.pk)).finished_at is not None
+            assert (await TelegramUser.get(id=user.pk)).status == TelegramUser.Status.IN_MENU
+            assert user_cache.get(user.tg_id).status == TelegramUser.Status.IN_MENU
+
+        assert (await Conversation.get(id=fresh_conversation.pk)).finished_at is None
+        # the reaped searches are out of the queue:
+        opponent = await TelegramUser.create(tg_id=4, tg_chat_id=40)
+        assert await matchmaker.pop_match(opponent.pk) == fresh_conversation.pk
+
+    async def test_reap_batch(self):
+        started_at = datetime.now() - timedelta(minutes=20)
+        for tg_id in range(1, 4):
+            await start_search(tg_id, started_at=started_at)
+
+        reaper = WaitingReaper(FakeSender(), search_timeout=timedelta(minutes=10), batch_size=2)
+        assert await reaper.reap() == 2
+        assert await reaper.reap() == 1
+        assert await reaper.reap() == 0
+
+    async def test_reap_skips_claimed(self):
+        user, conversation = await start_search(1, started_at=datetime.now() - timedelta(minutes=20))
+        opponent = await TelegramUser.create(tg_id=2, tg_chat_id=20)
+        await Conversation._pair(conversation.pk, opponent=opponent)
+
+        sender = FakeSender()
+        assert await WaitingReaper(sender, search_timeout=timedelta(minutes=10)).reap() == 0
+
+        conversation = await Conversation.get(id=conversation.pk)
+        assert conversation.finished_at is None
+        assert conversation.opponent_id == opponent.pk
+        assert sender.sent == []
+        statuses = await TelegramUser.all().values_list('status', flat=True)
+        assert statuses == [TelegramUser.Status.IN_CONVERSATION] * 2
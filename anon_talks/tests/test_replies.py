@@ -0,0 +1,23 @@
+import ujson
+from aiogram.dispatcher.webhook import SendMessage
+
+from anon_talks.replies import StaticReply, make_keyboard
+
+
+class TestStaticReply:
+
+    def test_web_response(self):
+        keyboard = make_keyboard('[Кнопка]')
+        reply = StaticReply('*Привет\\!*', 'MarkdownV2', keyboard)
+        expected = SendMessage(10, '*Привет\\!*', parse_mode='MarkdownV2', reply_markup=keyboard).get_response()
+
+        response = reply.to(10)
+        assert ujson.loads(reply.encode(10)) == expected
+        assert ujson.loads(response.get_web_response().body) == expected
+        assert response.get_response() == expected
+
+    def test_web_response_without_keyboard(self):
+        reply = StaticReply('Hello')
+
+        assert ujson.loads(reply.encode(10)) == {'method': 'sendMessage', 'chat_id': 10, 'text': 'Hello'}
+        assert reply.reply_markup is None
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+
+from anon_talks.routing import ConversationRoutes, Route
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestConversationRoutes:
+
+    async def test_get_added(self):
+        async def loader(user_id):
+            raise AssertionError('should not be called')
+
+        routes = ConversationRoutes(loader=loader)
+        user = SimpleNamespace(pk=1, tg_chat_id=10)
+        opponent = SimpleNamespace(pk=2, tg_chat_id=20)
+        routes.add(conversation_id=5, user=user, opponent=opponent)
+
+        assert await routes.get(1) == Route(conversation_id=5, opponent_id=2, opponent_chat_id=20)
+        assert await routes.get(2) == Route(conversation_id=5, opponent_id=1, opponent_chat_id=10)
+
+    async def test_get_loads_missing(self):
+        loaded = []
+
+        async def loader(user_id):
+            loaded.append(user_id)
+            return Route(conversation_id=5, opponent_id=2, opponent_chat_id=20) if user_id == 1 else None
+
+        routes = ConversationRoutes(loader=loader)
+        assert await routes.get(1) == Route(conversation_id=5, opponent_id=2, opponent_chat_id=20)
+        assert await routes.get(1) == Route(conversation_id=5, opponent_id=2, opponent_chat_id=20)
+        assert await routes.get(3) is None
+        assert loaded == [1, 3]
+
+    async def test_remove(self):
+        async def loader(user_id):
+            return None
+
+        routes = ConversationRoutes(loader=loader)
+        routes.add(conversation_id=5, user=SimpleNamespace(pk=1, tg_chat_id=10),
+                   opponent=SimpleNamespace(pk=2, tg_chat_id=20))
+        routes.remove(1, 2)
+
+        assert len(routes) == 0
+        assert await routes.get(1) is None
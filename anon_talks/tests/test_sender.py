@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+
+from anon_talks.sender import MessageSender, TokenBucket
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeBot:
+
+    def __init__(self, delay=0, errors=None):
+        self.delay = delay
+        self.errors = errors or {}  # text -> list of exceptions to raise one by one
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        errors = self.errors.get(text)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return f'{chat_id}:{text}'
+
+
+@pytest.fixture
+async def make_sender():
+    senders = []
+
+    def make_sender(bot, global_rate=1000, chat_rate=1000, chat_burst=1000, **kwargs):
+        sender = MessageSender(bot, global_rate=global_rate, chat_rate=chat_rate, chat_burst=chat_burst, **kwargs)
+        senders.append(sender)
+        return sender
+
+    yield make_sender
+    for sender in senders:
+        await sender.close()
+
+
+class TestTokenBucket:
+
+    def test_time_to_token(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = time.monotonic()
+
+        bucket.take(now)
+        bucket.take(now)
+        assert bucket.time_to_token(now) == pytest.approx(0.5)
+        assert bucket.time_to_token(now + 0.5) == 0
+
+    def test_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = time.monotonic() + 100
+
+        bucket.take(now)
+        bucket.take(now)
+        assert bucket.time_to_token(now) > 0
+
+
+class TestMessageSender:
+
+    async def test_send_message(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot)
+
+        result = await sender.send_message(1, 'hello', parse_mode='MarkdownV2')
+        assert result == '1:hello'
+        assert sender.pending_count == 0
+
+    async def test_chat_order(self, make_sender):
+        bot = FakeBot(delay=0.005)
+        sender = make_sender(bot)
+
+        await asyncio.gather(*(
+            sender.send_message(chat_id, f'{chat_id}-{number}')
+            for number in range(10)
+            for chat_id in (1, 2)
+        ))
+        for chat_id in (1, 2):
+            texts = [text for sent_chat_id, text, __ in bot.sent if sent_chat_id == chat_id]
+            assert texts == [f'{chat_id}-{number}' for number in range(10)]
+
+    async def test_chat_rate(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, chat_rate=20, chat_burst=1)
+
+        await asyncio.gather(*(sender.send_message(1, str(number)) for number in range(3)))
+        sent_times = [sent_at for __, __, sent_at in bot.sent]
+        assert sent_times[2] - sent_times[0] >= 0.09
+
+    async def test_chat_rate_of_spaced_calls(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, chat_rate=20, chat_burst=3)
+
+        for number in range(10):
+            await sender.send_message(1, str(number))  # the queue of the chat is drained by every call
+            await asyncio.sleep(0.005)
+        sent_times = [sent_at for __, __, sent_at in bot.sent]
+        # the burst, then a call per 1 / chat_rate seconds:
+        assert sent_times[-1] - sent_times[0] >= 7 / 20 - 0.01
+
+    async def test_idle_chat_bucket_is_dropped_when_full(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, chat_rate=100, chat_burst=2)
+
+        await sender.send_message(1, 'hello')
+        await sender.send_message(2, 'hello')
+        assert set(sender._chat_buckets) == {1, 2}
+        await asyncio.sleep(0.02)
+        await sender.send_message(3, 'hello')
+        assert set(sender._chat_buckets) == {3}
+
+    async def test_global_rate(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, global_rate=20)
+
+        started_at = time.monotonic()
+        await asyncio.gather(*(sender.send_message(chat_id, 'hello') for chat_id in range(30)))
+        assert time.monotonic() - started_at >= 0.45
+
+    async def test_set_global_rate(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, global_rate=1000)
+        sender.set_global_rate(20)
+
+        started_at = time.monotonic()
+        await asyncio.gather(*(sender.send_message(chat_id, 'hello') for chat_id in range(30)))
+        assert time.monotonic() - started_at >= 0.45
+
+    async def test_priority(self, make_sender):
+        bot = FakeBot()
+        sender = make_sender(bot, global_rate=100)
+
+        relayed = [sender.send_message(chat_id, 'relayed') for chat_id in range(150)]
+        tasks = [asyncio.create_task(coro) for coro in relayed]
+        await asyncio.sleep(0.1)
+        await sender.send_message(1000, 'system', priority=MessageSender.PRIORITY_HIGH)
+
+        sent_texts = [text for __, text, __ in bot.sent]
+        assert sent_texts.index('system') < 150
+        await asyncio.gather(*tasks)
+
+    async def test_retry_after(self, make_sender):
+        bot = FakeBot(errors={'first': [RetryAfter(0)]})
+        sender = make_sender(bot)
+
+        results = await asyncio.gather(sender.send_message(1, 'first'), sender.send_message(1, 'second'))
+        assert results == ['1:first', '1:second']
+        assert [text for __, text, __ in bot.sent] == ['first', 'second']
+
+    async def test_retry_after_max_retries(self, make_sender):
+        bot = FakeBot(errors={'first': [RetryAfter(0), RetryAfter(0)]})
+        sender = make_sender(bot, max_retries=1)
+
+        with pytest.raises(RetryAfter):
+            await sender.send_message(1, 'first')
+
+    async def test_error(self, make_sender):
+        bot = FakeBot(errors={'first': [BotBlocked('Forbidden: bot was blocked by the user')]})
+        sender = make_sender(bot)
+
+        first, second = await asyncio.gather(
+            sender.send_message(1, 'first'), sender.send_message(1, 'second'), return_exceptions=True,
+        )
+        assert isinstance(first, BotBlocked)
+        assert second == '1:second'
@@ -0,0 +1,291 @@
+import copy
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+import ujson
+from aiogram.dispatcher.webhook import SendMessage
+from aiogram.types import Message
+from tortoise import Tortoise
+
+from anon_talks.instrumentation import install_query_hook, track_queries
+from anon_talks.models import Conversation, TelegramUser
+from anon_talks.sender import MessageSender
+from anon_talks.services import BotService, conversation_analytics, media_groups
+from anon_talks.storage import MemoryStorage, TortoiseStorage
+from anon_talks.tests.test_analytics import FakePipeline
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeSender:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def make_message(user_id, text):
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=user_id * 10), text=text, media_group_id=None,
+    )
+
+
+def make_media_message(message_id, user_id, media_group_id=None, **content):
+    return Message.to_object({
+        'message_id': message_id,
+        'date': 0,
+        'chat': {'id': user_id * 10, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+        'media_group_id': media_group_id,
+        **content,
+    })
+
+
+def make_photo(file_id):
+    return [
+        {'file_id': f'{file_id}_small', 'file_unique_id': f'{file_id}_small', 'width': 90, 'height': 90},
+        {'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 800},
+    ]
+
+
+@pytest.fixture
+def sender():
+    return FakeSender()
+
+
+@pytest.fixture
+def storage():
+    # the service is tested on the state in memory, the storages are tested by their contract in test_storage:
+    return MemoryStorage(recent_timeout=timedelta(minutes=5), widen_after=timedelta(seconds=30))
+
+
+@pytest.fixture
+def service(sender, storage):
+    return BotService(sender, storage=storage)
+
+
+class TestBotService:
+
+    async def test_register_user(self, service, sender, storage):
+        response = await service.register_user(user_id=1, chat_id=10)
+
+        assert isinstance(response, SendMessage)
+        assert response.chat_id == 10
+        assert response.text == BotService.START_TEXT
+        assert (await storage.get_user(1)).tg_chat_id == 10
+        assert sender.sent == []
+
+    async def test_register_user_who_blocked_bot(self, service, sender, storage):
+        await service.register_user(user_id=1, chat_id=10)
+        (await storage.get_user(1)).blocked_at = datetime.now()
+
+        await service.register_user(user_id=1, chat_id=10)
+        assert (await storage.get_user(1)).blocked_at is None
+
+    async def test_handle_message_not_registered(self, service, sender):
+        response = await service.handle_message(make_message(user_id=1, text='hello'))
+
+        assert response.chat_id == 10
+        assert '/start' in response.text
+        assert sender.sent == []
+
+    async def test_search_and_chat(self, service, sender, storage):
+        await service.register_user(user_id=1, chat_id=10)
+        await service.register_user(user_id=2, chat_id=20)
+
+        response = await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        assert response.chat_id == 10
+        assert response.text == "Ищем свободного собеседника..."
+        assert sender.sent == []
+
+        response = await service.handle_message(make_message(user_id=2, text=BotService.START_CONVERSATION_BTN))
+        assert response.chat_id == 20
+        assert response.text == "*Собеседник найден \\- общайтесь*"
+        assert sender.sent == [(10, "*Собеседник найден \\- общайтесь*")]
+
+        response = await service.handle_message(make_message(user_id=2, text='hello'))
+        assert response is None
+        assert sender.sent[-1] == (10, 'hello')
+
+        response = await service.handle_message(make_message(user_id=1, text=BotService.COMPLETE_CONVERSATION_BTN))
+        assert response.chat_id == 10
+        assert response.text == "*Вы завершили чат\\.*"
+        assert sender.sent[-1] == (20, "*Собеседник завершил чат\\.*")
+        user = await storage.get_user(1)
+        assert user.status == TelegramUser.Status.IN_MENU
+        assert await storage.get_route(user.pk) is None
+
+    async def test_message_after_finished_conversation(self, service, sender, storage):
+        await service.register_user(user_id=1, chat_id=10)
+        await service.register_user(user_id=2, chat_id=20)
+        await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        await service.handle_message(make_message(user_id=2, text=BotService.START_CONVERSATION_BTN))
+        # the status is read before the opponent finishes the conversation:
+        user = copy.copy(await storage.get_user(2))
+        await service.handle_message(make_message(user_id=1, text=BotService.COMPLETE_CONVERSATION_BTN))
+        sent_count = len(sender.sent)
+
+        response = await service.handle_in_conversation(make_message(user_id=2, text='hello'), user)
+        assert response.chat_id == 20
+        assert response.text == "*Чат уже завершён\\.*"
+        assert len(sender.sent) == sent_count
+        assert (await storage.get_user(2)).status == TelegramUser.Status.IN_MENU
+
+    async def test_conversation_analytics(self, service, sender, storage):
+        pipeline = FakePipeline()
+        conversation_analytics.start(pipeline)
+        for user_id in (1, 2, 3):
+            await service.register_user(user_id=user_id, chat_id=user_id * 10)
+        await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        await service.handle_message(make_message(user_id=2, text=BotService.START_CONVERSATION_BTN))
+        user2 = await storage.get_user(2)
+        route = await storage.get_route(user2.pk)
+        await service.handle_message(make_message(user_id=1, text='hello'))
+        await service.handle_message(make_message(user_id=2, text='hi'))
+        await service.handle_message(make_message(user_id=2, text=BotService.COMPLETE_CONVERSATION_BTN))
+        await service.handle_message(make_message(user_id=3, text=BotService.START_CONVERSATION_BTN))
+        await service.handle_message(make_message(user_id=3, text=BotService.CANCEL_WAITING_OPPONENT_BTN))
+        await conversation_analytics.close()
+
+        assert pipeline.messages[0] == (
+            'Conversation finished: 2 messages, 0 s', route.conversation_id, f'user_{user2.pk}',
+        )
+        assert pipeline.messages[1][0].startswith('Rollup: 2 searches, 1 matches, 1 cancelled, 0 timed out;')
+        assert len(pipeline.messages) == 2
+
+    async def test_set_tags(self, service, sender, storage):
+        await service.register_user(user_id=1, chat_id=10)
+
+        response = await service.set_tags(user_id=1, chat_id=10, text='#Music, movies')
+        assert response.chat_id == 10
+        assert response.text == "Теги поиска: music, movies. Сначала ищем собеседников с общими тегами."
+        assert (await storage.get_user(1)).tags == 'music,movies'
+
+        response = await service.set_tags(user_id=1, chat_id=10, text='')
+        assert response.text == "Теги поиска удалены, ищем любого собеседника."
+        assert (await storage.get_user(1)).tags == ''
+
+        response = await service.set_tags(user_id=2, chat_id=20, text='music')
+        assert '/start' in response.text
+
+    async def test_cancel_search(self, service, sender, storage):
+        await service.register_user(user_id=1, chat_id=10)
+        await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+
+        response = await service.handle_message(make_message(user_id=1, text=BotService.CANCEL_WAITING_OPPONENT_BTN))
+        assert response.chat_id == 10
+        assert response.text == "*Поиск отменён\\.*"
+        assert (await storage.get_user(1)).status == TelegramUser.Status.IN_MENU
+        assert not await storage.cancel_search(await storage.get_user(1))
+        assert sender.sent == []
+
+
+@pytest.fixture
+async def api_sender(api_bot):
+    sender = MessageSender(api_bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+    yield sender
+    await sender.close()
+
+
+@pytest.fixture
+async def api_service(api_sender, storage):
+    service = BotService(api_sender, storage=storage)
+    for user_id in (1, 2):
+        await service.register_user(user_id=user_id, chat_id=user_id * 10)
+        await service.handle_message(make_message(user_id=user_id, text=BotService.START_CONVERSATION_BTN))
+    return service
+
+
+class TestStatements:
+    """
+    SQL statements of handling an update with the storage in the database, users and routes are cached.
+    """
+
+    @pytest.fixture(autouse=True)
+    def query_hook(self, db):
+        install_query_hook(type(Tortoise.get_connection('anon_talks')))
+
+    @pytest.fixture
+    async def service(self, sender):
+        storage = TortoiseStorage()
+        await storage.load()
+        service = BotService(sender, storage=storage)
+        await service.register_user(user_id=1, chat_id=10)
+        await service.register_user(user_id=2, chat_id=20)
+        return service
+
+    async def test_search(self, service):
+        with track_queries() as stats:
+            await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        assert stats.count == 2  # the conversation is created, the status is set
+
+    async def test_pairing(self, service):
+        await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        with track_queries() as stats:
+            await service.handle_message(make_message(user_id=2, text=BotService.START_CONVERSATION_BTN))
+        # the claimed conversation is read by a SELECT, if the DB doesn't support RETURNING:
+        assert stats.count == (2 if Conversation.CLAIM_RETURNING_SQL else 3)
+
+    async def test_complete_conversation(self, service):
+        await service.handle_message(make_message(user_id=1, text=BotService.START_CONVERSATION_BTN))
+        await service.handle_message(make_message(user_id=2, text=BotService.START_CONVERSATION_BTN))
+        with track_queries() as stats:
+            await service.handle_message(make_message(user_id=1, text='hello'))
+        assert stats.count == 0
+
+        with track_queries() as stats:
+            await service.handle_message(make_message(user_id=1, text=BotService.COMPLETE_CONVERSATION_BTN))
+        assert stats.count == 2  # the conversation is finished by the route, the statuses are set
+        assert not await Conversation.in_progress().exists()
+
+
+class TestRelay:
+
+    @pytest.mark.parametrize('content', [
+        {'photo': make_photo('photo'), 'caption': 'look'},
+        {'voice': {'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 3}},
+        {'sticker': {'file_id': 'sticker', 'file_unique_id': 'sticker', 'width': 512, 'height': 512,
+                     'is_animated': False}},
+        {'document': {'file_id': 'document', 'file_unique_id': 'document'}},
+    ])
+    async def test_relay_media(self, api_service, bot_api, content):
+        await api_service.handle_message(make_media_message(message_id=7, user_id=2, **content))
+
+        assert bot_api.get_calls('copyMessage') == [{'chat_id': '10', 'from_chat_id': '20', 'message_id': '7'}]
+        # nothing is uploaded:
+        assert all(content_type != 'multipart/form-data' for __, __, content_type in bot_api.calls)
+
+    async def test_relay_media_group(self, api_service, bot_api):
+        await api_service.handle_message(make_media_message(
+            message_id=7, user_id=2, media_group_id='album', photo=make_photo('first'), caption='look',
+        ))
+        await api_service.handle_message(make_media_message(
+            message_id=8, user_id=2, media_group_id='album', video={
+                'file_id': 'second', 'file_unique_id': 'second', 'width': 640, 'height': 480, 'duration': 5,
+            },
+        ))
+        assert bot_api.get_calls('sendMediaGroup') == []
+
+        await media_groups.close()
+        calls = bot_api.get_calls('sendMediaGroup')
+        assert len(calls) == 1
+        assert calls[0]['chat_id'] == '10'
+        assert ujson.loads(calls[0]['media']) == [
+            {'type': 'photo', 'media': 'first', 'caption': 'look'},
+            {'type': 'video', 'media': 'second'},
+        ]
+        assert bot_api.get_calls('copyMessage') == []
+
+    async def test_relay_media_group_before_later_message(self, api_service, bot_api):
+        await api_service.handle_message(
+            make_media_message(message_id=7, user_id=2, media_group_id='album', photo=make_photo('first'))
+        )
+        await api_service.handle_message(make_message(user_id=2, text='what do you think?'))
+
+        methods = [method for method, __, __ in bot_api.calls]
+        assert methods[-2:] == ['sendMediaGroup', 'sendMessage']
+        assert len(media_groups) == 0
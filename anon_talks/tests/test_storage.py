@@ -0,0 +1,430 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+import ujson
+
+from anon_talks.journal import Journal, JournalError
+from anon_talks.archive import ConversationArchiver
+from anon_talks.models import ArchivedConversation, Conversation, TelegramUser, user_cache
+from anon_talks.storage import MemoryStorage, TortoiseStorage, WriteBehindStorage
+
+
+pytestmark = pytest.mark.asyncio
+
+ROOT = str(Path(__file__).resolve().parent.parent.parent)
+
+
+def make_write_behind_storage(tmp_path, max_users=1000):
+    return WriteBehindStorage(
+        recent_timeout=timedelta(minutes=5),
+        widen_after=timedelta(seconds=30),
+        journal=Journal(tmp_path / 'journal', segment_size=1024),
+        flush_interval=3600,  # flushed explicitly by tests
+        flush_batch_size=5,
+        max_users=max_users,
+    )
+
+
+@pytest.fixture(params=['tortoise', 'memory', 'write_behind'])
+def storage_backend(request):
+    if request.param != 'memory':
+        request.getfixturevalue('db')  # outside of the event loop, as the fixture runs it
+    return request.param
+
+
+@pytest.fixture
+async def storage(storage_backend, tmp_path):
+    # the contract of the storage, every implementation must pass the tests:
+    if storage_backend == 'memory':
+        storage = MemoryStorage(recent_timeout=timedelta(minutes=5), widen_after=timedelta(seconds=30))
+    elif storage_backend == 'write_behind':
+        storage = make_write_behind_storage(tmp_path)
+    else:
+        storage = TortoiseStorage()
+    await storage.load()
+    yield storage
+    await storage.close()
+
+
+async def register(storage, *tg_ids):
+    return [(await storage.register_user(tg_id=tg_id, chat_id=tg_id * 10))[0] for tg_id in tg_ids]
+
+
+async def get_status(storage, user):
+    return (await storage.get_user(user.tg_id)).status
+
+
+async def finish_conversation(storage, user):
+    route = await storage.get_route(user.pk)
+    await storage.finish_conversation(route.conversation_id, (user.pk, route.opponent_id))
+
+
+class TestStorage:
+
+    async def test_register_user(self, storage):
+        assert await storage.get_user(1) is None
+
+        user, is_created = await storage.register_user(tg_id=1, chat_id=10)
+        assert is_created
+        assert (user.tg_id, user.tg_chat_id, user.status) == (1, 10, TelegramUser.Status.IN_MENU)
+
+        same_user, is_created = await storage.register_user(tg_id=1, chat_id=10)
+        assert not is_created
+        assert same_user.pk == user.pk
+        assert (await storage.get_user(1)).pk == user.pk
+
+    async def test_set_tags(self, storage):
+        user, = await register(storage, 1)
+        await storage.set_tags(user, ['music', 'movies'])
+
+        assert (await storage.get_user(1)).get_tags() == ('music', 'movies')
+
+    async def test_start_conversation(self, storage):
+        user1, user2 = await register(storage, 1, 2)
+
+        assert await storage.start_conversation(user1) is None
+        assert await get_status(storage, user1) == TelegramUser.Status.WAITING_OPPONENT
+        assert await storage.get_route(user1.pk) is None
+
+        opponent = await storage.start_conversation(user2)
+        assert opponent.pk == user1.pk
+        assert opponent.tg_chat_id == 10
+        assert await get_status(storage, user1) == TelegramUser.Status.IN_CONVERSATION
+        assert await get_status(storage, user2) == TelegramUser.Status.IN_CONVERSATION
+
+        route1, route2 = await storage.get_route(user1.pk), await storage.get_route(user2.pk)
+        assert route1.conversation_id == route2.conversation_id
+        assert (route1.opponent_id, route1.opponent_chat_id) == (user2.pk, 20)
+        assert (route2.opponent_id, route2.opponent_chat_id) == (user1.pk, 10)
+
+    async def test_start_conversation_not_with_own(self, storage):
+        user, = await register(storage, 1)
+        await storage.start_conversation(user)
+        await storage.cancel_search(user)
+
+        assert await storage.start_conversation(user) is None
+
+    async def test_start_conversation_by_tags(self, storage):
+        user1, user2, user3 = await register(storage, 1, 2, 3)
+        await storage.set_tags(user1, ['music'])
+        await storage.start_conversation(user1)
+
+        assert await storage.start_conversation(user2) is None
+        assert (await storage.start_conversation(user3, tags=['movies', 'music'])).pk == user1.pk
+
+    async def test_finish_conversation(self, storage):
+        user1, user2 = await register(storage, 1, 2)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+
+        await finish_conversation(storage, user1)
+        assert await get_status(storage, user1) == TelegramUser.Status.IN_MENU
+        assert await get_status(storage, user2) == TelegramUser.Status.IN_MENU
+        assert await storage.get_route(user1.pk) is None
+        assert await storage.get_route(user2.pk) is None
+
+    async def test_finish_finished_conversation(self, storage):
+        user1, user2 = await register(storage, 1, 2)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        route = await storage.get_route(user1.pk)
+        await storage.finish_conversation(route.conversation_id, (user1.pk, user2.pk))
+        await storage.start_conversation(user1)
+
+        # both members disconnect at once, by the route, cached before the finish:
+        await storage.finish_conversation(route.conversation_id, (user2.pk, user1.pk))
+        assert await get_status(storage, user1) == TelegramUser.Status.WAITING_OPPONENT
+
+    async def test_return_to_menu(self, storage):
+        user1, user2, user3 = await register(storage, 1, 2, 3)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await storage.start_conversation(user3)
+        await storage.return_to_menu(user1)
+        await storage.return_to_menu(user3)
+        assert await get_status(storage, user1) == TelegramUser.Status.IN_CONVERSATION
+        assert await get_status(storage, user3) == TelegramUser.Status.WAITING_OPPONENT
+
+        # the status is left behind by a conversation, e.g. the state is restored from a backup:
+        await finish_conversation(storage, user1)
+        if isinstance(storage, MemoryStorage):
+            (await storage.get_user(1)).status = TelegramUser.Status.IN_CONVERSATION
+        else:
+            await TelegramUser.filter(id=user1.pk).update(status=TelegramUser.Status.IN_CONVERSATION)
+            user_cache.invalidate(user1.pk)
+        await storage.return_to_menu(await storage.get_user(1))
+        assert await get_status(storage, user1) == TelegramUser.Status.IN_MENU
+
+    async def test_not_paired_with_recent_opponent(self, storage, freezer):
+        freezer.move_to("2021-03-07 12:30")
+        user1, user2 = await register(storage, 1, 2)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await finish_conversation(storage, user1)
+
+        await storage.start_conversation(user1)
+        assert await storage.start_conversation(user2) is None
+
+        freezer.move_to("2021-03-07 12:36")
+        await storage.cancel_search(user2)
+        assert (await storage.start_conversation(user2)).pk == user1.pk
+
+    async def test_cancel_search(self, storage):
+        user1, user2 = await register(storage, 1, 2)
+        assert not await storage.cancel_search(user1)
+
+        await storage.start_conversation(user1)
+        assert await storage.cancel_search(user1)
+        assert await get_status(storage, user1) == TelegramUser.Status.IN_MENU
+        assert not await storage.cancel_search(user1)
+
+        assert await storage.start_conversation(user2) is None
+
+    async def test_finish_stale_searches(self, storage, freezer):
+        freezer.move_to("2021-03-07 12:00")
+        user1, user2, user3, user4 = await register(storage, 1, 2, 3, 4)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)  # paired, so not a search anymore
+        await storage.start_conversation(user3)
+
+        freezer.move_to("2021-03-07 12:20")
+        created_before = datetime(2021, 3, 7, 12, 10)
+        assert await storage.finish_stale_searches(created_before=created_before, limit=10) == [(user3.pk, 30)]
+        assert await get_status(storage, user3) == TelegramUser.Status.IN_MENU
+
+        await storage.start_conversation(user4)
+        assert await storage.finish_stale_searches(created_before=created_before, limit=10) == []
+        assert await get_status(storage, user4) == TelegramUser.Status.WAITING_OPPONENT
+        user5, = await register(storage, 5)
+        assert (await storage.start_conversation(user5)).pk == user4.pk
+
+    async def test_finish_stale_searches_by_limit(self, storage, freezer):
+        freezer.move_to("2021-03-07 12:00")
+        users = await register(storage, 1, 2, 3)
+        await storage.set_tags(users[0], ['music'])
+        await storage.set_tags(users[1], ['movies'])
+        await storage.set_tags(users[2], ['books'])
+        for user in users:
+            await storage.start_conversation(user)
+
+        freezer.move_to("2021-03-07 12:30")
+        finished = await storage.finish_stale_searches(created_before=datetime(2021, 3, 7, 12, 10), limit=2)
+        assert finished == [(users[0].pk, 10), (users[1].pk, 20)]
+        assert await get_status(storage, users[2]) == TelegramUser.Status.WAITING_OPPONENT
+
+
+@pytest.mark.usefixtures('db')
+class TestWriteBehindStorage:
+
+    async def test_flush(self, tmp_path):
+        storage = make_write_behind_storage(tmp_path)
+        await storage.load()
+        user1, user2, user3 = await register(storage, 1, 2, 3)
+        await storage.set_tags(user3, ['music'])
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await storage.start_conversation(user3)
+        await finish_conversation(storage, user1)
+        assert not await Conversation.all().count()
+
+        assert await storage.flush() == 5
+        conversations = await Conversation.all().order_by('id').values_list(
+            'initiator_id', 'opponent_id', 'tags', 'finished_at',
+        )
+        assert [conversation[:3] for conversation in conversations] == [
+            (user1.pk, user2.pk, ''), (user3.pk, None, 'music'),
+        ]
+        assert conversations[0][3] and not conversations[1][3]
+        statuses = dict(await TelegramUser.all().values_list('tg_id', 'status'))
+        assert statuses == {
+            1: TelegramUser.Status.IN_MENU,
+            2: TelegramUser.Status.IN_MENU,
+            3: TelegramUser.Status.WAITING_OPPONENT,
+        }
+        assert (await TelegramUser.get(tg_id=3)).tags == 'music'
+
+        assert await storage.flush() == 0
+        await storage.close()
+
+    async def test_replay_on_load(self, tmp_path):
+        storage = make_write_behind_storage(tmp_path)
+        await storage.load()
+        user1, user2, user3, user4 = await register(storage, 1, 2, 3, 4)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await storage.start_conversation(user3)
+        await storage.flush()
+        await storage.cancel_search(user3)
+        await storage.start_conversation(user4)
+        # a crash: the flusher is stopped and the rest of the journal isn't applied
+        storage._flusher.cancel()
+        await storage._journal.close()
+
+        restarted = make_write_behind_storage(tmp_path)
+        await restarted.load()
+        assert await Conversation.filter(finished_at__isnull=True).count() == 2
+        assert await get_status(restarted, user1) == TelegramUser.Status.IN_CONVERSATION
+        assert await get_status(restarted, user3) == TelegramUser.Status.IN_MENU
+        assert (await restarted.get_route(user1.pk)).opponent_id == user2.pk
+
+        user5, = await register(restarted, 5)
+        assert (await restarted.start_conversation(user5)).pk == user4.pk
+        await restarted.close()
+        assert set(await Conversation.all().values_list('id', flat=True)) == {1, 2, 3}
+
+    async def test_users_are_evicted(self, tmp_path):
+        storage = make_write_behind_storage(tmp_path, max_users=2)
+        await storage.load()
+        user1, user2 = await register(storage, 1, 2)
+        await storage.set_tags(user1, ['music'])
+        await storage.start_conversation(user2)
+
+        await register(storage, 3, 4)
+        # the tags of the first user are not flushed yet, the second one is searching:
+        assert set(storage._users) == {1, 2, 4}
+        await storage.flush()
+        assert set(storage._users) == {2, 4}
+        user1 = await storage.get_user(1)
+        assert user1.get_tags() == ('music',)
+        assert (await storage.start_conversation(user1, tags=())).pk == user2.pk
+        await storage.close()
+
+    async def test_replay_of_archived_conversation(self, tmp_path):
+        storage = make_write_behind_storage(tmp_path)
+        await storage.load()
+        user1, user2 = await register(storage, 1, 2)
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await finish_conversation(storage, user1)
+        await storage.close()
+        archiver = ConversationArchiver(archive_after=timedelta(0))
+        assert await archiver.archive_batch(finished_before=datetime.now() + timedelta(minutes=1)) == 1
+
+        # the watermark isn't fsynced, so the flushed entries may be replayed:
+        (tmp_path / 'journal' / Journal.WATERMARK_NAME).unlink()
+        restarted = make_write_behind_storage(tmp_path)
+        await restarted.load()
+        assert not await Conversation.all().exists()
+        assert await ArchivedConversation.all().count() == 1
+        await restarted.close()
+
+    async def test_failed_transitions_are_undone(self, tmp_path, monkeypatch):
+        storage = make_write_behind_storage(tmp_path)
+        await storage.load()
+        user1, user2, user3, user4, user5 = await register(storage, 1, 2, 3, 4, 5)
+        await storage.set_tags(user5, ['music'])
+        await storage.start_conversation(user1)
+        await storage.start_conversation(user2)
+        await storage.start_conversation(user3)
+        route = await storage.get_route(user1.pk)
+
+        def fail():
+            raise OSError('No space left on device')
+
+        monkeypatch.setattr(storage._journal, '_sync', fail)
+        results = await asyncio.gather(
+            storage.start_conversation(user4),  # paired with user3
+            storage.start_conversation(user5, ['movies']),
+            finish_conversation(storage, user1),
+            storage.set_tags(user5, ['movies']),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, OSError) for result in results)
+        with pytest.raises(JournalError):
+            await storage.set_tags(user5, ['movies'])
+
+        assert await get_status(storage, user3) == TelegramUser.Status.WAITING_OPPONENT
+        assert await get_status(storage, user4) == TelegramUser.Status.IN_MENU
+        assert await storage.get_route(user4.pk) is None
+        assert await get_status(storage, user5) == TelegramUser.Status.IN_MENU
+        assert (await storage.get_user(5)).get_tags() == ('music',)
+        assert await storage.get_route(user1.pk) == route
+        assert await get_status(storage, user2) == TelegramUser.Status.IN_CONVERSATION
+        assert list(storage._waiting) == [route.conversation_id + 1]
+        assert await storage._matchmaker.pop_match(user4.pk) == route.conversation_id + 1
+        storage._flusher.cancel()
+        await storage._journal.close()
+
+    async def test_no_acknowledged_transition_is_lost_by_crash(self, tmp_path):
+        db_url = f'sqlite://{tmp_path / "db.sqlite3"}'
+        run = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', CRASH_SCRIPT, db_url, str(tmp_path), 'run', stdout=asyncio.subprocess.PIPE, cwd=ROOT,
+        )
+        acks = []  # (operation, conversation id)
+        while len(acks) < 1000:
+            line = await asyncio.wait_for(run.stdout.readline(), timeout=30)
+            assert line, 'the transitions are stopped by an error'
+            acks.append(line.decode().split())
+        run.kill()
+        # acknowledgements, written before the kill, are read after it:
+        acks.extend(line.split() for line in (await run.stdout.read()).decode().splitlines())
+        await run.wait()
+        journal = Journal(tmp_path / 'journal', segment_size=4096)
+        journal.open()
+        assert journal.get_unflushed(1), 'every transition is flushed before the crash'
+        await journal.close()
+
+        dump = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', CRASH_SCRIPT, db_url, str(tmp_path), 'dump', stdout=asyncio.subprocess.PIPE, cwd=ROOT,
+        )
+        stdout, __ = await asyncio.wait_for(dump.communicate(), timeout=30)
+        conversations = {conversation_id: (opponent_id, finished) for conversation_id, opponent_id, finished
+                         in ujson.loads(stdout)}
+        for operation, conversation_id in acks:
+            conversation = conversations[int(conversation_id)]
+            if operation == 'paired':
+                assert conversation[0]
+            elif operation == 'finished':
+                assert conversation[1]
+
+
+# transitions of pairs of users, concurrently, with an acknowledgement of every one, or a dump of the database:
+CRASH_SCRIPT = '''
+import asyncio, sys
+from pathlib import Path
+from datetime import timedelta
+import ujson
+from tortoise import Tortoise
+from anon_talks.db import init_db, sync_schemas
+from anon_talks.journal import Journal, JournalError
+from anon_talks.models import Conversation
+from anon_talks.storage import WriteBehindStorage
+
+db_url, path, mode = sys.argv[1:]
+
+async def pair(storage, user1, user2):
+    tags = [f'pair{user1.pk}']  # users of other pairs don't match them
+    while True:
+        await storage.start_conversation(user1, tags)
+        print('started', storage._user_conversations[user1.pk], flush=True)
+        await storage.start_conversation(user2, tags)
+        conversation_id = (await storage.get_route(user2.pk)).conversation_id
+        print('paired', conversation_id, flush=True)
+        await storage.finish_conversation(conversation_id, (user1.pk, user2.pk))
+        print('finished', conversation_id, flush=True)
+
+async def main():
+    if mode == 'run':
+        await sync_schemas(db_url)
+    else:
+        await init_db(db_url)
+    storage = WriteBehindStorage(
+        recent_timeout=timedelta(0), widen_after=timedelta(hours=1),
+        journal=Journal(Path(path) / 'journal', segment_size=4096), flush_interval=0.05, flush_batch_size=50,
+        max_users=1000,
+    )
+    await storage.load()
+    if mode == 'run':
+        users = [(await storage.register_user(tg_id=tg_id, chat_id=tg_id))[0] for tg_id in range(20)]
+        await asyncio.gather(*(pair(storage, *users[i:i + 2]) for i in range(0, 20, 2)))
+    await storage.close()
+    conversations = await Conversation.all().values_list('id', 'opponent_id', 'finished_at')
+    print(ujson.dumps([(conversation_id, opponent_id, bool(finished_at))
+                       for conversation_id, opponent_id, finished_at in conversations]))
+    await Tortoise.close_connections()
+
+asyncio.run(main())
+'''
@@ -0,0 +1,10 @@
+def get_worker_socket_names(workers_count: int):
+    return [f'bot_{number}.sock' for number in range(1, workers_count + 1)]
+
+
+def get_nginx_upstream(workers_count: int) -> str:
+    servers = ''.join(
+        f'  server unix:/tmp/socks/{socket_name} fail_timeout=0;\n'
+        for socket_name in get_worker_socket_names(workers_count)
+    )
+    return f'upstream bot {{\n{servers}}}\n'
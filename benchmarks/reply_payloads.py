@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of CPU cost of a static reply: built per send against serialized once.
+
+Before, every reply built its keyboard and serialized it, and the webhook response was dumped to JSON as a whole.
+Now the keyboard JSON is reused and the webhook response is the chat id put between pre-encoded parts of the body.
+Replies sent by API calls are measured up to the encoded form data of the request, without the network.
+
+Usage:
+    python benchmarks/reply_payloads.py --sends 100000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault('BOT_API_TOKEN', '123456:BENCHMARK-TOKEN-0000000000000000000')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.bot import api  # noqa: E402
+from aiogram.dispatcher.webhook import SendMessage  # noqa: E402
+from aiogram.types.reply_keyboard import KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+from anon_talks.services import BotService  # noqa: E402
+
+
+class OfflineBot(Bot):
+    """
+    Bot, encoding requests as for sending, but not sending them.
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        api.compose_data(data, files)
+        return {'message_id': 1, 'date': 0, 'chat': {'id': data['chat_id'], 'type': 'private'}}
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description='Micro-benchmark of static reply payloads.')
+    arg_parser.add_argument('--sends', type=int, default=100000, help='number of replies of each kind')
+    return arg_parser.parse_args()
+
+
+def get_menu_keyboard():
+    # the way keyboards were built before
+    markup = ReplyKeyboardMarkup(row_width=1)
+    markup.add(KeyboardButton(str(BotService.START_CONVERSATION_BTN)))
+    return markup
+
+
+def webhook_per_send(chat_id):
+    reply = BotService.USER_FINISHED_REPLY
+    SendMessage(chat_id, reply.text, parse_mode=reply.parse_mode, reply_markup=get_menu_keyboard()).get_web_response()
+
+
+def webhook_static(chat_id):
+    BotService.USER_FINISHED_REPLY.to(chat_id).get_web_response()
+
+
+async def api_per_send(bot, chat_id):
+    reply = BotService.OPPONENT_FINISHED_REPLY
+    await bot.send_message(chat_id, reply.text, parse_mode=reply.parse_mode, reply_markup=get_menu_keyboard())
+
+
+async def api_static(bot, chat_id):
+    reply = BotService.OPPONENT_FINISHED_REPLY
+    await bot.send_message(chat_id, reply.text, parse_mode=reply.parse_mode, reply_markup=reply.reply_markup)
+
+
+def report(name, sends, started_at):
+    print(f'{name:<26}{(time.process_time() - started_at) / sends * 1e6:>12.2f}')
+
+
+async def main(args):
+    bot = OfflineBot(token=os.environ['BOT_API_TOKEN'])
+    print(f'{"":<26}{"us per send":>12}')
+    for name, function in (('webhook, per send', webhook_per_send), ('webhook, static', webhook_static)):
+        started_at = time.process_time()
+        for chat_id in range(args.sends):
+            function(chat_id)
+        report(name, args.sends, started_at)
+
+    for name, coro_function in (('API call, per send', api_per_send), ('API call, static', api_static)):
+        started_at = time.process_time()
+        for chat_id in range(args.sends):
+            await coro_function(bot, chat_id)
+        report(name, args.sends, started_at)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
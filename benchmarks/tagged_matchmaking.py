@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of a match lookup by tags among many waiting users.
+
+The matchmaker looks a match up in the queues of the tags of the searcher, so a lookup takes O(tags).
+It's compared with a scan of the whole waiting queue for a shared tag, which takes O(waiting users)
+when there is no match. Every lookup is followed by an enqueue of a new search, to keep the queue size.
+
+Usage:
+    python benchmarks/tagged_matchmaking.py --waiting 100000 --tags 5000 --lookups 10000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from anon_talks.matchmaking import Matchmaker  # noqa: E402
+
+
+class ScanMatchmaker:
+    """
+    Matchmaker, scanning the whole waiting queue for the oldest search with a shared tag.
+    """
+
+    def __init__(self, waiting):
+        self._waiting = OrderedDict(
+            (conversation_id, (user_id, set(tags))) for conversation_id, user_id, tags, __ in waiting
+        )
+
+    async def pop_match(self, user_id, tags=()):
+        tags = set(tags)
+        for conversation_id, (initiator_id, initiator_tags) in self._waiting.items():
+            if initiator_id != user_id and (initiator_tags & tags if tags else not initiator_tags):
+                del self._waiting[conversation_id]
+                return conversation_id
+        return None
+
+    async def enqueue(self, conversation_id, user_id, tags=()):
+        self._waiting[conversation_id] = (user_id, set(tags))
+
+
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description='Micro-benchmark of a match lookup by tags.')
+    arg_parser.add_argument('--waiting', type=int, default=100000, help='number of waiting users')
+    arg_parser.add_argument('--tags', type=int, default=5000, help='number of distinct tags')
+    arg_parser.add_argument('--lookups', type=int, default=10000)
+    arg_parser.add_argument('--seed', type=int, default=1)
+    return arg_parser.parse_args()
+
+
+def make_tags(rng, args):
+    # popularity of tags is skewed, like of real interests:
+    return tuple({f'tag{int(rng.paretovariate(1.2)) % args.tags}' for __ in range(rng.randint(1, 3))})
+
+
+async def run(name, matchmaker, searches, first_id):
+    matched = 0
+    started_at = time.perf_counter()
+    for i, (user_id, tags) in enumerate(searches):
+        if await matchmaker.pop_match(user_id, tags) is not None:
+            matched += 1
+        await matchmaker.enqueue(first_id + i, user_id, tags)
+    duration = time.perf_counter() - started_at
+    print(f'{name:<24}{duration / len(searches) * 1e6:>14.2f}{matched / len(searches):>10.0%}')
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    waiting = [(i, i, make_tags(rng, args), now) for i in range(args.waiting)]
+    first_id = args.waiting
+    # searches by tags, which are mostly unique, miss and make the scan go through the whole queue:
+    searches = [(first_id + i, (f'tag{rng.randrange(args.tags * 2)}',) if i % 2 else make_tags(rng, args))
+                for i in range(args.lookups)]
+
+    async def loader():
+        return waiting, []
+
+    indexed = Matchmaker(loader=loader, recent_timeout=timedelta(minutes=5), widen_after=timedelta(hours=1))
+    await indexed.load()
+
+    print(f'{"":<24}{"us per lookup":>14}{"matched":>10}')
+    await run('tag index', indexed, searches, first_id)
+    await run('scan of the queue', ScanMatchmaker(waiting), searches, first_id)
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
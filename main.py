@@ -1,21 +1,59 @@
 import argparse
-import uvloop
-from anon_talks import start, sync_db
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
 
 
 def main():
-    commands = ('run', 'syncdb')
+    commands = ('run', 'syncdb', 'upstream', 'archive', 'broadcast')
 
     arg_parser = argparse.ArgumentParser(description='Managament commands.')
     arg_parser.add_argument('command', choices=commands)
     arg_parser.add_argument('--sock_name')
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--polling', action='store_true', help='get updates by long polling, not by the webhook')
+    arg_parser.add_argument('--text', help='text of the broadcast message')
+    arg_parser.add_argument('--text_file', help='file with text of the broadcast message')
+    arg_parser.add_argument('--parse_mode', help='parse mode of the broadcast message, e.g. MarkdownV2')
 
     args = arg_parser.parse_args()
+    # a command imports only what it needs, so the bot isn't set up to sync the db, for example:
     if args.command == 'syncdb':
+        from anon_talks.db import sync_db
         sync_db()
+    elif args.command == 'archive':
+        from anon_talks.archive import archive_conversations
+        archive_conversations()
+    elif args.command == 'broadcast':
+        if bool(args.text) == bool(args.text_file):
+            arg_parser.error('the broadcast message is given by either --text or --text_file')
+
+        from anon_talks.broadcast import broadcast
+        text = args.text
+        if args.text_file:
+            with open(args.text_file) as text_file:
+                text = text_file.read()
+        broadcast(text, parse_mode=args.parse_mode)
+    elif args.command == 'upstream':
+        from anon_talks.upstream import get_nginx_upstream
+        print(get_nginx_upstream(args.workers), end='')
     else:
+        from anon_talks import config
+        if args.polling and args.workers > 1:
+            arg_parser.error('--polling is run by a single process')
+        if args.workers > 1 and config.STORAGE != 'database':
+            arg_parser.error(f'the {config.STORAGE} storage is kept by a single process')
+
+        import uvloop
+        from anon_talks import app
         uvloop.install()
-        start(socket_name=args.sock_name)
+        if args.polling:
+            app.start_polling()
+        elif args.workers > 1:
+            app.start_workers(args.workers)
+        else:
+            app.start(socket_name=args.sock_name)
 
 
 if __name__ == '__main__':